@@ -1,4 +1,20 @@
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import signals
+
 from denormalize.backend.base import BackendBase
+from denormalize.context import get_current_context
+
+from . import settings
+from .bulk import chunks, is_batched
+from .fanout import FanOut, fanouts
+from .memo import batch_memo
+from .suspend import suspension_for
+from .verify import resync
+
+
+log = logging.getLogger(__name__)
 
 
 class PolymorphicBackendBase(BackendBase):
@@ -10,7 +26,14 @@ class PolymorphicBackendBase(BackendBase):
     This can be safely used as a mixin, too.
     """
 
+    #: Whether to project changes as Django's signals report them; a
+    #: backend kept up to date some other way (see :mod:`cqrs.polling`)
+    #: needn't.
+    listen = True
+
     def _setup_listeners(self, collection):
+        if not self.listen:
+            return
         # This is something that can *almost* be done in the collection, but
         # not quite. But really, doing it here is the right place, anyway.
         # Tests ensure that this fairly fragile thing doesn't break unnoticed.
@@ -62,3 +85,456 @@ class PolymorphicBackendBase(BackendBase):
             # the underlying problem. (Concensus is that it's a design bug.)
             assert self._listeners.pop().__name__ == 'post_delete'
             assert self._listeners.pop().__name__ == 'pre_delete'
+
+    def _add_listeners(self, collection, filter_path, submodel, info):
+        super(PolymorphicBackendBase, self)._add_listeners(
+            collection, filter_path, submodel, info)
+
+        if filter_path is None:
+            return
+        if filter_path in getattr(collection, 'fanout_paths', ()):
+            self._add_fanout_listeners(collection, filter_path, submodel)
+        else:
+            get_embedded_arrays = getattr(collection, 'get_embedded_arrays',
+                                          None)
+            embedded_array = None
+            if get_embedded_arrays is not None:
+                embedded_array = get_embedded_arrays().get(filter_path)
+            if embedded_array is not None:
+                if '__' in filter_path or (info['direct']
+                                           and not info['m2m']):
+                    raise ImproperlyConfigured(
+                        '{}.{}: only reverse foreign keys and many-to-many '
+                        'relations of the root model can be embedded arrays'
+                        .format(type(collection).__name__, filter_path))
+                self._add_embedded_array_listeners(
+                    collection, filter_path, submodel, info, embedded_array)
+        self._add_suspension_listeners(collection, filter_path, submodel)
+
+    def _replace_listener(self, signal, sender, name, make_listener):
+        # django-denormalize has just made and connected its listeners; swap
+        # the one called ``name`` for our own, which is given the original to
+        # fall back on. (Keeping its place in _listeners is important to the
+        # subclass listener trickery above.)
+        for i in range(len(self._listeners) - 1, -1, -1):
+            if self._listeners[i].__name__ == name:
+                break
+        else:
+            raise AssertionError('No {} listener to replace'.format(name))
+        original = self._listeners[i]
+        listener = make_listener(original)
+        listener.__name__ = name
+        signal.disconnect(original, sender=sender)
+        signal.connect(listener, sender=sender)
+        self._listeners[i] = listener
+
+    def _add_embedded_array_listeners(self, collection, filter_path, submodel,
+                                      info, embedded_array):
+        """
+        Replace the listeners which would re-dump every affected document
+        when a child changes with ones which update just that child's element
+        of the embedded array.
+        """
+
+        def affected_ids(instance):
+            return set(collection.queryset(prefetch=False)
+                       .filter(**{filter_path: instance})
+                       .values_list('id', flat=True))
+
+        # Where a child was before it was saved; unlike django-denormalize's
+        # record of it, this is forgotten once the save is done with, as it
+        # matters whether the child is new to a document or not. (Another
+        # backend may have the same collection, hence the backend's id.)
+        before_attname = self._embedded_before_attname(collection,
+                                                       filter_path)
+
+        def make_pre_save(original):
+            def pre_save(sender, instance, raw, **kwargs):
+                if raw or not instance.pk:
+                    return original(sender, instance=instance, raw=raw,
+                                    **kwargs)
+                before = affected_ids(instance)
+                # (What the original would have done, should post_save need
+                # to fall back on its original.)
+                self._set_affected('save', collection, instance, before)
+                setattr(instance, before_attname, before)
+            return pre_save
+
+        def make_post_save(original):
+            def post_save(sender, instance, created, raw, **kwargs):
+                before = instance.__dict__.pop(before_attname, set())
+                if raw or self._delaying():
+                    return original(sender, instance=instance,
+                                    created=created, raw=raw, **kwargs)
+                # It may have changed parents.
+                now = set(collection.map_affected(affected_ids(instance)))
+                before = set(collection.map_affected(before))
+                for doc_id in now:
+                    if created or doc_id not in before:
+                        self._queue_embedded(collection, doc_id,
+                                             self._embedded_add, collection,
+                                             embedded_array, doc_id, instance)
+                    else:
+                        self._queue_embedded(collection, doc_id,
+                                             self._embedded_change,
+                                             collection, embedded_array,
+                                             doc_id, instance)
+                for doc_id in before - now:
+                    self._queue_embedded(collection, doc_id,
+                                         self._embedded_remove, collection,
+                                         embedded_array, doc_id, instance.pk)
+            return post_save
+
+        def make_post_delete(original):
+            def post_delete(sender, instance, **kwargs):
+                if self._delaying():
+                    return original(sender, instance=instance, **kwargs)
+                affected = self._get_affected('delete', collection, instance)
+                for doc_id in collection.map_affected(affected):
+                    self._queue_embedded(collection, doc_id,
+                                         self._embedded_remove, collection,
+                                         embedded_array, doc_id, instance.pk)
+            return post_delete
+
+        def make_m2m_changed(original):
+            def m2m_changed(sender, instance, action, reverse, model, pk_set,
+                            **kwargs):
+                if action in ('pre_add', 'pre_remove'):
+                    # Nothing has happened yet; wait for the post_ signal.
+                    return
+                if (action not in ('post_add', 'post_remove')
+                        or self._delaying()):
+                    return original(sender, instance=instance, action=action,
+                                    reverse=reverse, model=model,
+                                    pk_set=pk_set, **kwargs)
+                if not pk_set:
+                    return
+                if isinstance(instance, collection.model):
+                    # Children added to or removed from a document.
+                    doc_ids = collection.map_affected(set([instance.pk]))
+                    children = submodel._default_manager.filter(pk__in=pk_set)
+                else:
+                    # A child added to or removed from some documents.
+                    doc_ids = collection.map_affected(set(pk_set))
+                    children = [instance]
+                for child in children:
+                    for doc_id in doc_ids:
+                        if action == 'post_add':
+                            self._queue_embedded(collection, doc_id,
+                                                 self._embedded_add,
+                                                 collection, embedded_array,
+                                                 doc_id, child)
+                        else:
+                            self._queue_embedded(collection, doc_id,
+                                                 self._embedded_remove,
+                                                 collection, embedded_array,
+                                                 doc_id, child.pk)
+            return m2m_changed
+
+        self._replace_listener(signals.pre_save, submodel, 'pre_save',
+                               make_pre_save)
+        self._replace_listener(signals.post_save, submodel, 'post_save',
+                               make_post_save)
+        self._replace_listener(signals.post_delete, submodel, 'post_delete',
+                               make_post_delete)
+        if info['m2m']:
+            self._replace_listener(signals.m2m_changed, info['through'],
+                                   'm2m_changed', make_m2m_changed)
+
+    def _embedded_before_attname(self, collection, filter_path):
+        return '_cqrs_embedded_{}_{}_{}'.format(id(self), collection.name,
+                                                filter_path)
+
+    def _add_suspension_listeners(self, collection, filter_path, submodel):
+        """
+        Wrap the post_save listener for a related model, so that while
+        projection is suspended (see :mod:`cqrs.suspend`), a new object is
+        just noted, and the documents it belongs to found at the end, along
+        with all the others, rather than with a query apiece.
+        """
+        before_attname = self._embedded_before_attname(collection,
+                                                       filter_path)
+
+        def make_post_save(original):
+            def post_save(sender, instance, created, raw, **kwargs):
+                suspension = suspension_for(collection)
+                if suspension is None or raw or not created:
+                    return original(sender, instance=instance,
+                                    created=created, raw=raw, **kwargs)
+                # (In case it came with a primary key, and so pre_save
+                # looked for where it was before.)
+                instance.__dict__.pop(before_attname, None)
+                suspension.touch_related(self, collection, filter_path,
+                                         instance.pk)
+            return post_save
+
+        self._replace_listener(signals.post_save, submodel, 'post_save',
+                               make_post_save)
+
+    def _add_fanout_listeners(self, collection, filter_path, submodel):
+        """
+        Replace the save listeners for a widely referenced related model with
+        ones which queue a single fan-out (see :mod:`cqrs.fanout`) instead of
+        working out and re-dumping every affected document there and then.
+        """
+        related_models = collection.get_related_models()
+        parts = filter_path.split('__')
+        for i in range(len(parts)):
+            if not related_models['__'.join(parts[:i + 1])]['direct']:
+                raise ImproperlyConfigured(
+                    '{}.{}: fan-out paths must be made of forward relations'
+                    .format(type(collection).__name__, filter_path))
+
+        def make_pre_save(original):
+            def pre_save(sender, instance, raw, **kwargs):
+                # Saving the related object can't change which documents
+                # refer to it, so there's no need to find them beforehand.
+                pass
+            return pre_save
+
+        def make_post_save(original):
+            def post_save(sender, instance, created, raw, **kwargs):
+                if raw or created:
+                    # Nothing can refer to a new object yet.
+                    return original(sender, instance=instance,
+                                    created=created, raw=raw, **kwargs)
+                self._queue_changed(collection,
+                                    FanOut(filter_path, instance.pk))
+            return post_save
+
+        self._replace_listener(signals.pre_save, submodel, 'pre_save',
+                               make_pre_save)
+        self._replace_listener(signals.post_save, submodel, 'post_save',
+                               make_post_save)
+
+    #: Whether the backend wants documents as plain dictionaries keyed by
+    #: ``_id`` (see :meth:`cqrs.serializers.CQRSSerializer.to_document`),
+    #: rather than the usual serializer output.
+    plain_documents = False
+
+    def document_for(self, collection, obj):
+        """Dump ``obj`` in the form the backend wants."""
+        if self.plain_documents and hasattr(collection, 'dump_document'):
+            return collection.dump_document(obj)
+        return collection.dump(obj)
+
+    def document_for_id(self, collection, doc_id):
+        """Dump the object ``doc_id`` in the form the backend wants."""
+        if self.plain_documents and hasattr(collection, 'dump_document_id'):
+            return collection.dump_document_id(doc_id)
+        return collection.dump_id(doc_id)
+
+    def _call_added(self, collection, doc_id):
+        doc = self.document_for_id(collection, doc_id)
+        self.added(collection, doc_id, doc)
+
+    def _call_changed(self, collection, doc_id):
+        if isinstance(doc_id, FanOut):
+            return fanouts.submit(self.backend_name, collection, doc_id)
+        doc = self.document_for_id(collection, doc_id)
+        self.changed(collection, doc_id, doc)
+
+    @property
+    def backend_name(self):
+        """The name this backend is registered under."""
+        for name, backend in self._registry.items():
+            if backend is self:
+                return name
+
+    # While projection is suspended for a collection (see cqrs.suspend),
+    # changes to it are merely noted.
+
+    def _suspended(self, collection, doc_id):
+        suspension = suspension_for(collection)
+        if suspension is None:
+            return False
+        suspension.touch(self, collection, doc_id)
+        return True
+
+    def _queue_added(self, collection, doc_id):
+        if not self._suspended(collection, doc_id):
+            super(PolymorphicBackendBase, self)._queue_added(collection,
+                                                             doc_id)
+
+    def _queue_changed(self, collection, doc_id):
+        if not self._suspended(collection, doc_id):
+            super(PolymorphicBackendBase, self)._queue_changed(collection,
+                                                               doc_id)
+
+    def _queue_deleted(self, collection, doc_id):
+        if not self._suspended(collection, doc_id):
+            super(PolymorphicBackendBase, self)._queue_deleted(collection,
+                                                               doc_id)
+
+    def _delaying(self):
+        """
+        Whether changes are being delayed (by ``delay_sync``) to be written
+        as whole documents, rather than batched (see :mod:`cqrs.bulk`), which
+        can cope with embedded array updates too.
+        """
+        context = get_current_context()
+        return context is not None and not is_batched(context)
+
+    def _queue_embedded(self, collection, doc_id, operation, *args):
+        """
+        Do an embedded array update (``operation(*args)``) for a document,
+        or queue it if changes are being batched.
+        """
+        if self._suspended(collection, doc_id):
+            return
+        context = get_current_context()
+        if is_batched(context):
+            key = u'{0}-{1}-{2}'.format(id(self), id(collection), doc_id)
+            context.embedded.append((key, operation, args))
+        else:
+            operation(*args)
+
+    # Bulk versions of _call_added, _call_changed and _call_deleted, for
+    # writing out batched changes (see cqrs.bulk). Documents are dumped and
+    # written CQRS_BULK_CHUNK_SIZE at a time, unless they've been dumped
+    # already (as cqrs.verify.resync has), when they're given as docs, a list
+    # of (doc_id, doc) for doc_ids.
+
+    def _call_added_many(self, collection, doc_ids, docs=None):
+        if docs is not None:
+            return self.added_many(collection, docs)
+        self._write_many(collection, doc_ids, self.added_many)
+
+    def _call_changed_many(self, collection, doc_ids):
+        self._write_many(collection, doc_ids, self.changed_many)
+
+    def _call_deleted_many(self, collection, doc_ids):
+        self.deleted_many(collection, doc_ids)
+
+    def _write_many(self, collection, doc_ids, write_many):
+        for chunk in chunks(doc_ids, settings.CQRS_BULK_CHUNK_SIZE):
+            with batch_memo():
+                docs = [(obj.pk, self.document_for(collection, obj))
+                        for obj in collection.queryset().filter(pk__in=chunk)]
+            if docs:
+                write_many(collection, docs)
+
+    def _embedded_add(self, collection, embedded_array, doc_id, obj):
+        if embedded_array.ordered or embedded_array.aggregates:
+            return self._call_changed(collection, doc_id)
+        element = embedded_array.dump_element(obj)
+        log.debug('embedded add: %s %s %s %s', collection.name, doc_id,
+                  embedded_array.field, element.get(embedded_array.key))
+        self.embedded_added(collection, doc_id, embedded_array, element)
+
+    def _embedded_change(self, collection, embedded_array, doc_id, obj):
+        if embedded_array.ordered:
+            return self._call_changed(collection, doc_id)
+        element = embedded_array.dump_element(obj)
+        log.debug('embedded change: %s %s %s %s', collection.name, doc_id,
+                  embedded_array.field, element.get(embedded_array.key))
+        self.embedded_changed(collection, doc_id, embedded_array, element)
+
+    def _embedded_remove(self, collection, embedded_array, doc_id, key):
+        if embedded_array.aggregates:
+            return self._call_changed(collection, doc_id)
+        log.debug('embedded remove: %s %s %s %s', collection.name, doc_id,
+                  embedded_array.field, key)
+        self.embedded_removed(collection, doc_id, embedded_array, key)
+
+    # Bulk versions of added, changed and deleted, for fan-outs and the like;
+    # ``docs`` is a sequence of (doc_id, doc) pairs. These defaults make one
+    # call per document; backends which can do better should.
+
+    def added_many(self, collection, docs):
+        for doc_id, doc in docs:
+            self.added(collection, doc_id, doc)
+
+    def changed_many(self, collection, docs):
+        for doc_id, doc in docs:
+            self.changed(collection, doc_id, doc)
+
+    def deleted_many(self, collection, doc_ids):
+        for doc_id in doc_ids:
+            self.deleted(collection, doc_id)
+
+    # Implement these for your backend to make use of embedded arrays (see
+    # cqrs.embedded). These defaults just re-dump the whole document, so a
+    # backend without them still gets the right data, just less quickly.
+
+    def embedded_added(self, collection, doc_id, embedded_array, element):
+        """Called when an element has been added to an embedded array."""
+        self._call_changed(collection, doc_id)
+
+    def embedded_changed(self, collection, doc_id, embedded_array, element):
+        """
+        Called when an element of an embedded array has changed. If the
+        document doesn't have the element, it should be added.
+        """
+        self._call_changed(collection, doc_id)
+
+    def embedded_removed(self, collection, doc_id, embedded_array, key):
+        """
+        Called when the element with the given key has been removed from an
+        embedded array.
+        """
+        self._call_changed(collection, doc_id)
+
+    def get_docs(self, collection, doc_ids):
+        """
+        Get the stored documents with the given ids, as a dictionary of id to
+        document (leaving out those there aren't). This default gets them one
+        at a time; backends which can do better should.
+        """
+        docs = {}
+        for doc_id in doc_ids:
+            doc = self.get_doc(collection, doc_id)
+            if doc is not None:
+                docs[doc_id] = doc
+        return docs
+
+    def docs_in_range(self, collection, lo=None, hi=None):
+        """
+        Get the stored ``(doc_id, doc)`` pairs with ``lo <= doc_id < hi``
+        (either bound may be ``None`` for no bound), in order of id, with
+        documents as :meth:`document_for` would dump them. It's what
+        :mod:`cqrs.verify` checks the read model with; backends which can't
+        read their documents back don't support it.
+        """
+        raise NotImplementedError(
+            "{} can't read documents back".format(type(self).__name__))
+
+    def distinct_values(self, collection, field, query=None):
+        """
+        Get the set of values the stored documents matching ``query`` (a
+        dictionary of top level field to value) have for ``field``, with
+        ``None`` for those without it. This default reads every document
+        (with :meth:`docs_in_range`); backends which can do better should.
+        """
+        query = query or {}
+        return set(doc.get(field) for doc_id, doc
+                   in self.docs_in_range(collection)
+                   if all(doc.get(key) == value
+                          for key, value in query.items()))
+
+    def sync_collection(self, collection):
+        """
+        Bring everything stored for a collection into line with the database
+        (see :func:`cqrs.verify.resync`), writing only what's wrong, and
+        returning the number of documents. It needs :meth:`docs_in_range`.
+        """
+        return resync(self, collection)['documents']
+
+    def ensure_indexes(self, collection):
+        """
+        Bring the read model's indexes into line with what ``collection``
+        declares (see :meth:`~cqrs.collections.DRFDocumentCollectionBase.get_indexes`),
+        creating any which are missing. Existing indexes are never dropped.
+
+        Returns the names of the indexes created. Backends without any notion
+        of secondary indexes needn't do anything, and this default doesn't.
+        """
+        return []
+
+    def ensure_all_indexes(self):
+        """
+        Run :meth:`ensure_indexes` for every registered collection, returning a
+        dictionary of collection name to the names of the indexes created.
+        """
+        return dict((name, self.ensure_indexes(collection))
+                    for name, collection in self.collections.items())
@@ -0,0 +1,310 @@
+'''
+Projection of bulk ORM operations.
+
+``QuerySet.bulk_create`` and ``QuerySet.update`` send no signals, so the
+backends never hear of what they do, and ``QuerySet.delete`` sends a pair for
+every object, each of which becomes its own backend write. The managers of
+:class:`~cqrs.models.CQRSModel` and
+:class:`~cqrs.models.CQRSPolymorphicModel` use the querysets here, which
+make up for that: they work out which documents the operation affects (those
+of the objects themselves, and those of anything with them as a related
+model) and project them all at once::
+
+    Product.objects.filter(category=old).update(category=new)
+
+Writes are batched up with :func:`batched_projection`, which is like
+:func:`denormalize.context.delay_sync`, except that when it's done it writes
+each collection's documents with a single ``deleted_many``, and
+``added_many`` or ``changed_many`` calls of up to ``CQRS_BULK_CHUNK_SIZE``
+documents each, dumped together (see :mod:`cqrs.memo`). It's also handy
+wrapped round any stretch of ordinary saves and deletes. Inside a
+``delay_sync`` everything is left for that to do, as it would be for any
+other change.
+
+Deleting a CQRS model instance is batched in the same way, so that the
+documents of everything the deletion cascades to are removed with a single
+``deleted_many`` per collection, rather than one backend call per object
+(and, for polymorphic models, the delete signals which bubble up to each
+concrete parent only mean the one document to remove). Deletions which start
+from other models and cascade to CQRS models can be batched by wrapping them
+in :func:`batched_projection`; and wrapping it round a transaction (outside
+the ``atomic``) projects everything done in it once it's committed::
+
+    with batched_projection(), transaction.atomic():
+        category.delete()
+
+Django 1.6 doesn't tell us the primary keys of the objects ``bulk_create``
+inserts, so objects which don't come with them can't be projected; a warning
+is logged for them.
+'''
+
+from __future__ import absolute_import
+
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db.models.query import QuerySet
+from polymorphic.query import PolymorphicQuerySet
+
+from denormalize.backend.base import BackendBase
+from denormalize.context import _Context, get_current_context, queue_context
+
+from . import settings
+from .fanout import FanOut
+
+
+log = logging.getLogger(__name__)
+
+
+def chunks(items, size):
+    """Split ``items`` into lists of up to ``size``."""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _group(queued):
+    """Group queued ``(backend, collection, doc_id)`` by the first two."""
+    groups = OrderedDict()
+    for backend, collection, doc_id in queued:
+        groups.setdefault((backend, collection), []).append(doc_id)
+    return groups.items()
+
+
+def _call_many(backend, name, collection, doc_ids):
+    many = getattr(backend, '_call_{}_many'.format(name), None)
+    if many is not None:
+        return many(collection, doc_ids)
+    # Not a CQRS backend; one at a time it is.
+    for doc_id in doc_ids:
+        getattr(backend, '_call_{}'.format(name))(collection, doc_id)
+
+
+def flush_batched(context):
+    """
+    Write out what has been queued in a batched context, with bulk backend
+    calls. The same rules apply as for ``delay_sync``: an added document is
+    only added (and not also changed), and a deleted one only deleted. Queued
+    embedded array updates are left out for documents being written whole.
+    """
+    for (backend, collection), doc_ids in _group(context.deleted.values()):
+        _call_many(backend, 'deleted', collection, doc_ids)
+    for (backend, collection), doc_ids in _group(context.added.values()):
+        _call_many(backend, 'added', collection, doc_ids)
+    changed = [value for key, value in context.changed.items()
+               if key not in context.added and key not in context.deleted]
+    for (backend, collection), doc_ids in _group(changed):
+        for doc_id in doc_ids:
+            if isinstance(doc_id, FanOut):
+                backend._call_changed(collection, doc_id)
+        doc_ids = [doc_id for doc_id in doc_ids
+                   if not isinstance(doc_id, FanOut)]
+        if doc_ids:
+            _call_many(backend, 'changed', collection, doc_ids)
+    for key, operation, args in context.embedded:
+        if (key not in context.added and key not in context.changed
+                and key not in context.deleted):
+            operation(*args)
+
+
+class _BatchedContext(_Context):
+    """A django-denormalize context which is flushed in bulk."""
+
+    def __init__(self):
+        super(_BatchedContext, self).__init__()
+        # (key, operation, args) for embedded array updates
+        self.embedded = []
+
+    def flush(self):
+        flush_batched(self)
+
+
+def is_batched(context):
+    """Whether a django-denormalize context is a batched one."""
+    return isinstance(context, _BatchedContext)
+
+
+@contextmanager
+def batched_projection():
+    """
+    Queue the projection of everything done in this thread for the duration,
+    and then write it out in bulk (see :mod:`cqrs.bulk`). As with
+    ``delay_sync``, nothing is written if it ends with an exception.
+    """
+    if get_current_context() is not None:
+        # Whoever is delaying syncs already will see to it.
+        yield
+        return
+    context = queue_context.context = _BatchedContext()
+    try:
+        yield
+    finally:
+        queue_context.context = None
+    context.flush()
+
+
+def affected_collections(model, listening=True):
+    """
+    Generate ``(backend, collection, filter_path)`` for each registered
+    collection whose documents objects of ``model`` are (``filter_path`` is
+    ``None``) or are related to (by ``filter_path``). Backends which don't
+    ``listen`` for changes (see :mod:`cqrs.polling`) are left out, unless
+    ``listening`` is false.
+    """
+    for backend in BackendBase._registry.values():
+        if listening and not getattr(backend, 'listen', True):
+            continue
+        for collection in backend.collections.values():
+            if (issubclass(model, collection.model)
+                    or issubclass(collection.model, model)):
+                yield backend, collection, None
+            for filter_path, info in collection.get_related_models().items():
+                if (issubclass(model, info['model'])
+                        or issubclass(info['model'], model)):
+                    yield backend, collection, filter_path
+
+
+def _root_ids(collection, model, pks):
+    if issubclass(model, collection.model):
+        return set(pks)
+    # They're not necessarily all in a collection of a subclass.
+    return set(collection.queryset(prefetch=False).filter(pk__in=pks)
+               .values_list('pk', flat=True))
+
+
+def related_ids(collection, filter_path, pks):
+    """Get the ids of the documents related by ``filter_path`` to ``pks``."""
+    return set(collection.queryset(prefetch=False)
+               .filter(**{'{}__in'.format(filter_path): pks})
+               .values_list('pk', flat=True))
+
+
+def reconcile(backend, collection, doc_ids):
+    """
+    Bring documents into line with the database, ``CQRS_BULK_CHUNK_SIZE`` at
+    a time: those whose objects are there are written whole (with
+    ``added_many``, which replaces them), and the rest deleted. Returns the
+    number of documents written or deleted.
+    """
+    for chunk in chunks(sorted(doc_ids), settings.CQRS_BULK_CHUNK_SIZE):
+        present = set(collection.queryset(prefetch=False)
+                      .filter(pk__in=chunk).values_list('pk', flat=True))
+        gone = [doc_id for doc_id in chunk if doc_id not in present]
+        if gone:
+            backend._call_deleted_many(collection, gone)
+        if present:
+            backend._call_added_many(collection, sorted(present))
+    return len(doc_ids)
+
+
+def queue_saved(model, pks, created=False, before=None):
+    """
+    Queue the projection of objects of ``model`` saved by a bulk operation,
+    given their primary keys.
+
+    :param created: whether they're new objects
+    :param before: what :func:`affected_before` gave before the operation,
+                   as an update may change which documents objects are related
+                   to
+    """
+    pks = list(pks)
+    if not pks:
+        return
+    before = before or {}
+    for backend, collection, filter_path in affected_collections(model):
+        if filter_path is None:
+            doc_ids = collection.map_affected(
+                _root_ids(collection, model, pks))
+            queue = backend._queue_added if created else backend._queue_changed
+            for doc_id in doc_ids:
+                queue(collection, doc_id)
+        elif (not created
+              and filter_path in getattr(collection, 'fanout_paths', ())):
+            # Fan-out paths are forward relations, so an update can't change
+            # which documents refer to the objects.
+            for pk in pks:
+                backend._queue_changed(collection, FanOut(filter_path, pk))
+        else:
+            affected = related_ids(collection, filter_path, pks)
+            affected |= before.get((id(backend), collection.name,
+                                    filter_path), set())
+            for doc_id in collection.map_affected(affected):
+                backend._queue_changed(collection, doc_id)
+
+
+def affected_before(model, pks):
+    """
+    Find the documents which objects of ``model`` are related to before a
+    bulk update, for :func:`queue_saved` to bring up to date afterwards.
+    """
+    pks = list(pks)
+    affected = {}
+    if not pks:
+        return affected
+    for backend, collection, filter_path in affected_collections(model):
+        if (filter_path is not None
+                and filter_path not in getattr(collection, 'fanout_paths', ())):
+            affected[(id(backend), collection.name, filter_path)] = \
+                related_ids(collection, filter_path, pks)
+    return affected
+
+
+def _has_collections(model):
+    for _ in affected_collections(model):
+        return True
+    return False
+
+
+class CQRSQuerySetMixin(object):
+    """
+    Projects ``bulk_create``, ``update`` and ``delete`` (see
+    :mod:`cqrs.bulk`).
+    """
+
+    def _pre_bulk_create(self, objs):
+        """Do anything ``save`` would have done to the objects."""
+
+    def bulk_create(self, objs, batch_size=None):
+        objs = list(objs)
+        self._pre_bulk_create(objs)
+        with batched_projection():
+            objs = super(CQRSQuerySetMixin, self).bulk_create(
+                objs, batch_size=batch_size)
+            pks = [obj.pk for obj in objs if obj.pk is not None]
+            if len(pks) < len(objs) and _has_collections(self.model):
+                log.warning('bulk_create: %d %s objects without primary '
+                            'keys could not be projected',
+                            len(objs) - len(pks), self.model.__name__)
+            queue_saved(self.model, pks, created=True)
+        return objs
+
+    def update(self, **kwargs):
+        if not _has_collections(self.model):
+            return super(CQRSQuerySetMixin, self).update(**kwargs)
+        # Afterwards, they may not match any more.
+        pks = list(self.values_list('pk', flat=True))
+        before = affected_before(self.model, pks)
+        with batched_projection():
+            rows = super(CQRSQuerySetMixin, self).update(**kwargs)
+            queue_saved(self.model, pks, before=before)
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        # Deleting sends signals for each object, which are queued up and
+        # written all together.
+        with batched_projection():
+            super(CQRSQuerySetMixin, self).delete()
+    delete.alters_data = True
+
+
+class CQRSQuerySet(CQRSQuerySetMixin, QuerySet):
+    pass
+
+
+class CQRSPolymorphicQuerySet(CQRSQuerySetMixin, PolymorphicQuerySet):
+
+    def _pre_bulk_create(self, objs):
+        for obj in objs:
+            obj.pre_save_polymorphic()
@@ -0,0 +1,300 @@
+'''
+A read-through cache of documents, for code which reads the read model back.
+
+Reading projected documents with ``get_doc`` (or ``get_docs``) costs a round
+trip to the backend every time. A backend with :class:`CachingBackendMixin`
+keeps the documents it has read in a bounded, least recently used cache, for up
+to ``cache_ttl`` seconds::
+
+    class Backend(CachingBackendMixin, PolymorphicMongoIDBackend):
+        cache_size = 10000
+        cache_ttl = 60
+
+The backend's own writes (``added``, ``changed``, ``deleted``, their ``_many``
+versions, embedded array updates, syncs and rebuilds) drop the documents they
+write from the cache, so in this process a cached document is never older than
+the last write to it. A read which was under way when a document was written
+isn't cached, as it may have read the document from before the write.
+
+Other processes' writes only reach the cache by way of the TTL, unless the
+backends share an *invalidation channel*, which passes on the ids written to
+every process's cache: :class:`MemoryInvalidationChannel` within a process
+(handy for tests), or :class:`cqrs.mongo.MongoInvalidationChannel` between
+processes. A channel needs :meth:`~MemoryInvalidationChannel.publish` and
+:meth:`~MemoryInvalidationChannel.subscribe`.
+
+:meth:`CachingBackendMixin.cache_report` gives the hits, misses and hit rate
+for each collection.
+'''
+
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+from . import settings
+from .memo import _report
+
+
+class DocumentCache(object):
+    """
+    A bounded, least recently used cache of documents, each kept for up to
+    ``ttl`` seconds, counting its hits and misses per collection.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = max_size or settings.CQRS_CACHE_SIZE
+        self.ttl = settings.CQRS_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        # (collection name, doc_id): (expiry time, document)
+        self._docs = OrderedDict()
+        # (collection name, doc_id): reads under way; and those of them
+        # which were invalidated meanwhile.
+        self._loading = {}
+        self._stale = set()
+        # collection name: [hits, misses]
+        self.stats = {}
+
+    def get(self, name, doc_id, load):
+        """
+        Get a document from the cache, calling ``load()`` for it if need be.
+        """
+        return self.get_many(
+            name, [doc_id], lambda doc_ids: {doc_id: load()}).get(doc_id)
+
+    def get_many(self, name, doc_ids, load_many):
+        """
+        Get documents from the cache, as a dictionary of id to document
+        (leaving out those there aren't), calling ``load_many(doc_ids)``
+        (which gives the same) for those it doesn't have.
+        """
+        docs = {}
+        missing = []
+        now = time.time()
+        with self._lock:
+            counts = self.stats.setdefault(name, [0, 0])
+            for doc_id in doc_ids:
+                key = name, doc_id
+                entry = self._docs.pop(key, None)
+                if entry is not None and entry[0] > now:
+                    # (Re-)inserted last, as the most recently used.
+                    self._docs[key] = entry
+                    counts[0] += 1
+                    if entry[1] is not None:
+                        docs[doc_id] = deepcopy(entry[1])
+                else:
+                    counts[1] += 1
+                    missing.append(doc_id)
+                    self._loading[key] = self._loading.get(key, 0) + 1
+        if not missing:
+            return docs
+
+        try:
+            loaded = load_many(missing)
+        except Exception:
+            for doc_id in missing:
+                self._loaded((name, doc_id))
+            raise
+        for doc_id in missing:
+            key = name, doc_id
+            # (Knowing there isn't one is worth keeping, too.)
+            doc = loaded.get(doc_id)
+            if self._loaded(key):
+                with self._lock:
+                    if len(self._docs) >= self.max_size:
+                        self._docs.popitem(last=False)
+                    self._docs[key] = now + self.ttl, deepcopy(doc)
+            if doc is not None:
+                docs[doc_id] = doc
+        return docs
+
+    def _loaded(self, key):
+        """Note that a read is done, returning whether it can be cached."""
+        with self._lock:
+            fresh = key not in self._stale
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+                self._stale.discard(key)
+            return fresh
+
+    def invalidate(self, name, doc_ids=None):
+        """
+        Drop documents of the collection ``name`` from the cache: those with
+        the given ids, or all of them.
+        """
+        with self._lock:
+            if doc_ids is None:
+                keys = [key for key in self._docs if key[0] == name]
+                self._stale.update(key for key in self._loading
+                                   if key[0] == name)
+            else:
+                keys = [(name, doc_id) for doc_id in doc_ids]
+                self._stale.update(key for key in keys
+                                   if key in self._loading)
+            for key in keys:
+                self._docs.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+            self._stale.update(self._loading)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def report(self):
+        """Report the hits, misses and hit rate for each collection."""
+        with self._lock:
+            return _report(deepcopy(self.stats))
+
+
+class MemoryInvalidationChannel(object):
+    """
+    An invalidation channel (see :mod:`cqrs.cache`) between the backends of
+    one process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def publish(self, name, doc_ids=None):
+        """
+        Tell every subscriber that documents of the collection ``name`` (those
+        with the given ids, or all of them) have been written.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber(name, doc_ids)
+
+    def subscribe(self, callback):
+        """Call ``callback(name, doc_ids)`` for everything published."""
+        with self._lock:
+            self._subscribers.append(callback)
+
+
+class CachingBackendMixin(object):
+    """
+    A backend mixin caching the documents ``get_doc`` and ``get_docs`` read
+    (see :mod:`cqrs.cache`). ``cache_size``, ``cache_ttl`` and
+    ``invalidation_channel`` may be given as class attributes or keyword
+    arguments.
+    """
+
+    cache_size = None
+    cache_ttl = None
+    invalidation_channel = None
+
+    def __init__(self, *args, **kwargs):
+        cache_size = kwargs.pop('cache_size', None) or self.cache_size
+        cache_ttl = kwargs.pop('cache_ttl', None)
+        if cache_ttl is None:
+            cache_ttl = self.cache_ttl
+        channel = kwargs.pop('invalidation_channel', None)
+        if channel is not None:
+            self.invalidation_channel = channel
+        self.cache = DocumentCache(cache_size, cache_ttl)
+        if self.invalidation_channel is not None:
+            self.invalidation_channel.subscribe(self.cache.invalidate)
+        super(CachingBackendMixin, self).__init__(*args, **kwargs)
+
+    def get_doc(self, collection, doc_id):
+        return self.cache.get(
+            collection.name, doc_id,
+            lambda: super(CachingBackendMixin, self).get_doc(collection,
+                                                             doc_id))
+
+    def get_docs(self, collection, doc_ids):
+        return self.cache.get_many(
+            collection.name, doc_ids,
+            lambda doc_ids: super(CachingBackendMixin, self).get_docs(
+                collection, doc_ids))
+
+    def cache_report(self):
+        """Report the hits, misses and hit rate for each collection."""
+        return self.cache.report()
+
+    def _invalidate(self, collection, doc_ids=None):
+        if doc_ids is not None:
+            doc_ids = list(doc_ids)
+        self.cache.invalidate(collection.name, doc_ids)
+        if self.invalidation_channel is not None:
+            self.invalidation_channel.publish(collection.name, doc_ids)
+
+    # Documents are dropped once they've been written (or failed to be, as
+    # there's no knowing how far it got), so that a read can't cache what
+    # was there before.
+
+    def added(self, collection, doc_id, doc):
+        try:
+            super(CachingBackendMixin, self).added(collection, doc_id, doc)
+        finally:
+            self._invalidate(collection, [doc_id])
+
+    def changed(self, collection, doc_id, doc):
+        try:
+            super(CachingBackendMixin, self).changed(collection, doc_id, doc)
+        finally:
+            self._invalidate(collection, [doc_id])
+
+    def deleted(self, collection, doc_id):
+        try:
+            super(CachingBackendMixin, self).deleted(collection, doc_id)
+        finally:
+            self._invalidate(collection, [doc_id])
+
+    def added_many(self, collection, docs):
+        try:
+            super(CachingBackendMixin, self).added_many(collection, docs)
+        finally:
+            self._invalidate(collection, [doc_id for doc_id, _ in docs])
+
+    def changed_many(self, collection, docs):
+        try:
+            super(CachingBackendMixin, self).changed_many(collection, docs)
+        finally:
+            self._invalidate(collection, [doc_id for doc_id, _ in docs])
+
+    def deleted_many(self, collection, doc_ids):
+        try:
+            super(CachingBackendMixin, self).deleted_many(collection, doc_ids)
+        finally:
+            self._invalidate(collection, doc_ids)
+
+    def embedded_added(self, collection, doc_id, *args):
+        try:
+            super(CachingBackendMixin, self).embedded_added(
+                collection, doc_id, *args)
+        finally:
+            self._invalidate(collection, [doc_id])
+
+    def embedded_changed(self, collection, doc_id, *args):
+        try:
+            super(CachingBackendMixin, self).embedded_changed(
+                collection, doc_id, *args)
+        finally:
+            self._invalidate(collection, [doc_id])
+
+    def embedded_removed(self, collection, doc_id, *args):
+        try:
+            super(CachingBackendMixin, self).embedded_removed(
+                collection, doc_id, *args)
+        finally:
+            self._invalidate(collection, [doc_id])
+
+    def sync_collection(self, collection):
+        try:
+            return super(CachingBackendMixin, self).sync_collection(collection)
+        finally:
+            self._invalidate(collection)
+
+    def _replaced(self, collection):
+        # Swapped for a rebuilt collection (see
+        # cqrs.mongo.PolymorphicMongoIDBackend.rebuild_collection), which was
+        # written to under another name.
+        super(CachingBackendMixin, self)._replaced(collection)
+        self._invalidate(collection)
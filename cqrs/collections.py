@@ -2,9 +2,19 @@ import weakref
 
 from denormalize.models import DocumentCollection
 
+from . import settings
+from .indexes import Index
+from .keymap import KeyMap, key_maps
+from .memo import batch_memo
 from .register import Register, RegisterableMeta
-from .serializers import CQRSSerializerMeta
+from .serializers import CQRSSerializerMeta, to_plain_document
 from .models import CQRSModel, CQRSPolymorphicModel
+from .typecodes import type_codes
+
+
+#: The document field holding the fingerprint of the serializer which made it
+#: (see :mod:`cqrs.fingerprints`).
+FINGERPRINT_FIELD = '_fp'
 
 
 class DRFDocumentCollectionBaseMeta(type):
@@ -70,6 +80,29 @@ class DRFDocumentCollectionBase(DocumentCollection):
     _required_model_base = None
     _required_not_model_base = None
 
+    #: Secondary indexes wanted on the read model; a sequence of
+    #: :class:`cqrs.indexes.Index` instances. (The backend creates them; see
+    #: :func:`cqrs.startup.ensure_indexes`.)
+    indexes = ()
+
+    #: Short-key storage for the read model (see :mod:`cqrs.keymap`): a
+    #: dictionary of long key to short key, ``True`` to generate one from the
+    #: serializer's fields, or ``None`` to store keys as they are.
+    key_map = None
+
+    #: Embedded arrays which the backend may update element by element rather
+    #: than re-dumping the whole document (see :mod:`cqrs.embedded`): a
+    #: dictionary of ORM filter path to :class:`~cqrs.embedded.EmbeddedArray`.
+    embedded_arrays = {}
+
+    #: ORM filter paths of widely referenced related objects, changes to
+    #: which are fanned out to the affected documents in chunks, resumably
+    #: (see :mod:`cqrs.fanout`), rather than all at once.
+    fanout_paths = ()
+
+    #: How many documents a fan-out loads and writes at a time.
+    fanout_chunk_size = 500
+
     # TODO: How to deal with stale foreign key data being cached in mongo?
 
     # A note on what needs to be overridden: pretty much only dump_obj and
@@ -87,6 +120,85 @@ class DRFDocumentCollectionBase(DocumentCollection):
     def serializer_class(self):
         return CQRSSerializerMeta._register[self.model]
 
+    def dump_document(self, root_obj):
+        """
+        Like ``dump``, but giving the document as a backend would store it
+        (see :meth:`cqrs.serializers.CQRSSerializer.to_document`): a plain
+        dictionary keyed by ``_id``, made in a single pass.
+        """
+        if not isinstance(root_obj, self.model):
+            raise ValueError("root_obj is not an instance of self.model")
+        return self.document_obj(root_obj)
+
+    def dump_document_id(self, root_pk):
+        return self.dump_document(self.model.objects.get(pk=root_pk))
+
+    def dump_many(self, root_objs):
+        """
+        Dump several root objects as a batch, sharing the representations of
+        what they have nested in common (see :mod:`cqrs.memo`).
+        """
+        with batch_memo():
+            return [self.dump(root_obj) for root_obj in root_objs]
+
+    def document_obj(self, obj):
+        if (type(self).dump_obj.__func__
+                is not self._serializer_dump_obj.__func__):
+            # dump_obj has been customised; we'd best go through it.
+            return to_plain_document(self.dump_obj(type(obj), obj, []))
+        serializer = CQRSSerializerMeta._register.instances[type(obj)]
+        return serializer.to_document(obj)
+
+    def get_indexes(self):
+        """
+        Get the complete list of indexes the read model should have: those
+        declared in ``indexes``, plus any that the collection type derives
+        for itself.
+        """
+        return list(self.indexes)
+
+    def get_key_map(self):
+        """
+        Get the :class:`~cqrs.keymap.KeyMap` to store documents with, or
+        ``None`` if keys aren't compressed.
+        """
+        if self.key_map is None:
+            return None
+        if '_key_map' not in self.__dict__:
+            if self.key_map is True:
+                self._key_map = key_maps.key_map(
+                    self.name, self._key_map_field_names())
+            else:
+                self._key_map = KeyMap(self.key_map)
+        return self._key_map
+
+    def _key_map_field_names(self):
+        return CQRSSerializerMeta._register.instances[self.model].fields.keys()
+
+    def get_embedded_arrays(self):
+        """
+        Get the collection's embedded arrays, bound to its serializer, as a
+        dictionary of ORM filter path to :class:`~cqrs.embedded.EmbeddedArray`.
+
+        :raises ImproperlyConfigured: if one doesn't match the serializer
+        """
+        if '_embedded_arrays' not in self.__dict__:
+            serializer = CQRSSerializerMeta._register.instances[self.model]
+            self._embedded_arrays = dict(
+                (filter_path, embedded_array.bind(serializer))
+                for filter_path, embedded_array
+                in self.embedded_arrays.items())
+        return self._embedded_arrays
+
+    def expand_doc(self, doc):
+        """
+        Reverse the key compression of a document read from the backend.
+        """
+        key_map = self.get_key_map()
+        if key_map is None or doc is None:
+            return doc
+        return key_map.expand(doc)
+
 
 class DRFDocumentCollectionMeta(DRFDocumentCollectionBaseMeta,
                                 RegisterableMeta):
@@ -118,6 +230,9 @@ class DRFDocumentCollection(DRFDocumentCollectionBase):
         """Use Django REST framework to serialize our object."""
         return self.serializer_class(obj).data
 
+    # (Unless dump_obj is overridden, document_obj can skip it.)
+    _serializer_dump_obj = dump_obj
+
 
 class DocumentCollectionRegister(Register):
     """
@@ -169,6 +284,97 @@ class DRFPolymorphicDocumentCollection(DRFDocumentCollectionBase):
 
     _required_model_base = CQRSPolymorphicModel
 
+    #: Whether to index the polymorphic ``type`` field automatically. You
+    #: almost certainly want this, as selecting by type is the whole point of
+    #: having it, but if you've got a compound index starting with ``type``
+    #: declared, it's redundant.
+    type_index = True
+
+    #: Whether documents should carry a ``types`` array of the type paths of
+    #: the object's class and all its concrete polymorphic ancestors (it's
+    #: given a multikey index). This makes subtree queries (see
+    #: :meth:`subtree_query`) a single indexed lookup rather than an ``$in``
+    #: that grows with the hierarchy.
+    type_ancestry = False
+
+    #: Whether documents should carry ``_fp``, the fingerprint of the
+    #: serializer which made them (see :mod:`cqrs.fingerprints`), so that a
+    #: change to one type's serializer means only rebuilding its documents.
+    fingerprints = settings.CQRS_FINGERPRINTS
+
+    def get_indexes(self):
+        """
+        The declared indexes, plus one on ``type`` (unless ``type_index`` is
+        false or an index on exactly that has been declared, whatever its name
+        and options) and one on ``types`` if ``type_ancestry`` is on (likewise).
+        """
+        indexes = super(DRFPolymorphicDocumentCollection, self).get_indexes()
+        derived = []
+        if self.type_index:
+            derived.append(Index('type'))
+        if self.type_ancestry:
+            derived.append(Index('types'))
+        # Compared by keys alone; Mongo won't have two indexes on the same
+        # keys anyway.
+        declared = [index.keys for index in indexes]
+        indexes.extend(index for index in derived
+                       if index.keys not in declared)
+        return indexes
+
+    def _key_map_field_names(self):
+        # Every type in the hierarchy has its say.
+        names = set()
+        models = [self.model]
+        while models:
+            model = models.pop()
+            models.extend(model.__subclasses__())
+            if not (model._meta.abstract or model._meta.proxy):
+                names.update(
+                    CQRSSerializerMeta._register.instances[model].fields)
+        return names
+
+    def subtree_query(self, model_class):
+        """
+        Get a read model query matching all documents of ``model_class``,
+        including those of its subclasses.
+
+        With ``type_ancestry`` on, this is a simple lookup on the indexed
+        ``types`` array; otherwise it's an ``$in`` of every concrete class in
+        the subtree.
+        """
+        if not issubclass(model_class, self.model):
+            raise ValueError('{!r} is not in the {!r} hierarchy'.format(
+                model_class.__name__, self.model.__name__))
+
+        if self.type_ancestry:
+            return {'types': self.type_value(model_class)}
+
+        def subtree(model):
+            if not (model._meta.abstract or model._meta.proxy):
+                yield model
+            for submodel in model.__subclasses__():
+                for cls in subtree(submodel):
+                    yield cls
+
+        # Diamond inheritance means some classes turn up more than once.
+        values = []
+        for cls in subtree(model_class):
+            if self.type_value(cls) not in values:
+                values.append(self.type_value(cls))
+        return {'type': {'$in': values}}
+
+    def type_value(self, model_class):
+        """
+        Get what is stored in ``type`` for instances of ``model_class``: its
+        type path, or its type code if the serializer uses them.
+        """
+        return self._encode_type_path(model_class._class_type_path())
+
+    def _encode_type_path(self, type_path):
+        if self.serializer_class.use_type_codes:
+            return type_codes.code_for(type_path)
+        return type_path
+
     def get_related_models(self):
         """
         A replacement get_related_models method, coping with polymorphic models
@@ -217,9 +423,34 @@ class DRFPolymorphicDocumentCollection(DRFDocumentCollectionBase):
 
         collection = self.collection_or_subcollection_for(type(obj))
         if collection is self:
-            return collection.serializer_class(obj).data
+            data = collection.serializer_class(obj).data
+        else:
+            data = collection.dump_obj(model, obj, path)
+
+        self._add_types(collection, data)
+        return data
+
+    def document_obj(self, obj):
+        collection = self.collection_or_subcollection_for(type(obj))
+        if collection is self:
+            doc = super(DRFPolymorphicDocumentCollection,
+                        self).document_obj(obj)
         else:
-            return collection.dump_obj(model, obj, path)
+            doc = collection.document_obj(obj)
+        self._add_types(collection, doc)
+        return doc
+
+    # document_obj takes care of the dispatching itself.
+    _serializer_dump_obj = dump_obj
+
+    def _add_types(self, collection, data):
+        if self.type_ancestry:
+            # Precomputed by the serializer class; see
+            # CQRSPolymorphicModel._type_ancestry.
+            data['types'] = [self._encode_type_path(type_path) for type_path
+                             in collection.serializer_class._type_ancestry]
+        if self.fingerprints:
+            data[FINGERPRINT_FIELD] = collection.serializer_class.fingerprint()
 
 
 class SubCollectionMeta(DRFDocumentCollectionMeta, RegisterableMeta):
@@ -299,6 +530,8 @@ class SubCollection(DRFDocumentCollectionBase):
         """Use Django REST framework to serialize our object."""
         return self.serializer_class(obj).data
 
+    _serializer_dump_obj = dump_obj
+
     def collection_or_subcollection_for(self, model):
         # If non-polymorphic, I don't have a subcollection, do I?
         assert self.serializer_class.Meta.model is model
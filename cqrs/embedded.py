@@ -0,0 +1,85 @@
+'''
+Incremental updates of embedded arrays.
+
+A document embedding a reverse foreign key or many-to-many relation as an
+array of nested documents normally gets re-dumped from top to bottom whenever
+one element of that array changes; for a parent with thousands of children,
+that's a lot of work to change one of them. A collection can instead declare
+that such an array may be maintained element by element::
+
+    class ShelfCollection(DRFDocumentCollection):
+        model = Shelf
+        prefetch_related = ['books', 'labels']
+        embedded_arrays = {
+            # ORM filter path: array description
+            'books': EmbeddedArray('books'),
+            'labels': EmbeddedArray('labels', aggregates=True),
+        }
+
+The backend then turns a child being added, changed or removed into a single
+array operation on each affected document (``$push``, a positional ``$set``
+and ``$pull`` respectively, for Mongo), serializing just that child.
+
+Only relations directly off the root model (reverse foreign keys and
+many-to-many relations in either direction) can be embedded arrays, and the
+array must be a nested serializer field of the collection's serializer, with
+each element carrying its key (``id``, by default).
+
+A full dump still happens whenever the element operation can't be trusted to
+give the same document:
+
+- ``ordered=True``: the array is in a meaningful order, so a new element or a
+  changed one (which might have moved) needs a full dump; removals are still
+  done in place.
+- ``aggregates=True``: the parent document has fields derived from the
+  array's membership (counts and the like), so additions and removals need a
+  full dump; changes to an element are still done in place. (If the parent
+  depends on the elements' *values*, don't declare the array at all.)
+- Inside :func:`denormalize.context.delay_sync` or ``sync_together``, as they
+  already collapse many changes into a single dump per document.
+'''
+
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.serializers import BaseSerializer
+
+
+class EmbeddedArray(object):
+    """
+    An array of nested documents (the serializer field ``field``) which the
+    backend may update element by element, identifying elements by ``key``.
+    """
+
+    def __init__(self, field, key='id', ordered=False, aggregates=False):
+        self.field = field
+        self.key = key
+        self.ordered = ordered
+        self.aggregates = aggregates
+        self.serializer_class = None
+
+    def bind(self, serializer):
+        """
+        Get a copy of this array description for use with a collection's root
+        ``serializer`` (an instance), which the element serializer is taken
+        from.
+
+        :raises ImproperlyConfigured: if the field is missing or isn't a
+                                      nested serializer
+        """
+        field = serializer.fields.get(self.field)
+        if not isinstance(field, BaseSerializer):
+            raise ImproperlyConfigured(
+                '{!r} has no nested serializer field {!r} to use as an '
+                'embedded array'.format(type(serializer).__name__, self.field))
+        bound = EmbeddedArray(self.field, self.key, self.ordered,
+                              self.aggregates)
+        bound.serializer_class = type(field)
+        return bound
+
+    def dump_element(self, obj):
+        """Serialize one element of the array."""
+        return self.serializer_class(obj).data
+
+    def __repr__(self):
+        return '{}({!r}, key={!r}, ordered={!r}, aggregates={!r})'.format(
+            type(self).__name__, self.field, self.key, self.ordered,
+            self.aggregates)
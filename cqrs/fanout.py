@@ -0,0 +1,209 @@
+'''
+Chunked, resumable fan-out of changes to widely referenced objects.
+
+When something that thousands of documents embed changes (the ``Category``
+in every ``Product``), django-denormalize works out every affected document
+and re-dumps them one by one, right there in the request that saved it. A
+collection can instead list the relations for which that should be done as a
+*fan-out*::
+
+    class ProductCollection(DRFPolymorphicDocumentCollection):
+        model = Product
+        select_related = ['category']
+        fanout_paths = ('category',)
+        fanout_chunk_size = 500
+
+A change to a category then becomes a fan-out job: the affected documents'
+ids are paged through in primary key order, ``fanout_chunk_size`` at a time,
+each chunk being loaded with a single (prefetching) query and written with
+the backend's ``changed_many``. After each chunk the job records how far it
+got, so if it's interrupted, :func:`cqrs.startup.resume_fanouts` picks it up
+where it left off rather than starting over.
+
+Jobs run in the saving process unless ``CQRS_FANOUT_EXECUTOR`` names a
+function to hand them to (it gets the job id, and should arrange for
+``fanouts.run(job_id)`` to be called, e.g. from a task queue worker). Jobs
+are kept in a store like the type code table's (:mod:`cqrs.typecodes`):
+memory by default, and a Mongo collection with ``CQRS_FANOUT_STORE =
+'cqrs.mongo.fanout_store'``, which is what a worker in another process needs.
+
+Fan-out paths must be made of forward relations (foreign keys or many to
+many fields) from the root model, as saving the related object then can't
+change *which* documents refer to it.
+'''
+
+import logging
+import threading
+import uuid
+
+from django.utils.module_loading import import_by_path
+
+from denormalize.backend.base import BackendBase
+
+from . import settings
+from .memo import batch_memo
+
+
+log = logging.getLogger(__name__)
+
+
+class FanOut(object):
+    """
+    A fan-out waiting to be started, standing in for a document id in the
+    backend's queue (so that :func:`denormalize.context.delay_sync` delays it
+    and starts it just the once, like any other change).
+    """
+
+    def __init__(self, filter_path, related_pk):
+        self.filter_path = filter_path
+        self.related_pk = related_pk
+
+    def __repr__(self):
+        return '<FanOut {}={!r}>'.format(self.filter_path, self.related_pk)
+
+
+class MemoryFanOutStore(object):
+    """
+    A fan-out job store which lives only in memory: no use for handing jobs
+    to other processes, and they're lost with the process.
+
+    A job is a dictionary (see :meth:`FanOutQueue.submit` for its keys);
+    a store needs :meth:`save`, :meth:`get`, :meth:`delete` and
+    :meth:`unfinished` (giving all the jobs it has).
+    """
+
+    def __init__(self):
+        self._jobs = {}
+
+    def save(self, job):
+        self._jobs[job['_id']] = dict(job)
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def delete(self, job_id):
+        self._jobs.pop(job_id, None)
+
+    def unfinished(self):
+        return [dict(job) for job in self._jobs.values()]
+
+
+def affected_id_chunks(collection, filter_path, related_pk, chunk_size,
+                       after=None):
+    """
+    Generate the ids of the root objects referring to ``related_pk`` through
+    ``filter_path``, in lists of up to ``chunk_size``, in primary key order,
+    starting after the primary key ``after``.
+
+    It's keyset pagination, so each chunk is one cheap indexed query however
+    far through it is, and nothing holds all the ids at once.
+    """
+    queryset = (collection.queryset(prefetch=False)
+                .filter(**{filter_path: related_pk}).order_by('pk'))
+    while True:
+        chunk = queryset if after is None else queryset.filter(pk__gt=after)
+        ids = list(chunk.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return
+        yield ids
+        after = ids[-1]
+
+
+class FanOutQueue(object):
+    """
+    Starts, runs and resumes fan-out jobs.
+    """
+
+    def __init__(self, store=None, executor=None):
+        self._lock = threading.Lock()
+        self._store = store
+        self.executor = executor
+
+    def set_store(self, store):
+        """Switch to a different store (``None`` for the configured one)."""
+        with self._lock:
+            self._store = store
+
+    @property
+    def store(self):
+        with self._lock:
+            if self._store is None:
+                if settings.CQRS_FANOUT_STORE:
+                    self._store = import_by_path(settings.CQRS_FANOUT_STORE)()
+                else:
+                    self._store = MemoryFanOutStore()
+            return self._store
+
+    def get_executor(self):
+        if self.executor is None and settings.CQRS_FANOUT_EXECUTOR:
+            self.executor = import_by_path(settings.CQRS_FANOUT_EXECUTOR)
+        return self.executor
+
+    def submit(self, backend_name, collection, fanout):
+        """
+        Record a job for a fan-out and start it (or hand it to the executor).
+        Returns the job id.
+        """
+        job = {
+            '_id': uuid.uuid4().hex,
+            'backend': backend_name,
+            'collection': collection.name,
+            'filter_path': fanout.filter_path,
+            'related_pk': fanout.related_pk,
+            'chunk_size': collection.fanout_chunk_size,
+            'last_pk': None,
+            'documents': 0,
+        }
+        self.store.save(job)
+        log.debug('fanout %s: %s %s=%r', job['_id'], collection.name,
+                  fanout.filter_path, fanout.related_pk)
+
+        executor = self.get_executor()
+        if executor is None:
+            self.run(job['_id'])
+        else:
+            executor(job['_id'])
+        return job['_id']
+
+    def run(self, job_id):
+        """
+        Run (or carry on with) a job, returning the number of documents it
+        has written. A job which no longer exists (e.g. one that another
+        worker has finished) is ignored.
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            return 0
+        backend = BackendBase._registry[job['backend']]
+        collection = backend.collections[job['collection']]
+
+        for ids in affected_id_chunks(collection, job['filter_path'],
+                                      job['related_pk'], job['chunk_size'],
+                                      after=job['last_pk']):
+            doc_ids = collection.map_affected(set(ids))
+            # The documents all refer to the same thing, at the very least.
+            with batch_memo():
+                docs = [(obj.pk, backend.document_for(collection, obj))
+                        for obj in
+                        collection.queryset().filter(pk__in=doc_ids)]
+            backend.changed_many(collection, docs)
+            job['last_pk'] = ids[-1]
+            job['documents'] += len(docs)
+            self.store.save(job)
+
+        self.store.delete(job_id)
+        log.debug('fanout %s: done, %d documents', job_id, job['documents'])
+        return job['documents']
+
+    def resume(self):
+        """
+        Carry on with every job in the store (for after a crash or restart),
+        returning a dictionary of job id to the number of documents written.
+        """
+        return dict((job['_id'], self.run(job['_id']))
+                    for job in self.store.unfinished())
+
+
+#: The fan-out queue used by the backends.
+fanouts = FanOutQueue()
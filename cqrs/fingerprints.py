@@ -0,0 +1,87 @@
+'''
+Rebuilding only the documents a serializer change affects.
+
+Changing one subtype's serializer changes the documents of that type (and of
+its subtypes, whose serializers inherit its fields), but a full rebuild
+rewrites every document in the collection. Each CQRS serializer has a
+fingerprint of its resolved field layout
+(:meth:`~cqrs.serializers.CQRSSerializer.fingerprint`), and a polymorphic
+collection with ``fingerprints`` on (or ``CQRS_FINGERPRINTS``) stores the
+fingerprint of the serializer which made each document in its ``_fp``. After
+a deploy::
+
+    rebuild_stale(backend, ProductCollection())
+
+finds the concrete types some of whose documents have a different
+fingerprint from their serializer's now (or none at all), selecting them by
+``type``, and re-projects the objects of just those types (see
+:func:`cqrs.bulk.reconcile`). There's a management command,
+``cqrs_rebuild_stale``, too.
+
+A fingerprint covers which fields there are and how they're set up, not the
+code behind them: a change to a model method a field calls, or to a
+``transform_`` method, isn't noticed.
+'''
+
+from __future__ import absolute_import
+
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+
+from . import settings
+from .bulk import chunks, reconcile
+from .collections import FINGERPRINT_FIELD
+from .serializers import CQRSSerializerMeta
+
+
+log = logging.getLogger(__name__)
+
+
+def concrete_models(model):
+    """Get ``model`` and its subclasses, less the abstract and proxy ones."""
+    models = []
+    pending = [model]
+    while pending:
+        model = pending.pop(0)
+        if (not (model._meta.abstract or model._meta.proxy)
+                and model not in models):
+            models.append(model)
+        pending.extend(model.__subclasses__())
+    return models
+
+
+def stale_models(backend, collection):
+    """
+    Get the concrete models whose documents in ``collection`` weren't all
+    made by their serializer as it is now.
+    """
+    stale = []
+    for model in concrete_models(collection.model):
+        current = CQRSSerializerMeta._register[model].fingerprint()
+        stored = backend.distinct_values(
+            collection, FINGERPRINT_FIELD,
+            {'type': collection.type_value(model)})
+        if stored - set([current]):
+            stale.append(model)
+    return stale
+
+
+def rebuild_stale(backend, collection, dry_run=False):
+    """
+    Re-project the objects of the models :func:`stale_models` finds (unless
+    ``dry_run``), returning a dictionary of model to the number of objects.
+    """
+    rebuilt = {}
+    for model in stale_models(backend, collection):
+        # Just this model's objects; its subclasses have their own say.
+        pks = list(model._base_manager.filter(
+            polymorphic_ctype=ContentType.objects.get_for_model(model))
+            .values_list('pk', flat=True))
+        if not dry_run:
+            for chunk in chunks(pks, settings.CQRS_BULK_CHUNK_SIZE):
+                reconcile(backend, collection, chunk)
+        rebuilt[model] = len(pks)
+        log.info('rebuild_stale %s: %d %s documents%s', collection.name,
+                 len(pks), model.__name__, ' (dry run)' if dry_run else '')
+    return rebuilt
@@ -0,0 +1,109 @@
+'''
+Declarative indexes for read model collections.
+
+A collection lists the indexes it wants in its ``indexes`` attribute, right
+alongside its model::
+
+    class ProductCollection(DRFPolymorphicDocumentCollection):
+        model = Product
+        indexes = (
+            Index('price'),
+            Index('manufacturer_id', '-price'),
+            Index('discontinued', partial={'discontinued': True}),
+            Index('created', expire_after=60 * 60 * 24 * 30),
+        )
+
+It is then the backend's business (see
+:meth:`cqrs.mongo.MongoIDBackend.ensure_indexes`) to compare what is declared
+with what exists, creating whatever is missing. Run it from
+:func:`cqrs.startup.ensure_indexes` or the ``cqrs_ensure_indexes`` management
+command.
+'''
+
+from pymongo import ASCENDING, DESCENDING
+
+
+class Index(object):
+    """
+    A single (possibly compound) index on a read model collection.
+
+    Keys are field names, ascending unless prefixed with ``-``; if you need
+    something more exotic (e.g. ``'2dsphere'``), give a ``(field, kind)``
+    tuple instead.
+
+    Options are passed through to the backend (``unique``, ``sparse``, &c.),
+    with a couple of friendlier spellings:
+
+    - ``partial``: the filter expression for a partial index
+      (``partialFilterExpression``);
+    - ``expire_after``: the number of seconds after which a TTL index
+      removes documents (``expireAfterSeconds``).
+    """
+
+    def __init__(self, *keys, **options):
+        if not keys:
+            raise ValueError('An index needs at least one key')
+        self.keys = [self._parse_key(key) for key in keys]
+
+        if 'partial' in options:
+            options['partialFilterExpression'] = options.pop('partial')
+        if 'expire_after' in options:
+            if len(self.keys) != 1:
+                raise ValueError('TTL indexes must have exactly one key')
+            options['expireAfterSeconds'] = options.pop('expire_after')
+
+        self.name = options.pop('name', None) or '_'.join(
+            '{}_{}'.format(field, direction)
+            for field, direction in self.keys)
+        self.options = options
+
+    @staticmethod
+    def _parse_key(key):
+        if isinstance(key, tuple):
+            return key
+        if key.startswith('-'):
+            return key[1:], DESCENDING
+        return key, ASCENDING
+
+    @property
+    def fields(self):
+        """The names of the indexed fields, in order."""
+        return [field for field, _ in self.keys]
+
+    def spec(self):
+        """
+        Get the ``(keys, options)`` pair to hand to the backend; the options
+        include the index name.
+        """
+        options = dict(self.options, name=self.name)
+        return list(self.keys), options
+
+    def matches(self, keys):
+        """
+        Whether a list of ``(field, direction)`` pairs, as reported by the
+        backend for an existing index, is the same as ours.
+
+        (Mongo has a habit of reporting directions as floats, hence not
+        simply comparing the lists.)
+        """
+        def normalize(direction):
+            if isinstance(direction, float):
+                return int(direction)
+            return direction
+
+        return [(field, normalize(direction)) for field, direction in keys] \
+            == self.keys
+
+    def __eq__(self, other):
+        return (isinstance(other, Index) and self.keys == other.keys
+                and self.name == other.name and self.options == other.options)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Index({})'.format(', '.join(
+            repr(field) if direction == ASCENDING else
+            repr('-' + field) if direction == DESCENDING else
+            repr((field, direction))
+            for field, direction in self.keys))
@@ -0,0 +1,261 @@
+'''
+Bulk ingestion of typed command payloads.
+
+Deserializing a list of polymorphic payloads one at a time costs a serializer
+dispatch, a query per foreign key and a save (and a projection) per payload.
+:func:`bulk_ingest` does the lot together::
+
+    products = bulk_ingest(request.DATA, model=Product)
+
+It
+
+1. resolves each payload's ``type`` (as
+   :meth:`~cqrs.serializers.CQRSPolymorphicSerializer.from_native` does) and
+   groups the payloads by model class;
+2. loads everything the payloads' foreign keys and many to many fields refer
+   to with one ``in_bulk`` per related model, and any existing objects (the
+   payloads carrying an ``id``) with one ``in_bulk`` per group;
+3. validates each group with a single serializer instance;
+4. saves it all in one transaction: with ``bulk_create`` where it can (see
+   below), and otherwise object by object;
+5. projects the lot once the transaction is done, with bulk backend writes
+   (see :func:`cqrs.bulk.batched_projection`).
+
+If any payload is invalid, nothing is saved and :exc:`IngestError` is raised,
+with the errors for each payload.
+
+``bulk_create`` can only be used for new objects which come with their ids
+(Django doesn't give back generated ones, and without them there's no
+projecting them), of models with no concrete parents (multi-table
+inheritance needs inserting into every table), and with no many to many or
+reverse relations to save. Everything else is saved the ordinary way,
+though still inside the one transaction and projection batch.
+'''
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import transaction
+from django.utils.encoding import smart_text
+from rest_framework.relations import PrimaryKeyRelatedField
+
+from .bulk import batched_projection
+from .models import CQRSPolymorphicModel
+from .serializers import CQRSSerializerMeta
+
+
+class IngestError(Exception):
+    """
+    Some payloads were invalid (and so nothing was saved). ``errors`` has
+    an item for each payload: a dictionary of its errors, empty if it was
+    fine.
+    """
+
+    def __init__(self, errors):
+        super(IngestError, self).__init__(
+            '{} of {} payloads invalid'.format(
+                sum(1 for error in errors if error), len(errors)))
+        self.errors = errors
+
+
+def _resolve_model(model, payload, errors):
+    """Get the model class for a payload, or record why there isn't one."""
+    if not issubclass(model, CQRSPolymorphicModel):
+        return model
+    if 'type' not in payload:
+        errors['type'] = ['No polymorphic type provided.']
+        return None
+    serializer = CQRSSerializerMeta._register.instances[model]
+    try:
+        model_class = serializer._model_class_for_type(payload['type'])
+    except (ImproperlyConfigured, TypeError, KeyError, ImportError):
+        model_class = None
+    if (not isinstance(model_class, type)
+            or not issubclass(model_class, model)
+            or model_class._meta.abstract or model_class._meta.proxy):
+        errors['type'] = ['Invalid type {!r}.'.format(payload['type'])]
+        return None
+    return model_class
+
+
+def _pk_values(model, values):
+    """Convert payload values to primary keys, skipping the bad ones."""
+    pk_field = model._meta.pk
+    for value in values:
+        try:
+            yield pk_field.to_python(value)
+        except (ValidationError, TypeError, ValueError):
+            # Left for the field to complain about.
+            pass
+
+
+def _related_fields(serializer):
+    return [(field_name, field)
+            for field_name, field in serializer.fields.items()
+            if isinstance(field, PrimaryKeyRelatedField)
+            and not field.read_only and field.queryset is not None]
+
+
+def _prefetched_from_native(field, objects):
+    """
+    Make a replacement for a related field's ``from_native`` which looks
+    things up in ``objects`` (loaded with ``in_bulk``) rather than querying.
+    """
+    pk_field = field.queryset.model._meta.pk
+
+    def from_native(data):
+        try:
+            return objects[pk_field.to_python(data)]
+        except KeyError:
+            msg = field.error_messages['does_not_exist'] % smart_text(data)
+            raise ValidationError(msg)
+        except (ValidationError, TypeError, ValueError):
+            received = type(data).__name__
+            msg = field.error_messages['incorrect_type'] % received
+            raise ValidationError(msg)
+    return from_native
+
+
+def _prefetch_related(serializers, payloads, groups):
+    """
+    Load everything the groups' related fields refer to, with one query per
+    related queryset, and point the fields at it.
+    """
+    wanted = OrderedDict()  # (model, sql): (queryset, pks, fields)
+    for model_class, indexes in groups.items():
+        for field_name, field in _related_fields(serializers[model_class]):
+            values = []
+            for i in indexes:
+                value = payloads[i].get(field_name)
+                if value is None:
+                    continue
+                if field.many and isinstance(value, (list, tuple)):
+                    values.extend(value)
+                else:
+                    values.append(value)
+            queryset = field.queryset.all()
+            key = queryset.model, str(queryset.query)
+            entry = wanted.setdefault(key, (queryset, set(), []))
+            entry[1].update(_pk_values(queryset.model, values))
+            entry[2].append(field)
+
+    for queryset, pks, fields in wanted.values():
+        objects = queryset.in_bulk(list(pks))
+        for field in fields:
+            field.from_native = _prefetched_from_native(field, objects)
+
+    # Model validation would check each foreign key exists all over again,
+    # with a query apiece; we've just made sure of that.
+    for serializer in serializers.values():
+        _skip_validation_of(serializer, [field.source or field_name
+                                         for field_name, field
+                                         in _related_fields(serializer)])
+
+
+def _skip_validation_of(serializer, names):
+    get_validation_exclusions = serializer.get_validation_exclusions
+
+    def exclusions(instance=None):
+        return list(get_validation_exclusions(instance)) + names
+    serializer.get_validation_exclusions = exclusions
+
+
+def _can_bulk_create(model_class, objs, existing):
+    if model_class._meta.parents:
+        return False
+    for obj in objs:
+        if obj.pk is None or obj.pk in existing:
+            return False
+        if (getattr(obj, '_m2m_data', None)
+                or getattr(obj, '_related_data', None)
+                or getattr(obj, '_nested_forward_relations', None)):
+            return False
+    return True
+
+
+def _save_group(serializer, model_class, objs, existing, using):
+    if _can_bulk_create(model_class, objs, existing):
+        # (CQRS managers' bulk_create does what save() would have done to
+        # the objects, and sees to the projection.)
+        model_class._default_manager.db_manager(using).bulk_create(objs)
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = using
+    else:
+        for obj in objs:
+            if obj.pk is not None and obj.pk not in existing:
+                serializer.save_object(obj, force_insert=True, using=using)
+            else:
+                serializer.save_object(obj, using=using)
+
+
+def bulk_ingest(payloads, model=CQRSPolymorphicModel, using='default'):
+    """
+    Validate and save a list of payloads (see :mod:`cqrs.ingest`), giving
+    the saved objects in the same order.
+
+    :param model: the model the payloads are all instances of (a polymorphic
+                  base, whose subclasses the payloads' ``type`` picks from,
+                  or a non-polymorphic model, in which case there's no
+                  ``type``)
+    :raises IngestError: if any of the payloads are invalid
+    """
+    payloads = list(payloads)
+    errors = [{} for _ in payloads]
+
+    groups = OrderedDict()
+    for i, payload in enumerate(payloads):
+        model_class = _resolve_model(model, payload, errors[i])
+        if model_class is not None:
+            groups.setdefault(model_class, []).append(i)
+
+    # One of each, not shared, as we're going to change their fields.
+    serializers = dict((model_class,
+                        CQRSSerializerMeta._register[model_class]())
+                       for model_class in groups)
+    _prefetch_related(serializers, payloads, groups)
+
+    objects = [None] * len(payloads)
+    existing = {}
+    for model_class, indexes in groups.items():
+        ids = list(_pk_values(model_class, [payloads[i]['id'] for i in indexes
+                                            if payloads[i].get('id')]))
+        existing[model_class] = (model_class._default_manager.using(using)
+                                 .in_bulk(ids))
+        serializer = serializers[model_class]
+        pk_field = model_class._meta.pk
+        for i in indexes:
+            try:
+                pk = pk_field.to_python(payloads[i].get('id'))
+            except ValidationError:
+                pk = None
+            instance = existing[model_class].get(pk)
+            if instance is not None and type(instance) is not model_class:
+                errors[i]['type'] = ['{} {} is a {}.'.format(
+                    model_class.__name__, pk, type(instance).__name__)]
+                continue
+            serializer.object = instance
+            kwargs = {}
+            if issubclass(model_class, CQRSPolymorphicModel):
+                kwargs['polymorphism_resolved'] = True
+            obj = serializer.from_native(payloads[i], None, **kwargs)
+            if serializer._errors:
+                errors[i] = dict(serializer._errors)
+            else:
+                if instance is None and pk is not None:
+                    # The id field is read only, but a new object may come
+                    # with its id all the same.
+                    obj.pk = pk
+                objects[i] = obj
+
+    if any(errors):
+        raise IngestError(errors)
+
+    with batched_projection(), transaction.atomic(using=using):
+        for model_class, indexes in groups.items():
+            _save_group(serializers[model_class], model_class,
+                        [objects[i] for i in indexes],
+                        existing[model_class], using)
+    return objects
@@ -0,0 +1,485 @@
+'''
+A durable change journal, so that the read model can't silently drift.
+
+Between Django saving something and the backend writing the document lies a
+window in which the process can die (or the backend be unreachable), and
+then the change is simply never projected. A backend with
+:class:`JournalBackendMixin` closes that window: each change is appended to a
+local, append-only journal before the backend is written to, and marked as
+acknowledged once the write is done::
+
+    class Backend(JournalBackendMixin, PolymorphicMongoIDBackend):
+        journal_path = '/var/lib/myproject/mongo.journal'
+
+Whatever is left unacknowledged (by a crash, or by a write failing with one
+of the backend's ``spill_exceptions``, which are then logged rather than
+raised) is replayed by :func:`cqrs.startup.replay_journals`. Replaying a
+change re-dumps the document from the database, whatever the change was (a
+delete included: the row may be back, or the delete rolled back), so it's
+safe however stale the entry is, and however many times it's replayed.
+
+Writes which fail or overrun (see below) are also retried in the background,
+by a writer thread of the backend's own, every ``drain_interval`` seconds
+until a replay goes through, so that the read model doesn't have to wait for
+a restart to catch up.
+
+A backend which is merely slow would still hold requests up, so a
+``write_timeout`` (in seconds) can be given too. The backend's writes are
+then made by a writer thread of its own, one at a time, in order, and a
+request waits no longer than that for each of them; a write which overruns
+is left to finish in the background, and its change to the journal, as if
+it had failed. (So it's replayed at the next start up, even if the write
+did go on to succeed, which does no harm.) Documents are still dumped in the
+request's own thread, so they see its transaction.
+
+Every entry is flushed to the operating system straight away, which is enough
+to survive the process dying; surviving the *machine* dying needs an fsync,
+and those are batched (every ``sync_every`` entries or ``sync_interval``
+seconds, whichever comes first) as they're expensive.
+
+The journal is a file of JSON lines, entries looking like ``{"seq": 42,
+"action": "CHANGE", "collection": "shop_product", "doc_id": 7}`` and
+acknowledgements like ``{"ack": 42}``. It's compacted (rewritten to hold just
+the unacknowledged entries, and atomically renamed into place) every
+``compact_after`` acknowledgements and after replaying.
+'''
+
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+
+from .backend import PolymorphicBackendBase
+from .fanout import FanOut
+from .memo import batch_memo
+from .replay import ADD, CHANGE, DELETE
+
+
+log = logging.getLogger(__name__)
+
+
+class Journal(object):
+    """
+    An append-only journal of change entries, kept in the file ``path``.
+    """
+
+    def __init__(self, path, sync_every=100, sync_interval=1.0,
+                 compact_after=10000):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._seq = 0
+        self._acks = 0
+        self._load()
+        self._file = open(self.path, 'a')
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        good_length = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    if not line.endswith('\n'):
+                        raise ValueError('Incomplete entry')
+                    record = json.loads(line)
+                except ValueError:
+                    # Half written when the process died; it can't have been
+                    # acted on, as the write comes after it.
+                    log.warning('journal %s: dropping damaged entry %r',
+                                self.path, line)
+                    break
+                good_length += len(line)
+                if 'ack' in record:
+                    self._pending.pop(record['ack'], None)
+                    self._acks += 1
+                else:
+                    self._pending[record['seq']] = record
+                    self._seq = max(self._seq, record['seq'])
+        if good_length != os.path.getsize(self.path):
+            # Chop it off, so that the next entry starts on a line of its own.
+            with open(self.path, 'r+') as f:
+                f.truncate(good_length)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_every
+                or time.time() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """fsync the journal, making everything so far durable."""
+        with self._lock:
+            if self._unsynced:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+            self._last_sync = time.time()
+
+    def append(self, action, collection_name, doc_id):
+        """Record a change, returning its sequence number."""
+        with self._lock:
+            self._seq += 1
+            record = {'seq': self._seq, 'action': action,
+                      'collection': collection_name, 'doc_id': doc_id}
+            self._write(record)
+            self._pending[self._seq] = record
+            return self._seq
+
+    def acknowledge(self, seq):
+        """Mark a change as done."""
+        with self._lock:
+            if self._pending.pop(seq, None) is None:
+                return
+            self._write({'ack': seq})
+            self._acks += 1
+            if self._acks >= self.compact_after:
+                self.compact()
+
+    def unacknowledged(self):
+        """Get the entries not yet acknowledged, in order."""
+        with self._lock:
+            return [self._pending[seq] for seq in sorted(self._pending)]
+
+    def compact(self):
+        """
+        Rewrite the journal to hold only the unacknowledged entries. The new
+        file is written and synced beside the old one and renamed over it, so
+        a crash part way through leaves one or the other intact.
+        """
+        with self._lock:
+            temp_path = self.path + '.compacting'
+            with open(temp_path, 'w') as f:
+                for record in self.unacknowledged():
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.rename(temp_path, self.path)
+            self._file = open(self.path, 'a')
+            self._unsynced = 0
+            self._acks = 0
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._file.close()
+
+
+class WriteTimeout(Exception):
+    """A backend write took longer than the journal's ``write_timeout``."""
+
+
+class _Write(object):
+    """A backend write for the writer thread to make."""
+
+    def __init__(self, write, args):
+        self.write = write
+        self.args = args
+        self.exc_info = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._abandoned = False
+
+    def run(self):
+        try:
+            self.write(*self.args)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        with self._lock:
+            self._done.set()
+            if self._abandoned and self.exc_info is not None:
+                # Nobody's waiting to hear about it any more.
+                log.error('journal: a write which overran failed; left for '
+                          'replaying', exc_info=self.exc_info)
+
+    def wait(self, timeout):
+        """
+        Wait for the write to be made, giving up after ``timeout`` seconds.
+
+        :raises WriteTimeout: if it wasn't made in time
+        """
+        self._done.wait(timeout)
+        with self._lock:
+            if not self._done.is_set():
+                self._abandoned = True
+                raise WriteTimeout('Write took over {}s'.format(timeout))
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+class JournalBackendMixin(object):
+    """
+    A backend mixin journalling every change before it's written (see
+    :mod:`cqrs.journal`). Give it a ``journal_path``, as a class attribute or
+    keyword argument.
+
+    Backend write errors of the types in the backend's ``spill_exceptions``
+    (e.g. :exc:`pymongo.errors.PyMongoError` for the Mongo backends) are
+    logged and left in the journal for replaying, rather than failing the
+    request; anything else is raised as normal (still leaving the entry for
+    replaying).
+
+    With a ``write_timeout`` (a class attribute or keyword argument), writes
+    taking longer than that many seconds are left to finish in the
+    background, their changes being left in the journal in the same way.
+    Either way, the journal is replayed in the background every
+    ``drain_interval`` seconds (likewise) until it goes through.
+    """
+
+    journal_path = None
+
+    #: How many seconds a request waits for a backend write, or ``None`` to
+    #: wait for as long as it takes.
+    write_timeout = None
+
+    #: How many seconds apart the journal is replayed in the background once
+    #: a write has failed or overrun, or ``None`` to leave it for
+    #: :func:`cqrs.startup.replay_journals`.
+    drain_interval = 5.0
+
+    def __init__(self, *args, **kwargs):
+        journal_path = kwargs.pop('journal_path', None) or self.journal_path
+        if journal_path is None:
+            raise ImproperlyConfigured(
+                '{} needs a journal_path'.format(type(self).__name__))
+        write_timeout = kwargs.pop('write_timeout', None)
+        if write_timeout is not None:
+            self.write_timeout = write_timeout
+        drain_interval = kwargs.pop('drain_interval', None)
+        if drain_interval is not None:
+            self.drain_interval = drain_interval
+        self.journal = Journal(journal_path)
+        self._writes = Queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._spilled = threading.Event()
+        super(JournalBackendMixin, self).__init__(*args, **kwargs)
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name='journal writer')
+                self._writer.daemon = True
+                self._writer.start()
+
+    def _write_loop(self):
+        next_drain = 0
+        while True:
+            # Idle until there's something to write, or to drain.
+            timeout = self.drain_interval if self._spilled.is_set() else None
+            try:
+                write = self._writes.get(True, timeout)
+            except Queue.Empty:
+                pass
+            else:
+                try:
+                    if write is not None:
+                        write.run()
+                finally:
+                    self._writes.task_done()
+            if (self.drain_interval is not None and self._spilled.is_set()
+                    and time.time() >= next_drain):
+                next_drain = time.time() + self.drain_interval
+                self._drain()
+
+    def _spill(self):
+        """Note that a change was left in the journal, to be drained."""
+        self._spilled.set()
+        if self.drain_interval is not None:
+            self._start_writer()
+            # Wake it, if it's idle.
+            self._writes.put(None)
+
+    def _drain(self):
+        # Anything spilled from here on needs another go.
+        self._spilled.clear()
+        try:
+            replayed = self.replay_journal()
+        except Exception:
+            self._spilled.set()
+            log.exception('journal: replaying failed; trying again in %ss',
+                          self.drain_interval)
+        else:
+            log.info('journal: replayed %d documents', replayed)
+
+    def _within_budget(self, write, *args):
+        """
+        Make a backend write, waiting no longer than ``write_timeout`` for it.
+
+        :raises WriteTimeout: if it's still going (it's left to finish)
+        """
+        if (self.write_timeout is None
+                or threading.current_thread() is self._writer):
+            return write(*args)
+        self._start_writer()
+        pending = _Write(write, args)
+        self._writes.put(pending)
+        pending.wait(self.write_timeout)
+
+    def wait_for_writes(self):
+        """Wait until the writes which overran have all been made."""
+        self._writes.join()
+
+    def _journalled(self, action, collection, doc_id, write, *args):
+        self._journalled_many(action, collection, [doc_id], write, *args)
+
+    def _journalled_many(self, action, collection, doc_ids, write, *args):
+        seqs = [self.journal.append(action, collection.name, doc_id)
+                for doc_id in doc_ids]
+        try:
+            write(*args)
+        except WriteTimeout:
+            log.warning('journal: %s %s %r overran; left for replaying',
+                        action, collection.name,
+                        doc_ids[0] if len(doc_ids) == 1 else doc_ids)
+            self._spill()
+            return
+        except getattr(self, 'spill_exceptions', ()):
+            log.exception('journal: %s %s %r failed; left for replaying',
+                          action, collection.name,
+                          doc_ids[0] if len(doc_ids) == 1 else doc_ids)
+            self._spill()
+            return
+        for seq in seqs:
+            self.journal.acknowledge(seq)
+
+    def _call_added(self, collection, doc_id):
+        self._journalled(ADD, collection, doc_id,
+                         super(JournalBackendMixin, self)._call_added,
+                         collection, doc_id)
+
+    def _call_changed(self, collection, doc_id):
+        if isinstance(doc_id, FanOut):
+            # Fan-outs look after themselves.
+            return super(JournalBackendMixin, self)._call_changed(
+                collection, doc_id)
+        self._journalled(CHANGE, collection, doc_id,
+                         super(JournalBackendMixin, self)._call_changed,
+                         collection, doc_id)
+
+    def _call_deleted(self, collection, doc_id):
+        self._journalled(DELETE, collection, doc_id,
+                         super(JournalBackendMixin, self)._call_deleted,
+                         collection, doc_id)
+
+    def _call_added_many(self, collection, doc_ids, docs=None):
+        self._journalled_many(
+            ADD, collection, doc_ids,
+            super(JournalBackendMixin, self)._call_added_many,
+            collection, doc_ids, docs)
+
+    def _call_changed_many(self, collection, doc_ids):
+        self._journalled_many(
+            CHANGE, collection, doc_ids,
+            super(JournalBackendMixin, self)._call_changed_many,
+            collection, doc_ids)
+
+    def _call_deleted_many(self, collection, doc_ids):
+        self._journalled_many(
+            DELETE, collection, doc_ids,
+            super(JournalBackendMixin, self)._call_deleted_many,
+            collection, doc_ids)
+
+    # The backend writes themselves, made within write_timeout.
+
+    def added(self, collection, doc_id, doc):
+        self._within_budget(super(JournalBackendMixin, self).added,
+                            collection, doc_id, doc)
+
+    def changed(self, collection, doc_id, doc):
+        self._within_budget(super(JournalBackendMixin, self).changed,
+                            collection, doc_id, doc)
+
+    def deleted(self, collection, doc_id):
+        self._within_budget(super(JournalBackendMixin, self).deleted,
+                            collection, doc_id)
+
+    def added_many(self, collection, docs):
+        self._within_budget(super(JournalBackendMixin, self).added_many,
+                            collection, docs)
+
+    def changed_many(self, collection, docs):
+        self._within_budget(super(JournalBackendMixin, self).changed_many,
+                            collection, docs)
+
+    def deleted_many(self, collection, doc_ids):
+        self._within_budget(super(JournalBackendMixin, self).deleted_many,
+                            collection, doc_ids)
+
+    # Embedded array updates are journalled as changes: replaying one
+    # re-dumps the whole document, which is always right.
+
+    def _embedded(self, name, collection, doc_id, *args):
+        write = getattr(super(JournalBackendMixin, self), name)
+        if write.__func__ is getattr(PolymorphicBackendBase, name).__func__:
+            # It re-dumps the document, which has to be done here; the write
+            # itself is made within the time limit anyway.
+            self._journalled(CHANGE, collection, doc_id, write,
+                             collection, doc_id, *args)
+        else:
+            self._journalled(CHANGE, collection, doc_id, self._within_budget,
+                             write, collection, doc_id, *args)
+
+    def embedded_added(self, collection, doc_id, *args):
+        self._embedded('embedded_added', collection, doc_id, *args)
+
+    def embedded_changed(self, collection, doc_id, *args):
+        self._embedded('embedded_changed', collection, doc_id, *args)
+
+    def embedded_removed(self, collection, doc_id, *args):
+        self._embedded('embedded_removed', collection, doc_id, *args)
+
+    def replay_journal(self):
+        """
+        Apply every unacknowledged change in the journal (only whether each
+        document is there matters, as they're all re-dumped from the
+        database), then compact it. Returns the number of documents written.
+        """
+        latest = {}
+        for record in self.journal.unacknowledged():
+            key = record['collection'], record['doc_id']
+            latest.setdefault(key, []).append(record)
+
+        replayed = 0
+        with batch_memo():
+            for (collection_name, doc_id), records in sorted(latest.items()):
+                collection = self.collections.get(collection_name)
+                if collection is None:
+                    log.warning('journal: no collection %s any more; '
+                                'dropping %d entries', collection_name,
+                                len(records))
+                else:
+                    self._replay(collection, doc_id)
+                    replayed += 1
+                for record in records:
+                    self.journal.acknowledge(record['seq'])
+
+        self.journal.compact()
+        return replayed
+
+    def _replay(self, collection, doc_id):
+        # Use the backend's own methods, not the _call_* ones, which would
+        # journal it all over again (and with no time limit, as it's better
+        # to wait than to fail to start up).
+        backend = super(JournalBackendMixin, self)
+        try:
+            doc = self.document_for_id(collection, doc_id)
+        except ObjectDoesNotExist:
+            # Deleted (or never committed).
+            backend.deleted(collection, doc_id)
+        else:
+            # added replaces the whole document, which is what we want.
+            backend.added(collection, doc_id, doc)
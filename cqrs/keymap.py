@@ -0,0 +1,215 @@
+'''
+Short-key storage for projected documents.
+
+Mongo stores every field name in every document, so a serializer with long,
+descriptive field names pays for them over and over, in disk and (more
+importantly) in working set. A collection can opt in to having its keys
+compressed on the way into the backend::
+
+    class ProductCollection(DRFPolymorphicDocumentCollection):
+        model = Product
+        key_map = {'manufacturer_description': 'md', 'recommended_price': 'rp'}
+
+or ``key_map = True`` to have one generated from the serializer's field list
+(for a polymorphic collection, the fields of every type in the hierarchy).
+
+A generated map is kept in a store like the type table
+(:mod:`cqrs.typecodes`), so that every process and every deploy agrees on it:
+memory by default, which is only good for tests (a Mongo backend won't take a
+collection with a generated map then), and a Mongo collection with
+``CQRS_KEY_MAP_STORE = 'cqrs.mongo.key_map_store'``. It's append-only. A field
+keeps its short key for good (even once it's gone from the serializer, so
+that older documents can still be read), and a new field gets a short key
+which has never been used. (:func:`compression_report` shows the map in use,
+should you want to pin it by declaring it.)
+
+Backends apply the map when writing; use the collection's ``expand_doc`` to
+reverse it when reading documents back (the backends' own ``get_doc`` does
+this for you).
+
+The document id and the polymorphic type fields are never compressed, as
+things outside the document body depend on their names.
+'''
+
+import string
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_by_path
+
+from . import settings
+
+
+RESERVED_KEYS = frozenset(['_id', 'id', 'type', 'types'])
+
+
+def _short_keys():
+    """Generate 'a' ... 'z', then 'aa', 'ab', ... 'zz', and so on."""
+    letters = string.ascii_lowercase
+    length = 1
+    while True:
+        for i in xrange(len(letters) ** length):
+            key = ''
+            for _ in xrange(length):
+                i, digit = divmod(i, len(letters))
+                key = letters[digit] + key
+            yield key
+        length += 1
+
+
+def next_short_key(used):
+    """Get the first short key which isn't reserved or in ``used``."""
+    used = set(used)
+    return next(key for key in _short_keys()
+                if key not in RESERVED_KEYS and key not in used)
+
+
+class KeyMap(object):
+    """
+    A mapping of long document keys to short ones, with a tally of how much
+    it has saved.
+    """
+
+    def __init__(self, mapping):
+        shorts = mapping.values()
+        if len(set(shorts)) != len(shorts):
+            raise ValueError('Short keys are not unique: {!r}'.format(mapping))
+        if RESERVED_KEYS & (set(mapping) | set(shorts)):
+            raise ValueError('Key map {!r} uses reserved keys'.format(mapping))
+
+        self.compress_map = dict(mapping)
+        self.expand_map = dict((short, long_)
+                               for long_, short in mapping.items())
+        self.documents = 0
+        self.bytes_saved = 0
+
+    def compress(self, doc):
+        """
+        Get a copy of ``doc`` with its (top level) keys compressed, counting
+        the saving.
+        """
+        compress_map = self.compress_map
+        compressed = {}
+        saved = 0
+        for key, value in doc.items():
+            short = compress_map.get(key)
+            if short is None:
+                compressed[key] = value
+            else:
+                compressed[short] = value
+                saved += len(key) - len(short)
+        self.documents += 1
+        self.bytes_saved += saved
+        return compressed
+
+    def expand(self, doc):
+        """Get a copy of ``doc`` with the original keys restored."""
+        expand_map = self.expand_map
+        return dict((expand_map.get(key, key), value)
+                    for key, value in doc.items())
+
+
+class MemoryKeyMapStore(object):
+    """
+    A generated key map store which lives only in memory. This is what you
+    get if ``CQRS_KEY_MAP_STORE`` isn't set; the maps are made afresh by each
+    process, so don't store documents with it.
+
+    A store needs :meth:`load`, giving a collection's map as a dictionary of
+    long key to short key, and :meth:`allocate`, giving the short key for a
+    long one, allocating a new one if need be.
+    """
+
+    def __init__(self):
+        self._maps = {}
+
+    def load(self, name):
+        return dict(self._maps.get(name, {}))
+
+    def allocate(self, name, key):
+        mapping = self._maps.setdefault(name, {})
+        if key not in mapping:
+            mapping[key] = next_short_key(mapping.values())
+        return mapping[key]
+
+
+class KeyMapTable(object):
+    """
+    The generated key maps, kept in a swappable store.
+    """
+
+    def __init__(self, store=None):
+        self._lock = threading.RLock()
+        self._store = store
+
+    def set_store(self, store):
+        """Switch to a different store (``None`` for the configured one)."""
+        with self._lock:
+            self._store = store
+
+    @property
+    def store(self):
+        with self._lock:
+            if self._store is None:
+                if settings.CQRS_KEY_MAP_STORE:
+                    self._store = import_by_path(settings.CQRS_KEY_MAP_STORE)()
+                else:
+                    self._store = MemoryKeyMapStore()
+            return self._store
+
+    def check_persistent(self, name):
+        """
+        Check that the map generated for the collection ``name`` will be the
+        same in every process, i.e. that the store isn't the in-memory
+        default.
+
+        :raises ImproperlyConfigured: if no store is configured
+        """
+        with self._lock:
+            if self._store is None and not settings.CQRS_KEY_MAP_STORE:
+                raise ImproperlyConfigured(
+                    "{} generates its key map, which needs "
+                    "CQRS_KEY_MAP_STORE (e.g. 'cqrs.mongo.key_map_store') "
+                    "to be stored".format(name))
+
+    def key_map(self, name, field_names):
+        """
+        Get the :class:`KeyMap` for the collection ``name``: the stored one,
+        with short keys allocated for any of ``field_names`` it hasn't got.
+        """
+        with self._lock:
+            mapping = self.store.load(name)
+            for key in sorted(set(field_names) - RESERVED_KEYS - set(mapping)):
+                mapping[key] = self.store.allocate(name, key)
+        return KeyMap(mapping)
+
+
+#: The generated key maps used by the collections.
+key_maps = KeyMapTable()
+
+
+def key_map_for(collection):
+    """
+    Get the :class:`KeyMap` in use for a collection, or ``None``. (Works for
+    plain django-denormalize collections, too; they never have one.)
+    """
+    get_key_map = getattr(collection, 'get_key_map', None)
+    return get_key_map() if get_key_map is not None else None
+
+
+def compression_report(backend):
+    """
+    Report, for each of a backend's collections which compresses its keys,
+    how many documents have been written in this process and how many bytes
+    of keys that saved, along with the map itself.
+    """
+    report = {}
+    for name, collection in backend.collections.items():
+        key_map = key_map_for(collection)
+        if key_map is not None:
+            report[name] = {
+                'documents': key_map.documents,
+                'bytes_saved': key_map.bytes_saved,
+                'key_map': key_map.compress_map,
+            }
+    return report
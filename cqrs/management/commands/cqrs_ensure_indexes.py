@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from denormalize.backend.base import BackendBase
+
+
+class Command(BaseCommand):
+
+    args = '<backend_name> [collection_name_1] [...]'
+    help = ("Create any missing read model indexes declared by the given "
+            "backend's collections (all of them if none are named)")
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Specify a backend name (one of: {0})".format(
+                ', '.join(sorted(BackendBase._registry.keys()))))
+
+        backend_name = args[0]
+        try:
+            backend = BackendBase._registry[backend_name]
+        except KeyError:
+            raise CommandError(
+                "No backend with name '{0}' found".format(backend_name))
+        if not hasattr(backend, 'ensure_indexes'):
+            raise CommandError("Backend '{0}' ({1}) doesn't manage indexes"
+                               .format(backend_name, type(backend).__name__))
+
+        collection_names = args[1:] or sorted(backend.collections.keys())
+        invalid_names = set(collection_names) - set(backend.collections)
+        if invalid_names:
+            raise CommandError("Invalid collection names: {0}".format(
+                ' '.join(sorted(invalid_names))))
+
+        for name in collection_names:
+            created = backend.ensure_indexes(backend.collections[name])
+            if created:
+                self.stdout.write("{0}: created {1}\n".format(
+                    name, ', '.join(created)))
+            else:
+                self.stdout.write("{0}: up to date\n".format(name))
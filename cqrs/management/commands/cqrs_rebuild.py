@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denormalize.backend.base import BackendBase
+
+
+class Command(BaseCommand):
+
+    args = '<backend_name> <collection_name_1> [...]'
+    help = ("Rebuild the given collections of a backend in shadow "
+            "collections, swapping each in for the live one when it's done")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=None,
+                    help='Number of documents to insert at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError("Specify a backend name (one of: {0}) and "
+                               "the collections to rebuild".format(
+                                   ', '.join(sorted(BackendBase._registry))))
+
+        backend_name = args[0]
+        try:
+            backend = BackendBase._registry[backend_name]
+        except KeyError:
+            raise CommandError(
+                "No backend with name '{0}' found".format(backend_name))
+        if not hasattr(backend, 'rebuild_collection'):
+            raise CommandError("Backend '{0}' ({1}) can't rebuild in a shadow "
+                               "collection".format(backend_name,
+                                                   type(backend).__name__))
+
+        collection_names = args[1:]
+        invalid_names = set(collection_names) - set(backend.collections)
+        if invalid_names:
+            raise CommandError("Invalid collection names: {0}".format(
+                ' '.join(sorted(invalid_names))))
+
+        for name in collection_names:
+            count = backend.rebuild_collection(
+                backend.collections[name], batch_size=options['batch_size'])
+            self.stdout.write("{0}: {1} documents\n".format(name, count))
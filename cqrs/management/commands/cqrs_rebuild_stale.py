@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denormalize.backend.base import BackendBase
+
+from ...fingerprints import rebuild_stale
+
+
+class Command(BaseCommand):
+
+    args = '<backend_name> [collection_name_1] [...]'
+    help = ("Re-project the documents of the given backend's polymorphic "
+            "collections (all of them if none are named) whose type's "
+            "serializer fingerprint has changed")
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only report the stale types; don't rebuild them"),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Specify a backend name (one of: {0})".format(
+                ', '.join(sorted(BackendBase._registry.keys()))))
+
+        backend_name = args[0]
+        try:
+            backend = BackendBase._registry[backend_name]
+        except KeyError:
+            raise CommandError(
+                "No backend with name '{0}' found".format(backend_name))
+
+        collection_names = args[1:] or sorted(
+            name for name, collection in backend.collections.items()
+            if getattr(collection, 'fingerprints', False))
+        invalid_names = set(collection_names) - set(backend.collections)
+        if invalid_names:
+            raise CommandError("Invalid collection names: {0}".format(
+                ' '.join(sorted(invalid_names))))
+        unfingerprinted = [
+            name for name in collection_names
+            if not getattr(backend.collections[name], 'fingerprints', False)]
+        if unfingerprinted:
+            raise CommandError("Collections without fingerprints: {0}".format(
+                ' '.join(sorted(unfingerprinted))))
+
+        for name in collection_names:
+            rebuilt = rebuild_stale(backend, backend.collections[name],
+                                    dry_run=options['dry_run'])
+            if rebuilt:
+                self.stdout.write("{0}: {1}\n".format(name, ', '.join(
+                    '{0} {1}'.format(count, model.__name__)
+                    for model, count in sorted(
+                        rebuilt.items(), key=lambda item: item[0].__name__))))
+            else:
+                self.stdout.write("{0}: up to date\n".format(name))
@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denormalize.backend.base import BackendBase
+
+from ...replay import replay
+
+
+class Command(BaseCommand):
+
+    args = '<backend_name> <event_file>'
+    help = ("Rebuild the given backend's read models from a file of recorded "
+            "change events")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of documents to write at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Specify a backend name (one of: {0}) and an "
+                               "event file".format(
+                                   ', '.join(sorted(BackendBase._registry))))
+
+        backend_name, path = args
+        try:
+            backend = BackendBase._registry[backend_name]
+        except KeyError:
+            raise CommandError(
+                "No backend with name '{0}' found".format(backend_name))
+        if not hasattr(backend, 'added_many'):
+            raise CommandError("Backend '{0}' ({1}) can't write in bulk"
+                               .format(backend_name, type(backend).__name__))
+
+        stats = replay(path, backend, batch_size=options['batch_size'])
+        self.stdout.write("{0}\n".format(stats))
+        if stats.skipped:
+            self.stdout.write("{0} documents skipped (unknown collections)\n"
+                              .format(stats.skipped))
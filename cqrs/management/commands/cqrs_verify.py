@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from denormalize.backend.base import BackendBase
+
+from ...backend import PolymorphicBackendBase
+from ...verify import RangeVerifier
+
+
+class Command(BaseCommand):
+
+    args = '<backend_name> [collection_name_1] [...]'
+    help = ("Check the given backend's read models against the database "
+            "(all of them if none are named), re-projecting the documents "
+            "which have drifted")
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only report drifted documents; don't fix them"),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Specify a backend name (one of: {0})".format(
+                ', '.join(sorted(BackendBase._registry.keys()))))
+
+        backend_name = args[0]
+        try:
+            backend = BackendBase._registry[backend_name]
+        except KeyError:
+            raise CommandError(
+                "No backend with name '{0}' found".format(backend_name))
+        # (PolymorphicBackendBase has one, which says it isn't supported.)
+        docs_in_range = getattr(type(backend), 'docs_in_range', None)
+        if (docs_in_range is None or docs_in_range.__func__
+                is PolymorphicBackendBase.docs_in_range.__func__):
+            raise CommandError("Backend '{0}' ({1}) can't read documents back"
+                               .format(backend_name, type(backend).__name__))
+
+        collection_names = args[1:] or sorted(backend.collections.keys())
+        invalid_names = set(collection_names) - set(backend.collections)
+        if invalid_names:
+            raise CommandError("Invalid collection names: {0}".format(
+                ' '.join(sorted(invalid_names))))
+
+        for name in collection_names:
+            verifier = RangeVerifier(backend, backend.collections[name])
+            drifted = verifier.verify(repair=not options['dry_run'])
+            self.stdout.write("{0}: {1} drifted ({2} ranges, {3} documents "
+                              "read)\n".format(name, len(drifted),
+                                               verifier.stats['ranges'],
+                                               verifier.stats['documents']))
@@ -0,0 +1,194 @@
+'''
+Batch-scoped memoization of nested serialization.
+
+When a batch of documents is dumped (a fan-out chunk, a full sync, a journal
+replay), the same related object is often nested in many of them: every
+product of a manufacturer embeds that manufacturer, and without help the
+nested serializer works out its representation afresh for each one. Inside
+:func:`batch_memo`, nested CQRS serializers remember what they produced, by
+``(serializer class, object pk)``, and hand it straight back the next time::
+
+    with batch_memo() as memo:
+        docs = [collection.dump(obj) for obj in objs]
+    log.debug('%d hits, %d misses', memo.hits, memo.misses)
+
+The memo holds up to ``CQRS_MEMO_SIZE`` representations (the least recently
+used going first) and is thrown away when the batch ends, so nothing can be
+served from it after the data may have changed. Within a batch, though, an
+object is taken to be unchanged: don't save things and re-dump them in the
+same batch. Batches don't nest; an inner one just carries on with the outer
+one's memo.
+
+Memoized representations are shared between the documents they're nested
+in, so treat them as read-only.
+
+Root objects aren't memoized (each is dumped just once per batch anyway),
+and neither is anything outside a batch.
+
+Computed fields
+---------------
+
+Read only fields which run model methods (``password_hash``, in the example
+in :mod:`cqrs`) are worked out again every time their object is serialized,
+which can be several times in a batch when the object belongs to several
+collections or turns up again in a fan-out. A serializer can list such fields
+in ``cached_fields``, and then inside a batch each is worked out once per
+object version::
+
+    class URLSerializer(CQRSPolymorphicSerializer):
+        password_hash = CharField(read_only=True)
+        cached_fields = 'password_hash',
+        cache_version = 'modified'
+
+        class Meta:
+            fields = 'url',
+
+``cache_version`` names the model attribute (a modification time or a
+counter, say) telling versions of an object apart; without one, an object is
+taken to be unchanged throughout the batch, as above. (Every collection of a
+model uses the same serializer, so they all share the values.)
+
+How well that's doing can be seen, per field, with the memo's :meth:`report
+<SerializationMemo.report>`, or with :func:`memo_report` for the totals of
+every batch so far in the process.
+'''
+
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+from contextlib import contextmanager
+
+from . import settings
+
+
+class SerializationMemo(object):
+    """
+    A bounded, least recently used memo of serialized representations,
+    counting its hits and misses.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.CQRS_MEMO_SIZE
+        self._values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # label: [hits, misses]
+        self.stats = {}
+
+    def get_or_compute(self, key, compute, label=None):
+        """
+        Get the value for ``key``, calling ``compute()`` if need be. If a
+        ``label`` is given, the hit or miss is also counted against it.
+        """
+        counts = None
+        if label is not None:
+            counts = self.stats.setdefault(label, [0, 0])
+        try:
+            value = self._values.pop(key)
+        except KeyError:
+            self.misses += 1
+            if counts is not None:
+                counts[1] += 1
+            value = compute()
+            if len(self._values) >= self.max_size:
+                self._values.popitem(last=False)
+        else:
+            self.hits += 1
+            if counts is not None:
+                counts[0] += 1
+        # (Re-)inserted last, as the most recently used.
+        self._values[key] = value
+        return value
+
+    def __len__(self):
+        return len(self._values)
+
+    def report(self):
+        """
+        Report the hits, misses and hit rate for each label (i.e. each cached
+        field, as ``'SerializerName.field_name'``).
+        """
+        return _report(self.stats)
+
+
+def _report(stats):
+    return dict((label, {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0,
+    }) for label, (hits, misses) in stats.items())
+
+
+_local = threading.local()
+
+# The stats of every batch so far, and the lock for adding to them.
+_total_stats = {}
+_total_stats_lock = threading.Lock()
+
+
+def memo_report():
+    """
+    Like :meth:`SerializationMemo.report`, but for every batch finished in
+    this process so far.
+    """
+    with _total_stats_lock:
+        return _report(deepcopy(_total_stats))
+
+
+def current_memo():
+    """Get the memo of the batch in progress in this thread, if any."""
+    return getattr(_local, 'memo', None)
+
+
+@contextmanager
+def batch_memo(max_size=None):
+    """
+    Memoize nested serialization in this thread for the duration (see
+    :mod:`cqrs.memo`), yielding the :class:`SerializationMemo`.
+    """
+    memo = current_memo()
+    if memo is not None:
+        yield memo
+        return
+    memo = _local.memo = SerializationMemo(max_size)
+    try:
+        yield memo
+    finally:
+        _local.memo = None
+        with _total_stats_lock:
+            for label, (hits, misses) in memo.stats.items():
+                counts = _total_stats.setdefault(label, [0, 0])
+                counts[0] += hits
+                counts[1] += misses
+
+
+def memoized(serializer, kind, obj, compute):
+    """
+    Get ``compute()``, the representation of ``obj`` of the given ``kind``
+    by ``serializer``, from the current batch's memo if there is one.
+    """
+    memo = current_memo()
+    pk = getattr(obj, 'pk', None)
+    if memo is None or pk is None:
+        return compute()
+    return memo.get_or_compute((type(serializer), kind, pk), compute)
+
+
+def memoized_field(serializer, field_name, obj, compute):
+    """
+    Get ``compute()``, the value of one of ``serializer``'s
+    ``cached_fields`` for ``obj``, from the current batch's memo if there is
+    one.
+    """
+    memo = current_memo()
+    pk = getattr(obj, 'pk', None)
+    if memo is None or pk is None:
+        return compute()
+    version = None
+    if serializer.cache_version is not None:
+        version = getattr(obj, serializer.cache_version)
+    return memo.get_or_compute(
+        (type(serializer), 'field', field_name, pk, version), compute,
+        label='{}.{}'.format(type(serializer).__name__, field_name))
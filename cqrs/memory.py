@@ -0,0 +1,349 @@
+'''
+A projection backend keeping documents in memory, for tests and benchmarks
+which want the whole read path (writes, lookups by id and simple queries) at
+memory speed, with no database to set up::
+
+    backend = PolymorphicMemoryBackend(name='test')
+    backend.register(ProductCollection())
+    ...
+    backend.find(collection, {'manufacturer_id': 7,
+                              'colour': {'$in': ['red', 'blue']}})
+
+Documents are stored as the Mongo backends store them (keyed by ``_id``,
+changes merging top level fields), and embedded array operations (see
+:mod:`cqrs.embedded`) are applied in place, so what a test reads back is what
+Mongo would hold.
+
+A collection's declared indexes (see :mod:`cqrs.indexes`) are maintained as
+dictionaries of key to document ids, and :meth:`MemoryBackend.find` uses one
+when the query constrains all its fields. Only the keys are used, not the
+options: a partial or sparse index holds every document, which doesn't change
+what a query finds. Without a usable index, a query looks at every document.
+
+Every write is also recorded in :attr:`MemoryBackend.oplog`, a ring buffer of
+the last ``oplog_size`` :class:`~cqrs.replay.Action` entries, so that a long
+benchmark doesn't slowly eat all the memory there is.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+from collections import deque
+from itertools import product
+
+from denormalize.backend.base import BackendBase
+
+from .backend import PolymorphicBackendBase
+from .memo import batch_memo
+from .replay import Action, ADD, CHANGE, DELETE
+
+
+log = logging.getLogger(__name__)
+
+
+def _get_path(doc, path):
+    """Get the value at a dotted ``path`` in a document, or ``None``."""
+    for part in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def _freeze(value):
+    """Make a value usable as (part of) a dictionary key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _values(doc, path):
+    """
+    Get the values a document has for ``path``, for matching and indexing:
+    like Mongo, a list matches (and is indexed under) each of its elements,
+    as well as the list as a whole.
+    """
+    value = _get_path(doc, path)
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+
+def _condition_values(condition):
+    """The values a query condition accepts (equality or ``$in``)."""
+    if isinstance(condition, dict) and condition.keys() == ['$in']:
+        return list(condition['$in'])
+    return [condition]
+
+
+def matches(doc, query):
+    """
+    Whether a document matches a query: a dictionary of (dotted) field paths
+    to values, or ``{'$in': [values]}``, all of which must match.
+    """
+    for path, condition in query.items():
+        accepted = [_freeze(v) for v in _condition_values(condition)]
+        if not any(_freeze(value) in accepted
+                   for value in _values(doc, path)):
+            return False
+    return True
+
+
+class MemoryIndex(object):
+    """An index (see :mod:`cqrs.indexes`) as a dictionary of key to ids."""
+
+    def __init__(self, index):
+        self.name = index.name
+        self.fields = index.fields
+        self.entries = {}
+
+    def keys_for(self, doc):
+        return set(product(*[[_freeze(value) for value in _values(doc, field)]
+                             for field in self.fields]))
+
+    def add(self, doc_id, doc):
+        for key in self.keys_for(doc):
+            self.entries.setdefault(key, set()).add(doc_id)
+
+    def remove(self, doc_id, doc):
+        for key in self.keys_for(doc):
+            ids = self.entries.get(key)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self.entries[key]
+
+    def usable_for(self, query):
+        return all(field in query for field in self.fields)
+
+    def lookup(self, query):
+        """Get the ids of the documents which might match the query."""
+        ids = set()
+        for key in product(*[[_freeze(v) for v in
+                              _condition_values(query[field])]
+                             for field in self.fields]):
+            ids.update(self.entries.get(key, ()))
+        return ids
+
+
+class MemoryBackend(BackendBase):
+    """
+    A backend storing documents in dictionaries (see :mod:`cqrs.memory`).
+    """
+
+    oplog_size = 10000
+
+    # Documents come ready to store, with no DRF structures to walk.
+    plain_documents = True
+
+    def __init__(self, name=None, oplog_size=None):
+        super(MemoryBackend, self).__init__(name=name)
+        if oplog_size is not None:
+            self.oplog_size = oplog_size
+        self._lock = threading.RLock()
+        self.data = {}
+        self.indexes = {}
+        self.oplog = deque(maxlen=self.oplog_size)
+
+    def flush_oplog(self):
+        """
+        Retrieve the list of logged operations and return it, clearing the
+        oplog at the same time.
+        """
+        with self._lock:
+            oplog = list(self.oplog)
+            self.oplog.clear()
+            return oplog
+
+    def register(self, collection):
+        super(MemoryBackend, self).register(collection)
+        self._ensure_collection(collection)
+
+    def _ensure_collection(self, collection):
+        if collection.name not in self.data:
+            with self._lock:
+                self.data.setdefault(collection.name, {})
+                self.indexes.setdefault(collection.name, [
+                    MemoryIndex(index) for index
+                    in getattr(collection, 'get_indexes', list)()])
+        return self.data[collection.name]
+
+    def _prepare_doc(self, doc):
+        """
+        Turn a dumped document into what is stored: ``id`` becomes ``_id``
+        (if it's not a plain document, which has that already).
+        """
+        doc = dict(doc)
+        if 'id' in doc:
+            doc['_id'] = doc.pop('id')
+        return doc
+
+    def _store(self, collection, doc_id, doc):
+        """Put a document in place of any existing one, updating indexes."""
+        docs = self._ensure_collection(collection)
+        indexes = self.indexes[collection.name]
+        old = docs.get(doc_id)
+        if old is not None:
+            for index in indexes:
+                index.remove(doc_id, old)
+        if doc is None:
+            docs.pop(doc_id, None)
+        else:
+            docs[doc_id] = doc
+            for index in indexes:
+                index.add(doc_id, doc)
+
+    def added(self, collection, doc_id, doc):
+        log.debug('added: %s %s', collection.name, doc_id)
+        doc = self._prepare_doc(doc)
+        with self._lock:
+            self._store(collection, doc_id, doc)
+            self.oplog.append(Action(ADD, collection, doc_id, doc))
+
+    def changed(self, collection, doc_id, doc):
+        log.debug('changed: %s %s', collection.name, doc_id)
+        doc = self._prepare_doc(doc)
+        with self._lock:
+            merged = dict(self._ensure_collection(collection).get(
+                doc_id, {'_id': doc_id}))
+            merged.update(doc)
+            # The id can't change, whatever the document says.
+            merged['_id'] = doc_id
+            self._store(collection, doc_id, merged)
+            self.oplog.append(Action(CHANGE, collection, doc_id, doc))
+
+    def deleted(self, collection, doc_id):
+        log.debug('deleted: %s %s', collection.name, doc_id)
+        with self._lock:
+            self._store(collection, doc_id, None)
+            self.oplog.append(Action(DELETE, collection, doc_id, None))
+
+    def get_doc(self, collection, doc_id):
+        return self._ensure_collection(collection).get(doc_id)
+
+    def get_docs(self, collection, doc_ids):
+        docs = self._ensure_collection(collection)
+        with self._lock:
+            return dict((doc_id, docs[doc_id]) for doc_id in doc_ids
+                        if doc_id in docs)
+
+    def docs_in_range(self, collection, lo=None, hi=None):
+        docs = self._ensure_collection(collection)
+        with self._lock:
+            doc_ids = sorted(doc_id for doc_id in docs
+                             if (lo is None or doc_id >= lo)
+                             and (hi is None or doc_id < hi))
+        for doc_id in doc_ids:
+            # It may have gone since.
+            doc = docs.get(doc_id)
+            if doc is not None:
+                yield doc_id, doc
+
+    def find(self, collection, query=None):
+        """
+        Get the documents matching a query (see :func:`matches`), in no
+        particular order. They're the stored documents themselves, so don't
+        change them.
+        """
+        query = query or {}
+        with self._lock:
+            docs = self._ensure_collection(collection)
+            if '_id' in query:
+                candidates = [docs[doc_id] for doc_id
+                              in _condition_values(query['_id'])
+                              if doc_id in docs]
+            else:
+                index = self._choose_index(collection, query)
+                if index is None:
+                    candidates = docs.values()
+                else:
+                    candidates = [docs[doc_id]
+                                  for doc_id in index.lookup(query)]
+            return [doc for doc in candidates if matches(doc, query)]
+
+    def distinct_values(self, collection, field, query=None):
+        return set(_get_path(doc, field)
+                   for doc in self.find(collection, query))
+
+    def _choose_index(self, collection, query):
+        # The index covering the most of the query is likely the most
+        # selective.
+        usable = [index for index in self.indexes[collection.name]
+                  if index.usable_for(query)]
+        if usable:
+            return max(usable, key=lambda index: len(index.fields))
+
+    def count(self, collection):
+        """Get the number of documents stored for a collection."""
+        return len(self._ensure_collection(collection))
+
+    def _update_array(self, collection, doc_id, embedded_array, update):
+        with self._lock:
+            doc = self._ensure_collection(collection).get(doc_id)
+            if doc is None:
+                # Like Mongo's update without upsert: nothing to update.
+                return
+            doc = dict(doc)
+            doc[embedded_array.field] = update(
+                list(doc.get(embedded_array.field) or ()))
+            self._store(collection, doc_id, doc)
+            self.oplog.append(Action(CHANGE, collection, doc_id, doc))
+
+    def embedded_added(self, collection, doc_id, embedded_array, element):
+        key = embedded_array.key
+
+        def add(array):
+            if not any(e.get(key) == element[key] for e in array):
+                array.append(element)
+            return array
+
+        self._update_array(collection, doc_id, embedded_array, add)
+
+    def embedded_changed(self, collection, doc_id, embedded_array, element):
+        key = embedded_array.key
+
+        def change(array):
+            for i, e in enumerate(array):
+                if e.get(key) == element[key]:
+                    array[i] = element
+                    return array
+            # It wasn't there, so it's really an addition.
+            array.append(element)
+            return array
+
+        self._update_array(collection, doc_id, embedded_array, change)
+
+    def embedded_removed(self, collection, doc_id, embedded_array, key):
+        self._update_array(
+            collection, doc_id, embedded_array,
+            lambda array: [e for e in array
+                           if e.get(embedded_array.key) != key])
+
+    def sync_collection(self, collection):
+        """
+        Replace everything stored for a collection with a fresh dump of it.
+        Writes from other threads wait for it, and so land on top of it.
+        Returns the number of documents.
+        """
+        log.info('Starting full sync for collection %s', collection.name)
+        t0 = time.time()
+        dump = getattr(collection, 'dump_document', collection.dump)
+        with self._lock, batch_memo():
+            self._ensure_collection(collection)
+            self.data[collection.name] = {}
+            for index in self.indexes[collection.name]:
+                index.entries.clear()
+            for obj in collection.queryset():
+                self._store(collection, obj.pk, self._prepare_doc(dump(obj)))
+            count = len(self.data[collection.name])
+        log.info('Full sync for collection %s completed in %.3fs '
+                 '(%d documents)', collection.name, time.time() - t0, count)
+        return count
+
+
+class PolymorphicMemoryBackend(MemoryBackend, PolymorphicBackendBase):
+    pass
@@ -1,3 +1,174 @@
+'''
+Helpers for DRF views of CQRS models.
+
+:class:`ProjectedReadMixin` serves ``retrieve`` and ``list`` from the read
+model: the documents were made with the very serializer the view would use,
+when the objects were saved, so there's no need to serialize them all over
+again for every GET::
+
+    class ProductList(ProjectedReadMixin, generics.ListAPIView):
+        model = Product
+        serializer_class = CQRSSerializerMeta._register[Product]
+        read_backend = 'mongo'
+
+The objects are still looked up as usual (so that filtering, pagination,
+permissions and 404s work as ever), but only their ids are read for a list;
+their documents are then fetched from the backend in one go (see
+``get_docs``), and only those the backend hasn't got are serialized live.
+
+The documents are as the read model has them, which may be a moment behind
+the database, and without anything the serializer makes of the request
+(hyperlinks, say); views whose output depends on the request shouldn't use
+it. They're only used if the view's serializer is the one which made them,
+serializing every field; otherwise (a different serializer, or
+``requested_fields``) the objects are serialized live.
+'''
+
+import warnings
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404
+from rest_framework import serializers
+from rest_framework.response import Response
+
+from denormalize.backend.base import BackendBase
+
+from .collections import FINGERPRINT_FIELD
+
+
+class _Precomputed(serializers.Field):
+    """A serializer field giving a value worked out already."""
+
+    def __init__(self, value):
+        super(_Precomputed, self).__init__()
+        self.value = value
+
+    def field_to_native(self, obj, field_name):
+        return self.value
+
+
+class ProjectedReadMixin(object):
+    """
+    A mixin for DRF generic views serving ``retrieve`` and ``list`` from the
+    documents in the read model (see :mod:`cqrs.mixins`).
+    """
+
+    #: The name of the backend to read documents from.
+    read_backend = None
+
+    #: The name of the collection the documents are in; by default, that of
+    #: the queryset's model (or else of its nearest base with one).
+    read_collection = None
+
+    def get_read_model(self):
+        """
+        Get the backend and collection to read documents from.
+
+        :raises ImproperlyConfigured: if there aren't any, or there's more
+                                      than one to choose from
+        """
+        try:
+            backend = BackendBase._registry[self.read_backend]
+        except KeyError:
+            raise ImproperlyConfigured(
+                "{} needs the name of a backend as read_backend (not {!r})"
+                .format(type(self).__name__, self.read_backend))
+        if self.read_collection is not None:
+            return backend, backend.collections[self.read_collection]
+        model = self.get_queryset().model
+        found = [collection for collection in backend.collections.values()
+                 if issubclass(model, collection.model)]
+        # The most specific: that of the model or its nearest base.
+        nearest = [collection for collection in found
+                   if all(issubclass(collection.model, other.model)
+                          for other in found)]
+        if len(nearest) == 1:
+            return backend, nearest[0]
+        if found:
+            raise ImproperlyConfigured(
+                "{} has several collections for {} ({}); set "
+                "read_collection".format(
+                    self.read_backend, model.__name__,
+                    ', '.join(sorted(collection.name
+                                     for collection in found))))
+        raise ImproperlyConfigured(
+            "{} has no collection for {}; set read_collection".format(
+                self.read_backend, model.__name__))
+
+    def uses_documents(self, collection):
+        """
+        Whether the collection's documents are what the view's serializer
+        would give: it's the collection's serializer, serializing every
+        field.
+        """
+        serializer = self.get_serializer()
+        return (type(serializer) is collection.serializer_class
+                and getattr(serializer, 'requested_fields', None) is None)
+
+    def document_data(self, collection, doc):
+        """
+        Turn a stored document back into what the serializer would have given:
+        ``_id`` becomes ``id``, and what the collection adds goes.
+        """
+        data = dict(doc)
+        data['id'] = data.pop('_id')
+        data.pop(FINGERPRINT_FIELD, None)
+        if getattr(collection, 'type_ancestry', False):
+            data.pop('types', None)
+        return data
+
+    def get_documents(self, queryset):
+        """
+        Get the data for the objects of ``queryset``, in order: their
+        documents, where the backend has them (and the view
+        :meth:`uses_documents`), and otherwise what the serializer gives.
+        """
+        backend, collection = self.get_read_model()
+        pks = list(queryset.values_list('pk', flat=True))
+        data = {}
+        if self.uses_documents(collection):
+            data.update((pk, self.document_data(collection, doc)) for pk, doc
+                        in backend.get_docs(collection, pks).items())
+        missing = [pk for pk in pks if pk not in data]
+        if missing:
+            objs = list(self.get_queryset().filter(pk__in=missing))
+            data.update(zip([obj.pk for obj in objs],
+                            self.get_serializer(objs, many=True).data))
+        return [data[pk] for pk in pks if pk in data]
+
+    def retrieve(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        backend, collection = self.get_read_model()
+        doc = None
+        if self.uses_documents(collection):
+            doc = backend.get_docs(collection, [self.object.pk]).get(
+                self.object.pk)
+        if doc is None:
+            return Response(self.get_serializer(self.object).data)
+        return Response(self.document_data(collection, doc))
+
+    def list(self, request, *args, **kwargs):
+        self.object_list = self.filter_queryset(self.get_queryset())
+        # As ListModelMixin does.
+        if not self.allow_empty and not self.object_list:
+            warnings.warn(
+                'The `allow_empty` parameter is due to be deprecated. '
+                'To use `allow_empty=False` style behavior, You should '
+                'override `get_queryset()` and explicitly raise a 404 on '
+                'empty querysets.',
+                PendingDeprecationWarning
+            )
+            class_name = self.__class__.__name__
+            raise Http404(self.empty_error % {'class_name': class_name})
+        page = self.paginate_queryset(self.object_list)
+        if page is None:
+            return Response(self.get_documents(self.object_list))
+        serializer = self.get_pagination_serializer(page)
+        serializer.fields[serializer.results_field] = _Precomputed(
+            self.get_documents(page.object_list))
+        return Response(serializer.data)
+
+
 # here for safe keeping...
 
 def update(self, request, *args, **kwargs):
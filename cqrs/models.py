@@ -1,17 +1,73 @@
 from django.db import models
+from polymorphic.base import PolymorphicModelBase
+from polymorphic.manager import PolymorphicManager
 from polymorphic.polymorphic_model import PolymorphicModel
 from django.utils.module_loading import import_by_path
 
+from .bulk import CQRSQuerySet, CQRSPolymorphicQuerySet, batched_projection
+
+
+class CQRSManager(models.Manager):
+    """
+    A manager whose bulk operations are projected (see :mod:`cqrs.bulk`).
+    """
+
+    def get_queryset(self):
+        return CQRSQuerySet(self.model, using=self._db)
+
+
+class CQRSPolymorphicManager(PolymorphicManager):
+    """
+    A polymorphic manager whose bulk operations are projected (see
+    :mod:`cqrs.bulk`).
+    """
+    queryset_class = CQRSPolymorphicQuerySet
+
+
+class CQRSPolymorphicModelBase(PolymorphicModelBase):
+    """
+    Gives CQRS polymorphic models a :class:`CQRSPolymorphicManager`.
+
+    django-polymorphic pays no attention to the managers of abstract models
+    other than its own ``PolymorphicModel``, and so would otherwise give every
+    concrete model a plain ``PolymorphicManager`` (unless it defines a manager
+    of its own, which is left alone).
+    """
+
+    def get_inherited_managers(self, attrs):
+        managers = []
+        for source_name, mgr_name, manager in super(
+                CQRSPolymorphicModelBase, self).get_inherited_managers(attrs):
+            if type(manager) is PolymorphicManager and mgr_name == 'objects':
+                model = manager.model
+                manager = CQRSPolymorphicManager()
+                manager.model = model
+            managers.append((source_name, mgr_name, manager))
+        return managers
+
 
 class CQRSModel(models.Model):
     """A non-polymorphic CQRS model."""
 
+    objects = CQRSManager()
+
+    def delete(self, using=None):
+        # Each object the deletion cascades to (and each of its concrete
+        # parents) gets its own pair of delete signals; the documents are
+        # removed all together at the end, with a deleted_many per collection.
+        with batched_projection():
+            super(CQRSModel, self).delete(using=using)
+    delete.alters_data = True
+
     class Meta:
         abstract = True
 
 
 class CQRSPolymorphicModel(CQRSModel, PolymorphicModel):
     """A polymorphic CQRS model."""
+    __metaclass__ = CQRSPolymorphicModelBase
+
+    objects = CQRSPolymorphicManager()
 
     @classmethod
     def _model_class_from_type_path(self, type_path):
@@ -25,6 +81,28 @@ class CQRSPolymorphicModel(CQRSModel, PolymorphicModel):
         '''
         return import_by_path(type_path)
 
+    @classmethod
+    def _class_type_path(cls):
+        '''
+        Get the path of this model class, as ``_type_path`` would give for an
+        instance of it.
+        '''
+        return '{}.{}'.format(cls.__module__, cls.__name__)
+
+    @classmethod
+    def _type_ancestry(cls):
+        '''
+        Get the type paths of this model class and all of its concrete CQRS
+        polymorphic ancestors, in MRO order (so most specific first).
+
+        This is what lets the read model find "all Books, including EBooks" by
+        looking for ``Book`` in a single array, rather than enumerating every
+        subclass.
+        '''
+        return [base._class_type_path() for base in cls.__mro__
+                if issubclass(base, CQRSPolymorphicModel)
+                and not base._meta.abstract and not base._meta.proxy]
+
     @property
     def _type_path(self):
         '''
@@ -34,8 +112,7 @@ class CQRSPolymorphicModel(CQRSModel, PolymorphicModel):
         unnecessary; django-polymorphic has already done that for us by giving
         us an instance of the right type.)
         '''
-        type_ = type(self)
-        return '{}.{}'.format(type_.__module__, type_.__name__)
+        return type(self)._class_type_path()
 
     class Meta:
         abstract = True
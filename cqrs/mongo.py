@@ -1,22 +1,561 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, PyMongoError
+
 from . import settings
 from .backend import PolymorphicBackendBase
+from .bulk import chunks
+from .indexes import Index
+from .keymap import key_map_for, key_maps, next_short_key
+from .typecodes import type_codes
+from .verify import dumped_docs
 
 from denormalize.backend.mongodb import MongoBackend
 
 
+log = logging.getLogger(__name__)
+
+
+class _Renamed(object):
+    """
+    A collection under another name, for writing its documents somewhere
+    else (a rebuild's shadow collection).
+    """
+
+    def __init__(self, collection, name):
+        self._collection = collection
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._collection, attr)
+
+
 class MongoIDBackend(MongoBackend):
 
+    #: Write errors a journal (see :mod:`cqrs.journal`) can recover from by
+    #: replaying the change later.
+    spill_exceptions = (PyMongoError,)
+
+    # Documents come ready to store, with no DRF structures to walk.
+    plain_documents = True
+
+    #: Appended to a collection's name for the shadow collection a rebuild
+    #: writes to.
+    shadow_suffix = '__rebuild'
+
+    def __init__(self, name=None, db_name=None, connection_uri=None):
+        self._db = None
+        self._connect_lock = threading.Lock()
+        super(MongoIDBackend, self).__init__(
+            name=name, db_name=db_name, connection_uri=connection_uri)
+        # Collection name: ids of the documents written while it's being
+        # rebuilt (see rebuild_collection).
+        self._captures = {}
+        self._rebuild_lock = threading.RLock()
+
+    def connect(self):
+        # Not until the database is first wanted (see db), so that merely
+        # importing cqrs.mongo doesn't need a Mongo server.
+        pass
+
+    @property
+    def db(self):
+        """The database, connecting to it if need be."""
+        if self._db is None:
+            with self._connect_lock:
+                if self._db is None:
+                    super(MongoIDBackend, self).connect()
+        return self._db
+
+    @db.setter
+    def db(self, db):
+        self._db = db
+
+    def register(self, collection):
+        # The documents outlive the process, so whatever encodes them has to
+        # be kept somewhere too.
+        serializer_class = getattr(collection, 'serializer_class', None)
+        if getattr(serializer_class, 'use_type_codes', False):
+            type_codes.check_persistent(collection.name)
+        if getattr(collection, 'key_map', None) is True:
+            key_maps.check_persistent(collection.name)
+        super(MongoIDBackend, self).register(collection)
+
+    @contextmanager
+    def _writing(self, collection, doc_ids):
+        """
+        Wrap a write to a collection, noting the documents written if it's
+        being rebuilt, so they can be written to the shadow too. Writes wait
+        while the shadow is being swapped in.
+        """
+        if collection.name not in self._captures:
+            yield
+            return
+        with self._rebuild_lock:
+            captured = self._captures.get(collection.name)
+            if captured is not None:
+                captured.update(doc_ids)
+            yield
+
+    def _prepare_doc(self, collection, doc):
+        """
+        Turn a dumped document into what is stored: ``id`` becomes ``_id``
+        (if it's not a plain document, which has that already) and, if the
+        collection wants it, keys are compressed.
+        """
+        if 'id' in doc:
+            doc['_id'] = doc.pop('id')
+        key_map = key_map_for(collection)
+        if key_map is not None:
+            doc = key_map.compress(doc)
+        return doc
+
     def added(self, collection, doc_id, doc):
-        doc['_id'] = doc.pop('id')
-        super(MongoIDBackend, self).added(collection, doc_id, doc)
+        doc = self._prepare_doc(collection, doc)
+        with self._writing(collection, [doc_id]):
+            super(MongoIDBackend, self).added(collection, doc_id, doc)
 
     def changed(self, collection, doc_id, doc):
-        doc['_id'] = doc.pop('id')
-        super(MongoIDBackend, self).changed(collection, doc_id, doc)
+        doc = self._prepare_doc(collection, doc)
+        with self._writing(collection, [doc_id]):
+            super(MongoIDBackend, self).changed(collection, doc_id, doc)
+
+    def deleted(self, collection, doc_id):
+        with self._writing(collection, [doc_id]):
+            super(MongoIDBackend, self).deleted(collection, doc_id)
+
+    def added_many(self, collection, docs):
+        col = getattr(self.db, collection.name)
+        bulk = col.initialize_unordered_bulk_op()
+        for doc_id, doc in docs:
+            bulk.find({'_id': doc_id}).upsert().replace_one(
+                self._prepare_doc(collection, doc))
+        if docs:
+            with self._writing(collection, [doc_id for doc_id, _ in docs]):
+                bulk.execute()
+
+    def changed_many(self, collection, docs):
+        col = getattr(self.db, collection.name)
+        bulk = col.initialize_unordered_bulk_op()
+        for doc_id, doc in docs:
+            doc = self._prepare_doc(collection, doc)
+            del doc['_id']
+            bulk.find({'_id': doc_id}).upsert().update_one({'$set': doc})
+        if docs:
+            with self._writing(collection, [doc_id for doc_id, _ in docs]):
+                bulk.execute()
+
+    def deleted_many(self, collection, doc_ids):
+        col = getattr(self.db, collection.name)
+        if doc_ids:
+            with self._writing(collection, doc_ids):
+                col.remove({'_id': {'$in': list(doc_ids)}})
+
+    def get_doc(self, collection, doc_id):
+        doc = super(MongoIDBackend, self).get_doc(collection, doc_id)
+        if doc is not None and hasattr(collection, 'expand_doc'):
+            doc = collection.expand_doc(doc)
+        return doc
+
+    def get_docs(self, collection, doc_ids):
+        col = getattr(self.db, collection.name)
+        docs = {}
+        for doc in col.find({'_id': {'$in': list(doc_ids)}}):
+            if hasattr(collection, 'expand_doc'):
+                doc = collection.expand_doc(doc)
+            docs[doc['_id']] = doc
+        return docs
+
+    def docs_in_range(self, collection, lo=None, hi=None):
+        query = {}
+        if lo is not None:
+            query['$gte'] = lo
+        if hi is not None:
+            query['$lt'] = hi
+        col = getattr(self.db, collection.name)
+        cursor = col.find({'_id': query} if query else {}).sort('_id', 1)
+        for doc in cursor:
+            if hasattr(collection, 'expand_doc'):
+                doc = collection.expand_doc(doc)
+            yield doc['_id'], doc
+
+    def distinct_values(self, collection, field, query=None):
+        col = getattr(self.db, collection.name)
+        query = dict((self._stored_key(collection, key), value)
+                     for key, value in (query or {}).items())
+        field = self._stored_key(collection, field)
+        values = set(col.find(query).distinct(field))
+        # distinct leaves out the documents without the field.
+        query[field] = {'$exists': False}
+        if col.find(query).limit(1).count(True):
+            values.add(None)
+        return values
+
+    def _stored_key(self, collection, key):
+        key_map = key_map_for(collection)
+        if key_map is None:
+            return key
+        # Only the top level is compressed, so only the first part of a
+        # dotted path.
+        head, dot, rest = key.partition('.')
+        return key_map.compress_map.get(head, head) + dot + rest
+
+    def _stored_query(self, collection, query):
+        """A query with its field names as they're stored."""
+        stored = {}
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor'):
+                value = [self._stored_query(collection, clause)
+                         for clause in value]
+            elif not key.startswith('$'):
+                key = self._stored_key(collection, key)
+            stored[key] = value
+        return stored
+
+    def embedded_added(self, collection, doc_id, embedded_array, element):
+        col = getattr(self.db, collection.name)
+        field = self._stored_key(collection, embedded_array.field)
+        key_path = '{}.{}'.format(field, embedded_array.key)
+        # The condition guards against adding the same element twice.
+        with self._writing(collection, [doc_id]):
+            col.update({'_id': doc_id,
+                        key_path: {'$ne': element[embedded_array.key]}},
+                       {'$push': {field: element}})
+
+    def embedded_changed(self, collection, doc_id, embedded_array, element):
+        col = getattr(self.db, collection.name)
+        field = self._stored_key(collection, embedded_array.field)
+        key_path = '{}.{}'.format(field, embedded_array.key)
+        with self._writing(collection, [doc_id]):
+            result = col.update({'_id': doc_id,
+                                 key_path: element[embedded_array.key]},
+                                {'$set': {field + '.$': element}})
+        if not result['n']:
+            # It wasn't there (it's been moved in, or the document was out of
+            # date), so it's really an addition.
+            self.embedded_added(collection, doc_id, embedded_array, element)
+
+    def embedded_removed(self, collection, doc_id, embedded_array, key):
+        col = getattr(self.db, collection.name)
+        field = self._stored_key(collection, embedded_array.field)
+        with self._writing(collection, [doc_id]):
+            col.update({'_id': doc_id},
+                       {'$pull': {field: {embedded_array.key: key}}})
+
+    def ensure_indexes(self, collection):
+        """
+        Create any of the collection's declared indexes which don't exist yet.
+        They are built in the background, so this is safe to run against a
+        live database.
+
+        Indexes are matched up by name; if one of the same name exists but
+        with different keys, it is left alone and a warning logged, as it
+        needs a human to decide what to do. On a collection with a key map,
+        the keys (and a partial index's filter) are compressed, as the
+        documents' are.
+        """
+        if not hasattr(collection, 'get_indexes'):
+            # A plain django-denormalize collection; nothing declared.
+            return []
+
+        col = getattr(self.db, collection.name)
+        existing = col.index_information()
+        created = []
+        for index in collection.get_indexes():
+            keys, options = index.spec()
+            keys = [(self._stored_key(collection, field), direction)
+                    for field, direction in keys]
+            if 'partialFilterExpression' in options:
+                options['partialFilterExpression'] = self._stored_query(
+                    collection, options['partialFilterExpression'])
+            if index.name in existing:
+                if not Index(*keys).matches(existing[index.name]['key']):
+                    log.warning('ensure_indexes: %s has an index %s on %r, '
+                                'but %r is declared; leaving it alone',
+                                collection.name, index.name,
+                                existing[index.name]['key'], keys)
+                continue
+            log.info('ensure_indexes: creating %s on %s',
+                     index.name, collection.name)
+            col.create_index(keys, background=True, **options)
+            created.append(index.name)
+        return created
 
 
 class PolymorphicMongoIDBackend(MongoIDBackend, PolymorphicBackendBase):
-    pass
+
+    def rebuild_collection(self, collection, batch_size=None):
+        """
+        Rebuild a collection without rewriting the live one: the documents
+        are dumped into a shadow collection, which is swapped in for the live
+        one once it's complete. Readers see the old documents until then, and
+        the new ones after, never a mixture, and the live collection's write
+        load is unchanged.
+
+        1. Every document is inserted into an empty shadow collection,
+           ``batch_size`` (by default ``CQRS_BULK_CHUNK_SIZE``) at a time,
+           with plain inserts rather than upserts.
+        2. The collection's declared indexes are built on the shadow (which
+           is quicker once it's full than while filling it).
+        3. The documents written to the live collection in the meantime are
+           dumped again into the shadow, until few enough are left to do
+           with writes held up (in this process), which is how the last of
+           them are done.
+        4. The shadow is renamed over the live collection, which is atomic.
+
+        Only writes made by this process are caught; if other processes
+        project to the collection meanwhile, check it afterwards with
+        ``cqrs_verify`` (see :mod:`cqrs.verify`), which fixes whatever they
+        did in the meantime. Returns the number of documents.
+        """
+        batch_size = batch_size or settings.CQRS_BULK_CHUNK_SIZE
+        shadow = _Renamed(collection, collection.name + self.shadow_suffix)
+        col = getattr(self.db, shadow.name)
+        col.drop()
+        log.info('Starting rebuild of collection %s', collection.name)
+        t0 = time.time()
+
+        with self._rebuild_lock:
+            self._captures[collection.name] = set()
+        try:
+            count = 0
+            docs = []
+            for doc_id, doc in dumped_docs(self, collection):
+                docs.append(self._prepare_doc(shadow, doc))
+                if len(docs) >= batch_size:
+                    col.insert(docs)
+                    count += len(docs)
+                    docs = []
+            if docs:
+                col.insert(docs)
+                count += len(docs)
+            self.ensure_indexes(shadow)
+
+            while True:
+                with self._rebuild_lock:
+                    doc_ids = self._captures[collection.name]
+                    self._captures[collection.name] = set()
+                    if len(doc_ids) <= batch_size:
+                        # Few enough to do with writes waiting.
+                        self._catch_up(shadow, doc_ids)
+                        col.rename(collection.name, dropTarget=True)
+                        break
+                self._catch_up(shadow, doc_ids)
+        finally:
+            with self._rebuild_lock:
+                del self._captures[collection.name]
+        self._replaced(collection)
+
+        log.info('Rebuild of collection %s completed in %.3fs (%d documents)',
+                 collection.name, time.time() - t0, count)
+        return count
+
+    def _replaced(self, collection):
+        """
+        Called once a collection has been swapped for a rebuilt one, for
+        mixins which remember documents (see :mod:`cqrs.cache`).
+        """
+
+    def _catch_up(self, shadow, doc_ids):
+        """Write documents to a shadow as they are now, or delete them."""
+        doc_ids = sorted(doc_ids)
+        present = set()
+        for chunk in chunks(doc_ids, settings.CQRS_BULK_CHUNK_SIZE):
+            present.update(shadow.queryset(prefetch=False).filter(
+                pk__in=chunk).values_list('pk', flat=True))
+        gone = [doc_id for doc_id in doc_ids if doc_id not in present]
+        if gone:
+            self.deleted_many(shadow, gone)
+        if present:
+            self._write_many(shadow, sorted(present), self.added_many)
+
+
+class MongoTypeCodeStore(object):
+    """
+    A type code store (see :mod:`cqrs.typecodes`) keeping the type table in a
+    Mongo collection, one document per type path, ``{'_id': path, 'code':
+    code}``, plus a counter document for allocating new codes.
+    """
+
+    counter_id = '__counter__'
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def load(self):
+        return dict((doc['_id'], doc['code']) for doc
+                    in self.collection.find({'code': {'$exists': True}}))
+
+    def allocate(self, type_path):
+        doc = self.collection.find_one({'_id': type_path})
+        if doc is not None:
+            return doc['code']
+
+        counter = self.collection.find_and_modify(
+            {'_id': self.counter_id}, {'$inc': {'seq': 1}},
+            upsert=True, new=True)
+        try:
+            self.collection.insert({'_id': type_path, 'code': counter['seq']})
+        except DuplicateKeyError:
+            # Another process allocated one for this type in the meantime;
+            # theirs stands, and the number we got is simply never used.
+            return self.collection.find_one({'_id': type_path})['code']
+        return counter['seq']
+
+
+class MongoKeyMapStore(object):
+    """
+    A generated key map store (see :mod:`cqrs.keymap`) keeping the maps in a
+    Mongo collection, one document per collection, ``{'_id': name, 'keys':
+    {long key: short key}, 'shorts': [short key, ...]}``.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def load(self, name):
+        doc = self.collection.find_one({'_id': name})
+        return dict(doc['keys']) if doc is not None else {}
+
+    def allocate(self, name, key):
+        field = 'keys.' + key
+        while True:
+            mapping = self.load(name)
+            if key in mapping:
+                return mapping[key]
+            short = next_short_key(mapping.values())
+            try:
+                # Only if nobody has mapped the key, or taken the short key,
+                # in the meantime.
+                doc = self.collection.find_and_modify(
+                    {'_id': name, field: {'$exists': False},
+                     'shorts': {'$ne': short}},
+                    {'$set': {field: short}, '$push': {'shorts': short}},
+                    upsert=True, new=True)
+            except DuplicateKeyError:
+                # Somebody had (so the upsert tried to insert it again); have
+                # another look.
+                continue
+            return doc['keys'][key]
+
+
+class MongoFanOutStore(object):
+    """
+    A fan-out job store (see :mod:`cqrs.fanout`) keeping the jobs in a Mongo
+    collection, so that they survive restarts and workers can pick them up.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def save(self, job):
+        self.collection.save(job)
+
+    def get(self, job_id):
+        return self.collection.find_one({'_id': job_id})
+
+    def delete(self, job_id):
+        self.collection.remove({'_id': job_id})
+
+    def unfinished(self):
+        return list(self.collection.find())
+
+
+class MongoWatermarkStore(object):
+    """
+    A change poller watermark store (see :mod:`cqrs.polling`) keeping them
+    in a Mongo collection, so that pollers carry on where they left off.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, name):
+        record = self.collection.find_one({'_id': name})
+        return record['watermark'] if record is not None else None
+
+    def save(self, name, watermark):
+        self.collection.save({'_id': name, 'watermark': watermark})
+
+
+class MongoInvalidationChannel(object):
+    """
+    A cache invalidation channel (see :mod:`cqrs.cache`) between processes,
+    by way of a capped collection in the Mongo database ``db`` (by default
+    ``CQRS_CACHE_INVALIDATION_COLLECTION_NAME``), which each subscriber tails
+    in a thread of its own::
+
+        class Backend(CachingBackendMixin, PolymorphicMongoIDBackend):
+            pass
+
+        backend = Backend(name='cached', db_name=settings.CQRS_MONGO_DB_NAME,
+                          invalidation_channel=MongoInvalidationChannel(
+                              mongodb.db))
+
+    Subscribers start from whatever is published after they subscribe. If
+    tailing fails, it's started again a second later, so an invalidation
+    may be missed then; the cache's TTL puts that right in the end.
+    """
+
+    #: The size of the capped collection, in bytes.
+    size = 1024 * 1024
+
+    retry_interval = 1.0
+
+    def __init__(self, db, name=None, size=None):
+        self.db = db
+        self.name = name or settings.CQRS_CACHE_INVALIDATION_COLLECTION_NAME
+        if size:
+            self.size = size
+        self._lock = threading.Lock()
+        self._collection = None
+
+    @property
+    def collection(self):
+        with self._lock:
+            if self._collection is None:
+                try:
+                    self.db.create_collection(self.name, capped=True,
+                                              size=self.size)
+                except CollectionInvalid:
+                    # It's there already.
+                    pass
+                self._collection = getattr(self.db, self.name)
+            return self._collection
+
+    def publish(self, name, doc_ids=None):
+        self.collection.insert({'collection': name, 'doc_ids': doc_ids})
+
+    def subscribe(self, callback):
+        thread = threading.Thread(target=self._tail, args=(callback,),
+                                  name='cache invalidation')
+        thread.daemon = True
+        thread.start()
+
+    def _tail(self, callback):
+        started, last = False, None
+        while True:
+            try:
+                if not started:
+                    # Only what's published from now on matters.
+                    latest = list(self.collection.find(fields=['_id'])
+                                  .sort('$natural', -1).limit(1))
+                    last = latest[0]['_id'] if latest else None
+                    started = True
+                query = {'_id': {'$gt': last}} if last is not None else {}
+                cursor = self.collection.find(query, tailable=True,
+                                              await_data=True)
+                while cursor.alive:
+                    for record in cursor:
+                        last = record['_id']
+                        callback(record['collection'], record['doc_ids'])
+            except PyMongoError:
+                log.exception('cache invalidation: tailing %s failed',
+                              self.name)
+            time.sleep(self.retry_interval)
 
 
 mongodb = PolymorphicMongoIDBackend(
@@ -24,3 +563,26 @@ mongodb = PolymorphicMongoIDBackend(
     db_name=settings.CQRS_MONGO_DB_NAME,
     connection_uri=settings.CQRS_MONGO_CONNECTION_URI
 )
+
+
+# Stores in the default database, for the CQRS_*_STORE settings. They're only
+# made when something first needs them.
+
+def type_code_store():
+    return MongoTypeCodeStore(
+        getattr(mongodb.db, settings.CQRS_TYPE_CODES_COLLECTION_NAME))
+
+
+def key_map_store():
+    return MongoKeyMapStore(
+        getattr(mongodb.db, settings.CQRS_KEY_MAPS_COLLECTION_NAME))
+
+
+def fanout_store():
+    return MongoFanOutStore(
+        getattr(mongodb.db, settings.CQRS_FANOUT_COLLECTION_NAME))
+
+
+def watermark_store():
+    return MongoWatermarkStore(
+        getattr(mongodb.db, settings.CQRS_WATERMARK_COLLECTION_NAME))
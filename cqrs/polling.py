@@ -0,0 +1,295 @@
+'''
+Change capture by polling the database, rather than by Django's signals.
+
+Signals only hear about what this process does through the ORM, one object at
+a time: raw SQL, other services writing to the same tables and
+``QuerySet.update`` elsewhere go unnoticed, and each save pays for its
+projection there and then. A :class:`ChangePoller` instead asks the database
+what has changed since it last looked, a batch at a time, and brings the
+documents of the changed objects up to date in every registered collection
+of their model (see :func:`cqrs.bulk.reconcile`)::
+
+    poller = ChangePoller(ColumnSource(Product, 'modified'))
+    poller.run()  # polls every CQRS_POLL_INTERVAL seconds, until stopped
+
+Only a collection's own model can be polled. Collections which embed the
+model as a related object aren't brought up to date: once a related object
+has been deleted, or moved to another parent, the database no longer says
+which documents it was in, so polling would leave them stale. (Use the
+signals, or a bulk operation, for those; or sync the collections now and
+then.) A poller for a model without a collection of its own raises
+:exc:`~django.core.exceptions.ImproperlyConfigured`.
+
+Where changes come from is up to the source:
+
+:class:`ColumnSource`
+    A column of the model itself which only ever goes up when a row is
+    written (an ``auto_now`` modification time, or a version counter). It
+    can't see deletions, and if writes can commit out of order, a row may
+    commit with a value below one already seen and be missed; a periodic
+    full sync covers both.
+
+:class:`ChangeLogSource`
+    A change log table (written to by triggers, say) with an autoincrementing
+    primary key and a column holding the id of the object changed. Deletions
+    are seen too: a document whose object has gone is deleted.
+
+How far a poller has got (its *watermark*) is kept in a store like the
+fan-out job store (:mod:`cqrs.fanout`): memory by default, and a Mongo
+collection with ``CQRS_WATERMARK_STORE = 'cqrs.mongo.watermark_store'``, so
+that a restarted poller carries on where it left off. A batch's watermark is
+only saved once its documents are written, so a crash means some changes are
+projected twice, never that they're missed.
+
+A backend used only with polling needn't listen to signals at all; give it
+``listen = False``, and neither signals nor bulk operations (see
+:mod:`cqrs.bulk`) are projected to it.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.utils.module_loading import import_by_path
+
+from . import settings
+from .bulk import affected_collections, reconcile
+
+
+log = logging.getLogger(__name__)
+
+
+class MemoryWatermarkStore(object):
+    """
+    A watermark store which lives only in memory, so pollers start from
+    scratch in a new process. A store needs :meth:`get` and :meth:`save`.
+    """
+
+    def __init__(self):
+        self._watermarks = {}
+
+    def get(self, name):
+        return self._watermarks.get(name)
+
+    def save(self, name, watermark):
+        self._watermarks[name] = watermark
+
+
+class Watermarks(object):
+    """The pollers' watermarks, kept in a swappable store."""
+
+    def __init__(self, store=None):
+        self._lock = threading.Lock()
+        self._store = store
+
+    def set_store(self, store):
+        """Switch to a different store (``None`` for the configured one)."""
+        with self._lock:
+            self._store = store
+
+    @property
+    def store(self):
+        with self._lock:
+            if self._store is None:
+                if settings.CQRS_WATERMARK_STORE:
+                    self._store = import_by_path(
+                        settings.CQRS_WATERMARK_STORE)()
+                else:
+                    self._store = MemoryWatermarkStore()
+            return self._store
+
+    def get(self, name):
+        return self.store.get(name)
+
+    def save(self, name, watermark):
+        self.store.save(name, watermark)
+
+
+#: The watermark store used by the pollers.
+watermarks = Watermarks()
+
+
+class ColumnSource(object):
+    """
+    Changes to ``model`` found by an ever increasing ``column`` (see
+    :mod:`cqrs.polling`). Its watermark is the last ``[value, pk]`` seen; the
+    primary key breaks ties between rows with the same value.
+
+    Dates and times are kept in the watermark as ISO 8601 strings (with
+    their time zone, if they have one), so that it comes back from a store
+    exactly as it went in: Mongo, for one, would keep a datetime only to the
+    millisecond, and without its time zone.
+    """
+
+    def __init__(self, model, column='modified'):
+        self.model = model
+        self.column = column
+        self.field = model._meta.get_field(column)
+        self.name = '{}.{}'.format(model._meta.db_table, column)
+
+    def changes(self, watermark, limit):
+        """
+        Get up to ``limit`` of the primary keys changed since ``watermark``
+        (``None`` for the beginning), and the new watermark.
+        """
+        queryset = self.model._base_manager.all()
+        if watermark is not None:
+            value, pk = watermark
+            value = self.field.to_python(value)
+            queryset = queryset.filter(
+                Q(**{'{}__gt'.format(self.column): value})
+                | Q(**{self.column: value, 'pk__gt': pk}))
+        rows = list(queryset.order_by(self.column, 'pk')
+                    .values_list(self.column, 'pk')[:limit])
+        if not rows:
+            return [], watermark
+        value, pk = rows[-1]
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        return [pk for _, pk in rows], [value, pk]
+
+
+class ChangeLogSource(object):
+    """
+    Changes to ``model`` recorded in the change log model ``log_model``, in
+    its ``object_field`` (see :mod:`cqrs.polling`). Its watermark is the last
+    log entry's primary key.
+    """
+
+    def __init__(self, model, log_model, object_field='object_id'):
+        self.model = model
+        self.log_model = log_model
+        self.object_field = object_field
+        self.name = '{}.{}'.format(log_model._meta.db_table, object_field)
+
+    def changes(self, watermark, limit):
+        queryset = self.log_model._base_manager.all()
+        if watermark is not None:
+            queryset = queryset.filter(pk__gt=watermark)
+        rows = list(queryset.order_by('pk')
+                    .values_list('pk', self.object_field)[:limit])
+        if not rows:
+            return [], watermark
+        return [pk for seq, pk in rows], rows[-1][0]
+
+
+class ChangePoller(object):
+    """
+    Polls a source (:class:`ColumnSource` or :class:`ChangeLogSource`) for
+    changes and projects them to the collections of its model in the
+    backends named (by default, all of them).
+
+    ``stats`` counts the polls, the changes and documents written, and the
+    time spent on them; :meth:`report` gives the throughput.
+    """
+
+    def __init__(self, source, batch_size=None, interval=None,
+                 backend_names=None, name=None):
+        self.source = source
+        self.batch_size = batch_size or settings.CQRS_BULK_CHUNK_SIZE
+        self.interval = (settings.CQRS_POLL_INTERVAL if interval is None
+                         else interval)
+        self.backend_names = backend_names
+        self.name = name or source.name
+        self._stop = threading.Event()
+        self.stats = {'polls': 0, 'changes': 0, 'documents': 0,
+                      'seconds': 0.0}
+
+    def collections(self):
+        """
+        Get ``(backend, collection)`` for each collection of the source's
+        model (or of a class in its hierarchy).
+
+        :raises ImproperlyConfigured: if there aren't any
+        """
+        found = [(backend, collection) for backend, collection, filter_path
+                 in affected_collections(self.source.model, listening=False)
+                 if filter_path is None and (
+                     self.backend_names is None
+                     or backend.backend_name in self.backend_names)]
+        if not found:
+            raise ImproperlyConfigured(
+                'poll {}: {} has no collections of its own; only a '
+                "collection's own model can be polled".format(
+                    self.name, self.source.model.__name__))
+        return found
+
+    def _doc_ids(self, collection, pks):
+        model = self.source.model
+        if issubclass(model, collection.model):
+            # reconcile deletes the documents of those which have gone.
+            return set(pks)
+        # A collection of a subclass: those of the objects which are in it,
+        # and those which have gone, which might have been.
+        existing = set(model._base_manager.filter(pk__in=pks)
+                       .values_list('pk', flat=True))
+        return (set(pks) - existing) | set(
+            collection.queryset(prefetch=False).filter(pk__in=pks)
+            .values_list('pk', flat=True))
+
+    def poll(self):
+        """
+        Project one batch of changes, if there are any, returning how many
+        there were.
+        """
+        t0 = time.time()
+        pks, watermark = self.source.changes(watermarks.get(self.name),
+                                             self.batch_size)
+        documents = 0
+        if pks:
+            for backend, collection in self.collections():
+                documents += reconcile(
+                    backend, collection,
+                    collection.map_affected(self._doc_ids(collection, pks)))
+            watermarks.save(self.name, watermark)
+        self.stats['polls'] += 1
+        self.stats['changes'] += len(pks)
+        self.stats['documents'] += documents
+        self.stats['seconds'] += time.time() - t0
+        if pks:
+            log.debug('poll %s: %d changes, %d documents', self.name,
+                      len(pks), documents)
+        return len(pks)
+
+    def poll_all(self):
+        """Poll until there's nothing new, returning the number of changes."""
+        total = 0
+        while True:
+            changes = self.poll()
+            total += changes
+            if changes < self.batch_size:
+                return total
+
+    def run(self):
+        """
+        Poll until :meth:`stop` is called, waiting ``interval`` seconds
+        whenever it has caught up.
+        """
+        self._stop.clear()
+        while not self._stop.is_set():
+            try:
+                self.poll_all()
+            except Exception:
+                # It'll be tried again next time round.
+                log.exception('poll %s failed', self.name)
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+    def report(self):
+        """
+        Report the totals in ``stats``, with the changes and documents
+        handled per second spent polling.
+        """
+        report = dict(self.stats)
+        seconds = self.stats['seconds']
+        report['changes_per_second'] = (
+            self.stats['changes'] / seconds if seconds else 0.0)
+        report['documents_per_second'] = (
+            self.stats['documents'] / seconds if seconds else 0.0)
+        return report
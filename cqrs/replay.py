@@ -0,0 +1,286 @@
+'''
+Rebuilding read models by replaying recorded changes.
+
+Rebuilding a projection from the database means serializing every object
+again, which for a big collection takes hours. If the changes written to a
+backend have been recorded (by a backend with :class:`RecordingBackendMixin`,
+or anything else producing the same :class:`Action` events), they can be
+played back into another backend instead, and that's bounded by I/O rather
+than serialization::
+
+    stats = replay('/var/lib/myproject/mongo.events', backend)
+    print stats  # 1204332 events, 88210 documents in 9.8s (122891 events/s)
+
+Events are first collapsed down to each document's final state (later
+changes merged over earlier ones; a deletion wiping out what came before),
+so each document is written just once, then applied in batches with the
+backend's ``added_many`` and ``deleted_many``. A document whose events only
+ever change it (the events starting part way through its life) is known only
+in part, so what they set is written with ``changed_many``, leaving the rest
+of the document as the backend has it.
+
+An event file holds one JSON object per line, with the same fields as
+:class:`Action` (``collection`` being the collection's name); values JSON
+can't represent, like dates, use MongoDB's extended JSON.
+'''
+
+from __future__ import absolute_import
+
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from bson import json_util
+
+
+log = logging.getLogger(__name__)
+
+ADD = 'ADD'
+CHANGE = 'CHANGE'
+DELETE = 'DELETE'
+
+#: A change to a document, as a backend sees it.
+Action = namedtuple('Action', ('action', 'collection', 'doc_id', 'doc'))
+
+
+class EventWriter(object):
+    """
+    Appends :class:`Action` events to an event file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._file = open(path, 'a')
+
+    @contextmanager
+    def paused(self):
+        """
+        Don't write anything in this thread for the duration (for when
+        something has already been written another way).
+        """
+        self._local.paused = getattr(self._local, 'paused', 0) + 1
+        try:
+            yield
+        finally:
+            self._local.paused -= 1
+
+    def write(self, action):
+        if getattr(self._local, 'paused', 0):
+            return
+        record = {
+            'action': action.action,
+            # Collection objects are written as their name.
+            'collection': getattr(action.collection, 'name',
+                                  action.collection),
+            'doc_id': action.doc_id,
+            'doc': action.doc,
+        }
+        line = json.dumps(record, default=json_util.default) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_events(path):
+    """Generate the :class:`Action` events in an event file."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line, object_hook=json_util.object_hook)
+                yield Action(record['action'], record['collection'],
+                             record['doc_id'], record.get('doc'))
+
+
+class Changes(dict):
+    """
+    The fields set by changes to a document whose state before them isn't
+    known, as :func:`collapse` gives them.
+    """
+
+
+def collapse(events):
+    """
+    Collapse a sequence of events to the final state of each document: a
+    dictionary of ``(collection name, doc id)`` to the document, ``None`` if
+    it has been deleted, or :class:`Changes` if it has only been changed.
+    """
+    final = {}
+    for action, collection, doc_id, doc in events:
+        key = getattr(collection, 'name', collection), doc_id
+        if action == DELETE:
+            final[key] = None
+        elif action == CHANGE and key not in final:
+            final[key] = Changes(doc)
+        elif action == CHANGE and final[key] is not None:
+            # Like the Mongo backend's $set: top level fields are replaced.
+            merged = type(final[key])(final[key])
+            merged.update(doc)
+            final[key] = merged
+        else:
+            final[key] = dict(doc)
+    return final
+
+
+class ReplayStats(object):
+    """What a replay did, and how quickly."""
+
+    def __init__(self):
+        self.events = 0
+        self.written = 0
+        self.deleted = 0
+        self.skipped = 0
+        self.seconds = 0.0
+
+    @property
+    def documents(self):
+        return self.written + self.deleted
+
+    @property
+    def events_per_second(self):
+        return self.events / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return ('{} events, {} documents in {:.1f}s ({:.0f} events/s)'
+                .format(self.events, self.documents, self.seconds,
+                        self.events_per_second))
+
+
+def _batches(items, batch_size):
+    for i in xrange(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def replay(events, backend, batch_size=1000):
+    """
+    Apply recorded events to a backend, collapsed and in batches.
+
+    :param events: an event file path, or a sequence of :class:`Action`
+    :param backend: the backend to write to; its collections are looked up
+                    by name (events for ones it doesn't have are skipped)
+    :returns: a :class:`ReplayStats`
+    """
+    stats = ReplayStats()
+    start = time.time()
+    if isinstance(events, basestring):
+        events = read_events(events)
+
+    def counted(events):
+        for event in events:
+            stats.events += 1
+            yield event
+
+    # Collection name: (whole documents, changes, deletions)
+    by_collection = {}
+    for (name, doc_id), doc in collapse(counted(events)).items():
+        kind = 2 if doc is None else 1 if isinstance(doc, Changes) else 0
+        by_collection.setdefault(name, ([], [], []))[kind].append(
+            (doc_id, doc))
+
+    for name, (docs, changes, deletions) in sorted(by_collection.items()):
+        collection = backend.collections.get(name)
+        if collection is None:
+            count = len(docs) + len(changes) + len(deletions)
+            log.warning('replay: no collection %s; skipping %d documents',
+                        name, count)
+            stats.skipped += count
+            continue
+        for batch in _batches(docs, batch_size):
+            backend.added_many(collection, batch)
+            stats.written += len(batch)
+        for batch in _batches(changes, batch_size):
+            backend.changed_many(
+                collection,
+                [(doc_id, dict(doc)) for doc_id, doc in batch])
+            stats.written += len(batch)
+        for batch in _batches(deletions, batch_size):
+            backend.deleted_many(collection,
+                                 [doc_id for doc_id, _ in batch])
+            stats.deleted += len(batch)
+
+    stats.seconds = time.time() - start
+    log.info('replay: %s', stats)
+    return stats
+
+
+class RecordingBackendMixin(object):
+    """
+    A backend mixin recording every document written to it in an event file,
+    for :func:`replay`. Give it an ``events_path``, as a class attribute or
+    keyword argument.
+    """
+
+    events_path = None
+
+    def __init__(self, *args, **kwargs):
+        events_path = kwargs.pop('events_path', None) or self.events_path
+        self.event_writer = EventWriter(events_path)
+        super(RecordingBackendMixin, self).__init__(*args, **kwargs)
+
+    # The backend may change the document as it writes it, so it's recorded
+    # first. (And where one method does its work with another, e.g. the
+    # default added_many, recording is paused so it's only recorded once.)
+
+    def added(self, collection, doc_id, doc):
+        self.event_writer.write(Action(ADD, collection, doc_id, doc))
+        super(RecordingBackendMixin, self).added(collection, doc_id, doc)
+
+    def changed(self, collection, doc_id, doc):
+        self.event_writer.write(Action(CHANGE, collection, doc_id, doc))
+        super(RecordingBackendMixin, self).changed(collection, doc_id, doc)
+
+    def deleted(self, collection, doc_id):
+        self.event_writer.write(Action(DELETE, collection, doc_id, None))
+        super(RecordingBackendMixin, self).deleted(collection, doc_id)
+
+    def added_many(self, collection, docs):
+        for doc_id, doc in docs:
+            self.event_writer.write(Action(ADD, collection, doc_id, doc))
+        with self.event_writer.paused():
+            super(RecordingBackendMixin, self).added_many(collection, docs)
+
+    def changed_many(self, collection, docs):
+        for doc_id, doc in docs:
+            self.event_writer.write(Action(CHANGE, collection, doc_id, doc))
+        with self.event_writer.paused():
+            super(RecordingBackendMixin, self).changed_many(collection, docs)
+
+    def deleted_many(self, collection, doc_ids):
+        for doc_id in doc_ids:
+            self.event_writer.write(Action(DELETE, collection, doc_id, None))
+        with self.event_writer.paused():
+            super(RecordingBackendMixin, self).deleted_many(collection,
+                                                            doc_ids)
+
+    # An embedded array update (see cqrs.embedded) isn't a whole document, so
+    # the document is dumped to record it; recording costs some of what the
+    # update saved.
+
+    def _record_embedded(self, collection, doc_id):
+        self.event_writer.write(Action(CHANGE, collection, doc_id,
+                                       collection.dump_id(doc_id)))
+
+    def embedded_added(self, collection, doc_id, *args):
+        self._record_embedded(collection, doc_id)
+        with self.event_writer.paused():
+            super(RecordingBackendMixin, self).embedded_added(
+                collection, doc_id, *args)
+
+    def embedded_changed(self, collection, doc_id, *args):
+        self._record_embedded(collection, doc_id)
+        with self.event_writer.paused():
+            super(RecordingBackendMixin, self).embedded_changed(
+                collection, doc_id, *args)
+
+    def embedded_removed(self, collection, doc_id, *args):
+        self._record_embedded(collection, doc_id)
+        with self.event_writer.paused():
+            super(RecordingBackendMixin, self).embedded_removed(
+                collection, doc_id, *args)
@@ -4,12 +4,20 @@ CQRS serializer bases.
 See :mod:`cqrs` docs for a full explanation.
 '''
 
-from django.core.exceptions import ImproperlyConfigured
+import hashlib
+import json
+from decimal import Decimal
+
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.paginator import Page
 from rest_framework import serializers
-from rest_framework.fields import CharField
+from rest_framework.fields import CharField, get_component, is_simple_callable
 
+from . import settings
+from .memo import memoized, memoized_field
 from .models import CQRSModel, CQRSPolymorphicModel
 from .register import Register, RegisterableMeta
+from .typecodes import type_codes
 
 
 def cqrs_base(model):
@@ -105,6 +113,17 @@ class CQRSSerializerMeta(serializers.SerializerMetaclass, RegisterableMeta):
             "Expected {!r} to be in {!r}'s bases, but found {!r}".format(
                 expected_base, cls, cls.__bases__)
 
+        # cached_fields accumulate down the inheritance tree, as the fields
+        # themselves do.
+        cls._cached_fields = frozenset(
+            field_name for klass in cls.__mro__
+            for field_name in klass.__dict__.get('cached_fields', ()))
+
+        if issubclass(cls.Meta.model, CQRSPolymorphicModel):
+            # Work out the type ancestry now, once, rather than for every
+            # object serialized; it's a property of the class, after all.
+            cls._type_ancestry = tuple(cls.Meta.model._type_ancestry())
+
 
 class SerializerRegister(Register):
 
@@ -164,6 +183,173 @@ class CQRSSerializer(serializers.ModelSerializer):
 
     type = CharField(source='__class__.__name__', read_only=True)
 
+    # Read only fields whose values may be worked out just once per object
+    # (version) in a batch, and the model attribute telling versions apart
+    # (see cqrs.memo).
+    cached_fields = ()
+    cache_version = None
+    _cached_fields = frozenset()
+
+    # The field names to serialize by default (see to_native), for all of
+    # them.
+    requested_fields = None
+
+    # (serializer class, its instance's field names, requested field names):
+    # the names of the fields to serialize, in order. (An instance may have
+    # dropped some of the class's fields.) Cleared if it gets too big, as the
+    # requests may come from clients.
+    _field_subsets = {}
+    _field_subsets_max = 1000
+
+    # serializer class: fingerprint (see fingerprint)
+    _fingerprints = {}
+
+    def __init__(self, *args, **kwargs):
+        requested_fields = kwargs.pop('requested_fields', None)
+        super(CQRSSerializer, self).__init__(*args, **kwargs)
+        if requested_fields is not None:
+            self.requested_fields = requested_fields
+
+    @classmethod
+    def fingerprint(cls):
+        """
+        Get a digest of the serializer's resolved field layout (see
+        :func:`serializer_layout`), which changes when what it puts in a
+        document does, and not otherwise; it's the same from one process (and
+        deploy) to the next.
+        """
+        fingerprints = CQRSSerializer._fingerprints
+        if cls not in fingerprints:
+            fingerprints[cls] = hashlib.md5(json.dumps(
+                serializer_layout(cls()))).hexdigest()[:12]
+        return fingerprints[cls]
+
+    def to_native(self, obj, fields=None):
+        '''
+        Serialize an object. If ``fields`` (or failing that, the
+        ``requested_fields`` the serializer was created with) is given, only
+        the fields of those names are serialized; the rest aren't so much as
+        looked at. Names the serializer doesn't have are ignored, and nested
+        serializers are serialized in full.
+        '''
+        if fields is None:
+            fields = self.requested_fields
+        if self.parent is None or fields is not None:
+            return self._native(obj, fields)
+        # Nested, so it may well be nested in every document of the batch
+        # (see cqrs.memo).
+        return memoized(self, 'native', obj, lambda: self._native(obj))
+
+    def _fields_for(self, fields):
+        """Get the ``(name, field)`` pairs to serialize for ``fields``."""
+        if fields is None:
+            return self.fields.items()
+        subsets = CQRSSerializer._field_subsets
+        requested = frozenset(fields)
+        key = type(self), tuple(self.fields), requested
+        names = subsets.get(key)
+        if names is None:
+            if len(subsets) >= self._field_subsets_max:
+                subsets.clear()
+            names = subsets[key] = [name for name in self.fields
+                                    if name in requested]
+        return [(name, self.fields[name]) for name in names]
+
+    def _native(self, obj, fields=None):
+        # This is BaseSerializer.to_native, with the values coming from
+        # _field_value, and just the fields asked for.
+        ret = self._dict_class()
+        ret.fields = self._dict_class()
+
+        for field_name, field in self._fields_for(fields):
+            if field.read_only and obj is None:
+                continue
+            field.initialize(parent=self, field_name=field_name)
+            key = self.get_field_key(field_name)
+            value = self._field_value(obj, field_name, field)
+            method = getattr(self, 'transform_%s' % field_name, None)
+            if callable(method):
+                value = method(obj, value)
+            if not getattr(field, 'write_only', False):
+                ret[key] = value
+            ret.fields[key] = self.augment_field(field, field_name, key, value)
+
+        return ret
+
+    def _field_value(self, obj, field_name, field):
+        if field_name in self._cached_fields:
+            return memoized_field(
+                self, field_name, obj,
+                lambda: field.field_to_native(obj, field_name))
+        return field.field_to_native(obj, field_name)
+
+    def to_document(self, obj):
+        """
+        Serialize an object straight into a document for a backend to store:
+        a plain dictionary, keyed by ``_id`` rather than ``id``, with values
+        converted as :func:`document_value` does.
+
+        This is what ``data`` would give (once converted), without DRF's
+        ordered dictionaries and field metadata, or a second pass over it all
+        to convert it; nested CQRS serializers are done the same way.
+        """
+        doc = self._document_native(obj)
+        doc['_id'] = doc.pop('id')
+        return doc
+
+    def _document_native(self, obj):
+        # This is BaseSerializer.to_native, less the bits that we don't want.
+        doc = {}
+        for field_name, field in self.fields.items():
+            if field.read_only and obj is None:
+                continue
+            field.initialize(parent=self, field_name=field_name)
+            if isinstance(field, CQRSSerializer):
+                # Its output is a document already.
+                value = field._document_field_to_native(obj, field_name)
+            else:
+                value = document_value(
+                    self._field_value(obj, field_name, field))
+            method = getattr(self, 'transform_%s' % field_name, None)
+            if callable(method):
+                value = method(obj, value)
+            if not getattr(field, 'write_only', False):
+                doc[self.get_field_key(field_name)] = value
+        return doc
+
+    def _document_field_to_native(self, obj, field_name):
+        # And this is BaseSerializer.field_to_native, for when it's nested.
+        if self.write_only:
+            return None
+        if self.source == '*':
+            return self._nested_document(obj)
+
+        try:
+            value = obj
+            for component in (self.source or field_name).split('.'):
+                if value is None:
+                    break
+                value = get_component(value, component)
+        except ObjectDoesNotExist:
+            return None
+
+        if is_simple_callable(getattr(value, 'all', None)):
+            return [self._nested_document(item) for item in value.all()]
+        if value is None:
+            return None
+        if self.many is not None:
+            many = self.many
+        else:
+            many = hasattr(value, '__iter__') and not isinstance(
+                value, (Page, dict, unicode))
+        if many:
+            return [self._nested_document(item) for item in value]
+        return self._nested_document(value)
+
+    def _nested_document(self, obj):
+        return memoized(self, 'document', obj,
+                        lambda: self._document_native(obj))
+
     def get_default_fields(self):
         """
         Return the PARTIAL set of default fields for the object, as a dict.
@@ -254,17 +440,91 @@ class CQRSSerializer(serializers.ModelSerializer):
 SerializerRegister.value_type = CQRSSerializer
 
 
+def document_value(value):
+    """
+    Convert a serialized value into something a backend can store as it is:
+    DRF's dictionaries become plain ones, and decimals strings (as DRF's JSON
+    encoder does).
+    """
+    if isinstance(value, dict):
+        return dict((key, document_value(item))
+                    for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [document_value(item) for item in value]
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def _field_layout(field):
+    layout = ['{}.{}'.format(type(field).__module__, type(field).__name__),
+              field.source, field.read_only,
+              getattr(field, 'write_only', False),
+              getattr(field, 'many', None), getattr(field, 'format', None),
+              getattr(field, 'method_name', None)]
+    if isinstance(field, serializers.BaseSerializer):
+        # Nested; what it puts in the document counts too.
+        layout.append(serializer_layout(field))
+    return layout
+
+
+def serializer_layout(serializer):
+    """
+    Describe what a serializer puts in a document, as a list of strings and
+    the like: each field's key, class, source, options and (if it's nested)
+    layout, and whether the serializer transforms it. What the fields and
+    transforms do with the values isn't covered.
+    """
+    layout = [[serializer.get_field_key(field_name), _field_layout(field),
+               callable(getattr(serializer, 'transform_' + field_name, None))]
+              for field_name, field in serializer.fields.items()]
+    layout.append(getattr(serializer, 'use_type_codes', False))
+    return layout
+
+
+def to_plain_document(data):
+    """
+    Make a backend document (see :meth:`CQRSSerializer.to_document`) out of
+    ordinary serializer output.
+    """
+    doc = document_value(data)
+    doc['_id'] = doc.pop('id')
+    return doc
+
+
+class TypeField(CharField):
+    """
+    The polymorphic ``type`` field: the model's type path, or, if the
+    serializer has ``use_type_codes`` on, its compact integer code (see
+    :mod:`cqrs.typecodes`).
+    """
+
+    def to_native(self, value):
+        if getattr(self.parent, 'use_type_codes', False):
+            return type_codes.code_for(value)
+        return super(TypeField, self).to_native(value)
+
+
 class CQRSPolymorphicSerializer(CQRSSerializer):
     '''
     Serializer for Polymorphic Model
     '''
 
-    type = CharField(source='_type_path', read_only=True)
+    type = TypeField(source='_type_path', read_only=True)
+
+    # Emit integer type codes instead of type paths. Being a plain class
+    # attribute (unlike Meta), setting it on a root serializer carries through
+    # to all the serializers below it.
+    use_type_codes = settings.CQRS_TYPE_CODES
+
+    # The type paths of the model and its concrete polymorphic ancestors (see
+    # CQRSPolymorphicModel._type_ancestry); set by the metaclass.
+    _type_ancestry = ()
 
     class Meta:
         model = CQRSPolymorphicModel
 
-    def to_native(self, obj):
+    def _native(self, obj, fields=None):
         '''
         Because OfferAspect is Polymorphic and don't know ahead of time
         which downcast model we'll be dealing with
@@ -273,10 +533,36 @@ class CQRSPolymorphicSerializer(CQRSSerializer):
         if CQRSSerializerMeta._register[type(obj)] == type(self):
             # We have the correct serializer class.
             # Rejoice and be exceeding glad.
-            return super(CQRSPolymorphicSerializer, self).to_native(obj)
+            return super(CQRSPolymorphicSerializer, self)._native(obj, fields)
         # Otherwise, do this quick dodge where we effectively substitute self
-        # for a different (more precise) serializer
-        return CQRSSerializerMeta._register.instances[type(obj)].to_native(obj)
+        # for a different (more precise) serializer. (The fields asked for go
+        # along too, as the subtype's fields are a superset of ours.)
+        return CQRSSerializerMeta._register.instances[type(obj)].to_native(
+            obj, fields)
+
+    def _document_native(self, obj):
+        # The same dodge as to_native.
+        if CQRSSerializerMeta._register[type(obj)] == type(self):
+            return super(CQRSPolymorphicSerializer,
+                         self)._document_native(obj)
+        return CQRSSerializerMeta._register.instances[
+            type(obj)]._document_native(obj)
+
+    def _model_class_for_type(self, type_):
+        '''
+        Get the model class for a ``type`` value, which may be a type path or
+        a type code (in which case it may be a string of digits, too, if it
+        came in through a form).
+
+        :raises: :exc:`django.core.exceptions.ImproperlyConfigured` or
+                 :exc:`TypeError` for illegal type paths, :exc:`KeyError` for
+                 unknown type codes.
+        '''
+        if isinstance(type_, basestring) and type_.isdigit():
+            type_ = int(type_)
+        if isinstance(type_, (int, long)) and not isinstance(type_, bool):
+            type_ = type_codes.path_for(type_)
+        return self.opts.model._model_class_from_type_path(type_)
 
     def from_native(self, data, files=None, polymorphism_resolved=False):
         """
@@ -307,10 +593,10 @@ class CQRSPolymorphicSerializer(CQRSSerializer):
             return
 
         try:
-            model_class = self.opts.model._model_class_from_type_path(data['type'])
+            model_class = self._model_class_for_type(data['type'])
             # Now get the correct serializer for that model class.
             serializer = CQRSSerializerMeta._register.instances[model_class]
-        except (ImproperlyConfigured, TypeError):
+        except (ImproperlyConfigured, TypeError, KeyError):
             self._errors['type'] = ['Invalid type {!r}.'.format(data['type'])]
             return
 
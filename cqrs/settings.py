@@ -10,3 +10,71 @@ CQRS_MONGO_DB_NAME = getattr(
 
 CQRS_MONGO_CONNECTION_URI = getattr(
     settings, "CQRS_MONGO_URI", "mongodb://localhost")
+
+# Store compact integer codes rather than type paths in polymorphic documents'
+# ``type`` (see cqrs.typecodes); serializers can also turn this on themselves.
+CQRS_TYPE_CODES = getattr(settings, "CQRS_TYPE_CODES", False)
+
+CQRS_TYPE_CODES_COLLECTION_NAME = getattr(
+    settings, "CQRS_TYPE_CODES_COLLECTION_NAME", "type_codes")
+
+# Dotted path of a function giving the store to keep the type table in (see
+# cqrs.typecodes), e.g. "cqrs.mongo.type_code_store"; None keeps it in memory,
+# which Mongo backends refuse.
+CQRS_TYPE_CODE_STORE = getattr(settings, "CQRS_TYPE_CODE_STORE", None)
+
+# Store the fingerprint of the serializer which made each polymorphic document
+# in its ``_fp``, so that a change to a serializer only means rebuilding the
+# documents it made (see cqrs.fingerprints); collections can turn this on
+# themselves, too.
+CQRS_FINGERPRINTS = getattr(settings, "CQRS_FINGERPRINTS", False)
+
+# Dotted path of a function to hand fan-out job ids to (see cqrs.fanout);
+# None runs fan-outs in the process which triggered them.
+CQRS_FANOUT_EXECUTOR = getattr(settings, "CQRS_FANOUT_EXECUTOR", None)
+
+CQRS_FANOUT_COLLECTION_NAME = getattr(
+    settings, "CQRS_FANOUT_COLLECTION_NAME", "fanout_jobs")
+
+# Dotted path of a function giving the store to keep generated key maps in
+# (see cqrs.keymap), e.g. "cqrs.mongo.key_map_store"; None keeps them in
+# memory, which Mongo backends refuse.
+CQRS_KEY_MAP_STORE = getattr(settings, "CQRS_KEY_MAP_STORE", None)
+
+CQRS_KEY_MAPS_COLLECTION_NAME = getattr(
+    settings, "CQRS_KEY_MAPS_COLLECTION_NAME", "key_maps")
+
+# Dotted path of a function giving the store to keep fan-out jobs in, e.g.
+# "cqrs.mongo.fanout_store"; None keeps them in memory.
+CQRS_FANOUT_STORE = getattr(settings, "CQRS_FANOUT_STORE", None)
+
+# The most nested representations remembered while dumping a batch of
+# documents (see cqrs.memo).
+CQRS_MEMO_SIZE = getattr(settings, "CQRS_MEMO_SIZE", 10000)
+
+# The most documents dumped and written at a time when projecting bulk
+# operations (see cqrs.bulk).
+CQRS_BULK_CHUNK_SIZE = getattr(settings, "CQRS_BULK_CHUNK_SIZE", 500)
+
+# How many seconds a change poller waits once it has caught up (see
+# cqrs.polling).
+CQRS_POLL_INTERVAL = getattr(settings, "CQRS_POLL_INTERVAL", 1.0)
+
+CQRS_WATERMARK_COLLECTION_NAME = getattr(
+    settings, "CQRS_WATERMARK_COLLECTION_NAME", "poll_watermarks")
+
+# Dotted path of a function giving the store to keep change pollers'
+# watermarks in, e.g. "cqrs.mongo.watermark_store"; None keeps them in memory.
+CQRS_WATERMARK_STORE = getattr(settings, "CQRS_WATERMARK_STORE", None)
+
+# How many ranges of ids the read model verifier splits a range into when
+# its digests don't match (see cqrs.verify).
+CQRS_VERIFY_BRANCHING = getattr(settings, "CQRS_VERIFY_BRANCHING", 16)
+
+# The most documents a caching backend keeps, and for how many seconds (see
+# cqrs.cache).
+CQRS_CACHE_SIZE = getattr(settings, "CQRS_CACHE_SIZE", 10000)
+CQRS_CACHE_TTL = getattr(settings, "CQRS_CACHE_TTL", 60.0)
+
+CQRS_CACHE_INVALIDATION_COLLECTION_NAME = getattr(
+    settings, "CQRS_CACHE_INVALIDATION_COLLECTION_NAME", "cache_invalidations")
@@ -0,0 +1,252 @@
+'''
+A projection backend keeping documents in SQLite, for when there's no Mongo
+to be had: edge deployments, CI, and load testing on a laptop.
+
+Each collection gets a table of its own, named after the collection, with the
+document's id as the primary key and the document as JSON::
+
+    CREATE TABLE "shop_product" (_id PRIMARY KEY, doc TEXT NOT NULL)
+
+Writes go through ``executemany`` inside a transaction, a batch of up to
+``batch_size`` documents at a time, so bulk loading (:func:`cqrs.replay.replay`
+or :meth:`SQLiteBackend.sync_collection`) costs a handful of commits rather
+than one per document. With the default ``path`` of ``':memory:'`` nothing
+touches the disk at all, which makes it a fair way of measuring projection
+throughput on its own, without any network in the way::
+
+    backend = PolymorphicSQLiteBackend(name='bench')
+    backend.register(ProductCollection())
+    print replay('/var/lib/myproject/mongo.events', backend)
+
+Changes behave as they do with the Mongo backends: a changed document's top
+level fields are merged over the stored ones.
+'''
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from denormalize.backend.base import BackendBase
+
+from .backend import PolymorphicBackendBase
+from .memo import batch_memo
+
+
+log = logging.getLogger(__name__)
+
+
+def _batches(items, batch_size):
+    items = list(items)
+    for i in xrange(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+class SQLiteBackend(BackendBase):
+    """
+    A backend storing documents in the SQLite database at ``path`` (a file,
+    or ``':memory:'``).
+    """
+
+    path = ':memory:'
+    batch_size = 500
+
+    # Documents come ready to store, with no DRF structures to walk.
+    plain_documents = True
+
+    def __init__(self, name=None, path=None, batch_size=None):
+        super(SQLiteBackend, self).__init__(name=name)
+        if path:
+            self.path = path
+        if batch_size:
+            self.batch_size = batch_size
+        # One connection, shared between threads (which SQLite can do, as
+        # long as they take turns).
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._tables = set()
+
+    def register(self, collection):
+        super(SQLiteBackend, self).register(collection)
+        self._ensure_table(collection)
+
+    def _table(self, collection):
+        return '"{}"'.format(collection.name.replace('"', '""'))
+
+    def _ensure_table(self, collection):
+        if collection.name in self._tables:
+            return
+        with self._lock:
+            with self.connection:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS {} '
+                    '(_id PRIMARY KEY, doc TEXT NOT NULL)'
+                    .format(self._table(collection)))
+            self._tables.add(collection.name)
+
+    def _prepare_doc(self, doc):
+        """
+        Turn a dumped document into what is stored: ``id`` becomes ``_id``
+        (if it's not a plain document, which has that already).
+        """
+        doc = dict(doc)
+        if 'id' in doc:
+            doc['_id'] = doc.pop('id')
+        return doc
+
+    def _encode(self, doc):
+        return json.dumps(doc, cls=JSONEncoder, separators=(',', ':'))
+
+    def _load(self, collection, doc_ids):
+        """Get the stored documents with the given ids, by id."""
+        docs = {}
+        for batch in _batches(doc_ids, self.batch_size):
+            cursor = self.connection.execute(
+                'SELECT _id, doc FROM {} WHERE _id IN ({})'.format(
+                    self._table(collection), ','.join('?' * len(batch))),
+                batch)
+            docs.update((doc_id, json.loads(doc)) for doc_id, doc in cursor)
+        return docs
+
+    def _write(self, collection, rows):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO {} (_id, doc) VALUES (?, ?)'
+            .format(self._table(collection)), rows)
+
+    def added(self, collection, doc_id, doc):
+        log.debug('added: %s %s', collection.name, doc_id)
+        self.added_many(collection, [(doc_id, doc)])
+
+    def changed(self, collection, doc_id, doc):
+        log.debug('changed: %s %s', collection.name, doc_id)
+        self.changed_many(collection, [(doc_id, doc)])
+
+    def deleted(self, collection, doc_id):
+        log.debug('deleted: %s %s', collection.name, doc_id)
+        self.deleted_many(collection, [doc_id])
+
+    def added_many(self, collection, docs):
+        self._ensure_table(collection)
+        with self._lock:
+            for batch in _batches(docs, self.batch_size):
+                with self.connection:
+                    self._write(collection, [
+                        (doc_id, self._encode(self._prepare_doc(doc)))
+                        for doc_id, doc in batch])
+
+    def changed_many(self, collection, docs):
+        self._ensure_table(collection)
+        with self._lock:
+            for batch in _batches(docs, self.batch_size):
+                with self.connection:
+                    stored = self._load(collection,
+                                        [doc_id for doc_id, _ in batch])
+                    rows = []
+                    for doc_id, doc in batch:
+                        merged = stored.get(doc_id, {'_id': doc_id})
+                        merged.update(self._prepare_doc(doc))
+                        # The id can't change, whatever the document says.
+                        merged['_id'] = doc_id
+                        rows.append((doc_id, self._encode(merged)))
+                    self._write(collection, rows)
+
+    def deleted_many(self, collection, doc_ids):
+        self._ensure_table(collection)
+        with self._lock:
+            for batch in _batches(doc_ids, self.batch_size):
+                with self.connection:
+                    self.connection.execute(
+                        'DELETE FROM {} WHERE _id IN ({})'.format(
+                            self._table(collection),
+                            ','.join('?' * len(batch))),
+                        batch)
+
+    def get_doc(self, collection, doc_id):
+        self._ensure_table(collection)
+        with self._lock:
+            return self._load(collection, [doc_id]).get(doc_id)
+
+    def get_docs(self, collection, doc_ids):
+        self._ensure_table(collection)
+        with self._lock:
+            return self._load(collection, doc_ids)
+
+    def docs_in_range(self, collection, lo=None, hi=None):
+        """
+        Generate the stored ``(doc_id, doc)`` pairs with ``lo <= doc_id <
+        hi``, in order of id. They're read ``batch_size`` at a time, so that
+        other threads needn't wait for the lot, and can write in between.
+        """
+        self._ensure_table(collection)
+        after = None
+        while True:
+            conditions, params = [], []
+            if after is not None:
+                conditions.append('_id > ?')
+                params.append(after)
+            elif lo is not None:
+                conditions.append('_id >= ?')
+                params.append(lo)
+            if hi is not None:
+                conditions.append('_id < ?')
+                params.append(hi)
+            where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+            with self._lock:
+                rows = self.connection.execute(
+                    'SELECT _id, doc FROM {}{} ORDER BY _id LIMIT ?'.format(
+                        self._table(collection), where),
+                    params + [self.batch_size]).fetchall()
+            for doc_id, doc in rows:
+                yield doc_id, json.loads(doc)
+            if len(rows) < self.batch_size:
+                return
+            after = rows[-1][0]
+
+    def count(self, collection):
+        """Get the number of documents stored for a collection."""
+        self._ensure_table(collection)
+        with self._lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM {}'.format(self._table(collection))
+            ).fetchone()[0]
+
+    def sync_collection(self, collection):
+        """
+        Replace everything stored for a collection with a fresh dump of it,
+        in a single transaction, so readers see either the old documents or
+        the new ones and never a mixture. Writes from other threads wait for
+        it, and so land on top of it. Returns the number of documents.
+        """
+        log.info('Starting full sync for collection %s', collection.name)
+        t0 = time.time()
+        self._ensure_table(collection)
+        dump = getattr(collection, 'dump_document', collection.dump)
+        count = 0
+        with self._lock, batch_memo():
+            with self.connection:
+                self.connection.execute(
+                    'DELETE FROM {}'.format(self._table(collection)))
+                rows = []
+                for obj in collection.queryset():
+                    doc = self._prepare_doc(dump(obj))
+                    rows.append((obj.pk, self._encode(doc)))
+                    if len(rows) >= self.batch_size:
+                        self._write(collection, rows)
+                        count += len(rows)
+                        rows = []
+                self._write(collection, rows)
+                count += len(rows)
+        log.info('Full sync for collection %s completed in %.3fs '
+                 '(%d documents)', collection.name, time.time() - t0, count)
+        return count
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class PolymorphicSQLiteBackend(SQLiteBackend, PolymorphicBackendBase):
+    pass
@@ -24,3 +24,57 @@ def run():
     # serializers just because someone forgot to import the manually specified
     # serializer
     autoload(('collections', 'serializers'))
+
+
+def ensure_indexes(backend_names=None):
+    """
+    Create any missing read model indexes, for all collections registered
+    with the named backends (by default, every backend which knows how).
+    Returns a dictionary of backend name to the result of its
+    ``ensure_all_indexes``.
+
+    Call this once the backends have had their collections registered (e.g.
+    after :func:`run` in whatever start up code registers them), or use the
+    ``cqrs_ensure_indexes`` management command.
+    """
+    from denormalize.backend.base import BackendBase
+
+    if backend_names is None:
+        backend_names = BackendBase._registry.keys()
+    backends = ((name, BackendBase._registry[name]) for name in backend_names)
+    return dict((name, backend.ensure_all_indexes())
+                for name, backend in backends
+                if hasattr(backend, 'ensure_all_indexes'))
+
+
+def resume_fanouts():
+    """
+    Carry on with any fan-outs (see :mod:`cqrs.fanout`) which were
+    interrupted, e.g. by the process being restarted. Returns a dictionary of
+    job id to the number of documents written.
+
+    Call this once the backends have had their collections registered.
+    """
+    from .fanout import fanouts
+
+    return fanouts.resume()
+
+
+def replay_journals(backend_names=None):
+    """
+    Apply the changes left unacknowledged in the journals of the named
+    backends (by default, every backend with a journal; see
+    :mod:`cqrs.journal`), e.g. by a crash. Returns a dictionary of backend
+    name to the number of documents written.
+
+    Call this once the backends have had their collections registered, and
+    before serving requests.
+    """
+    from denormalize.backend.base import BackendBase
+
+    if backend_names is None:
+        backend_names = BackendBase._registry.keys()
+    backends = ((name, BackendBase._registry[name]) for name in backend_names)
+    return dict((name, backend.replay_journal())
+                for name, backend in backends
+                if hasattr(backend, 'replay_journal'))
@@ -0,0 +1,137 @@
+'''
+Suspending projection, for imports and data migrations.
+
+Loading a few million rows one ``save`` at a time is slow enough without each
+save dumping and writing a document as well. Inside :func:`suspend_projection`
+the backends just note which documents need writing, and when it's done,
+each of them is dumped and written once, in bulk::
+
+    with suspend_projection([ProductCollection]) as suspension:
+        for row in rows:
+            Product.objects.create(**row)
+    log.info('%d products projected', suspension.written)
+
+The signal listeners still run, but instead of writing (or queueing)
+anything, they add the ids of the documents affected to a set per collection.
+Saving a new object costs nothing more than a set addition (the documents a
+related object belongs to are found at the end, a chunk at a time); saving
+an existing related object costs the queries finding the documents it
+belonged to and belongs to, as ever, but no dumping or writing. Fan-outs are
+left until the end, too, and embedded array updates are swallowed by the
+whole documents being written.
+
+Reconciling reads the database as it is, writing the documents which are
+there (``added_many``, which replaces them) and deleting those which aren't,
+``CQRS_BULK_CHUNK_SIZE`` at a time. It's done however the block ends, as
+that's right whatever got committed (or rolled back). It should be outside
+any transaction the import is done in, so as to see its outcome.
+
+Only the collections given (collection instances, classes or names) are
+suspended; by default it's all of them. Suspension is per thread.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from . import settings
+from .bulk import chunks, reconcile, related_ids
+from .fanout import FanOut
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Suspension(object):
+    """
+    The documents touched while projection is suspended for some
+    collections (``names``, or all of them if ``None``).
+    """
+
+    def __init__(self, names=None):
+        self.names = names
+        # (backend, collection name): (collection, set of document ids)
+        self.touched = {}
+        # (backend, collection name, filter path): (collection, set of pks)
+        self.related = {}
+        #: How many documents reconciling wrote (or deleted).
+        self.written = 0
+
+    def covers(self, collection):
+        return self.names is None or collection.name in self.names
+
+    def touch(self, backend, collection, doc_id):
+        """Note that a document needs writing."""
+        if isinstance(doc_id, FanOut):
+            return self.touch_related(backend, collection, doc_id.filter_path,
+                                      doc_id.related_pk)
+        self.touched.setdefault((backend, collection.name),
+                                (collection, set()))[1].add(doc_id)
+
+    def touch_related(self, backend, collection, filter_path, pk):
+        """
+        Note that the documents related to ``pk`` by ``filter_path`` need
+        writing.
+        """
+        self.related.setdefault((backend, collection.name, filter_path),
+                                (collection, set()))[1].add(pk)
+
+    def reconcile(self):
+        """Write (or delete) every document touched, returning how many."""
+        for (backend, name, filter_path), (collection, pks) \
+                in self.related.items():
+            for chunk in chunks(pks, settings.CQRS_BULK_CHUNK_SIZE):
+                for doc_id in collection.map_affected(
+                        related_ids(collection, filter_path, chunk)):
+                    self.touch(backend, collection, doc_id)
+        self.related = {}
+
+        for (backend, name), (collection, doc_ids) in self.touched.items():
+            self.written += reconcile(backend, collection, doc_ids)
+            log.info('suspend_projection: reconciled %d documents of %s',
+                     len(doc_ids), name)
+        self.touched = {}
+        return self.written
+
+
+def suspension_for(collection):
+    """
+    Get the innermost :class:`Suspension` in this thread covering
+    ``collection``, if any.
+    """
+    for suspension in reversed(getattr(_local, 'stack', ())):
+        if suspension.covers(collection):
+            return suspension
+    return None
+
+
+def _collection_name(collection):
+    if isinstance(collection, basestring):
+        return collection
+    if isinstance(collection, type):
+        collection = collection()
+    return collection.name
+
+
+@contextmanager
+def suspend_projection(collections=None):
+    """
+    Suspend projection to ``collections`` (by default, all of them) in this
+    thread for the duration, then reconcile the documents touched (see
+    :mod:`cqrs.suspend`). Yields the :class:`Suspension`.
+    """
+    names = None
+    if collections is not None:
+        names = frozenset(_collection_name(c) for c in collections)
+    suspension = Suspension(names)
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(suspension)
+    try:
+        yield suspension
+    finally:
+        stack.remove(suspension)
+        suspension.reconcile()
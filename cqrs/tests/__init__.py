@@ -5,5 +5,18 @@ from . import backend
 from . import collections
 from . import models
 from . import serializers
+from . import test_bulk
+from . import test_cache
 from . import test_collections
+from . import test_fingerprints
+from . import test_ingest
+from . import test_journal
+from . import test_memory
+from . import test_mixins
+from . import test_mongo
+from . import test_polling
+from . import test_replay
 from . import test_serializers
+from . import test_sqlite
+from . import test_suspend
+from . import test_verify
@@ -1,14 +1,10 @@
-from __future__ import absolute_import
-
-from collections import namedtuple
 from ..backend import PolymorphicBackendBase
+from ..replay import Action, ADD, CHANGE, DELETE
 
 
-ADD = 'ADD'
-DELETE = 'DELETE'
-CHANGE = 'CHANGE'
-
-Action = namedtuple('Action', ('action', 'collection', 'doc_id', 'doc'))
+EMBEDDED_ADD = 'EMBEDDED_ADD'
+EMBEDDED_CHANGE = 'EMBEDDED_CHANGE'
+EMBEDDED_REMOVE = 'EMBEDDED_REMOVE'
 
 
 class OpLogBackend(PolymorphicBackendBase):
@@ -44,5 +40,20 @@ class OpLogBackend(PolymorphicBackendBase):
     def changed(self, collection, doc_id, doc):
         self.log(CHANGE, collection, doc_id, doc)
 
+    # Embedded array operations are logged with a doc of (field, element), or
+    # (field, key) for removals.
+
+    def embedded_added(self, collection, doc_id, embedded_array, element):
+        self.log(EMBEDDED_ADD, collection, doc_id,
+                 (embedded_array.field, element))
+
+    def embedded_changed(self, collection, doc_id, embedded_array, element):
+        self.log(EMBEDDED_CHANGE, collection, doc_id,
+                 (embedded_array.field, element))
+
+    def embedded_removed(self, collection, doc_id, embedded_array, key):
+        self.log(EMBEDDED_REMOVE, collection, doc_id,
+                 (embedded_array.field, key))
+
     # get_doc and sync_collection are not implemented; they are considered out
     # of scope for the tests.
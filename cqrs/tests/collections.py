@@ -1,8 +1,10 @@
 from ..collections import (DRFPolymorphicDocumentCollection,
                            DRFDocumentCollection, SubCollection)
+from ..embedded import EmbeddedArray
 
 from .models import (ModelA, ModelM, ModelAM, ModelAMM, ModelMAM, BoringModel,
-                     OneMixingBowl, AnotherMixingBowl, AutomaticMixer)
+                     OneMixingBowl, AnotherMixingBowl, AutomaticMixer, Label,
+                     Shelf, Book, Note)
 
 
 class ACollection(DRFPolymorphicDocumentCollection):
@@ -42,3 +44,28 @@ class AnotherMixingBowlCollection(DRFDocumentCollection):
 
 class AutomaticMixerCollection(DRFDocumentCollection):
     model = AutomaticMixer
+
+
+class ShelfCollection(DRFDocumentCollection):
+    model = Shelf
+    prefetch_related = ['books', 'labels']
+    embedded_arrays = {
+        'books': EmbeddedArray('books'),
+        # Pretend something counts the labels.
+        'labels': EmbeddedArray('labels', aggregates=True),
+    }
+
+
+class BookCollection(DRFDocumentCollection):
+    model = Book
+    select_related = ['shelf']
+    fanout_paths = ('shelf',)
+    fanout_chunk_size = 2
+
+
+class LabelCollection(DRFDocumentCollection):
+    model = Label
+
+
+class NoteCollection(DRFDocumentCollection):
+    model = Note
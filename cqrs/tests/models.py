@@ -202,3 +202,31 @@ class AutomaticMixer(CQRSModel, DryIngredientsMixin):
         })
 
     locals().update(standard_model_test_methods())
+
+
+# And these are for documents embedding arrays of related objects.
+
+class Label(CQRSModel):
+    name = models.CharField(max_length=50)
+
+
+class Shelf(CQRSModel):
+    name = models.CharField(max_length=50)
+    labels = models.ManyToManyField(Label, related_name='shelves')
+
+
+class Book(CQRSModel):
+    shelf = models.ForeignKey(Shelf, related_name='books', null=True)
+    title = models.CharField(max_length=50)
+
+
+# And these for change capture by polling.
+
+class Note(CQRSModel):
+    text = models.CharField(max_length=50)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+
+class NoteChange(models.Model):
+    # As a trigger might write, for every change to a note.
+    note_id = models.IntegerField()
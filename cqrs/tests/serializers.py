@@ -3,7 +3,8 @@ from rest_framework.fields import CharField, IntegerField
 from ..serializers import CQRSSerializer, CQRSPolymorphicSerializer
 
 from .models import (ModelAAM, ModelAM, ModelAMM, ModelM, ModelMAM, ModelMM,
-                     ModelMMM, BoringModel, OneMixingBowl, AnotherMixingBowl)
+                     ModelMMM, BoringModel, OneMixingBowl, AnotherMixingBowl,
+                     Label, Shelf, Book)
 
 
 def make_serializer(model):
@@ -72,6 +73,7 @@ class BoringSerializer(CQRSSerializer):
 
 class OneMixingBowlSerializer(CQRSSerializer):
     total = IntegerField(read_only=True)
+    cached_fields = 'total',
 
     class Meta:
         model = OneMixingBowl
@@ -84,3 +86,27 @@ class AnotherMixingBowlSerializer(CQRSSerializer):
     class Meta:
         model = AnotherMixingBowl
         # fields explicitly omitted. Everything should be included.
+
+
+class LabelSerializer(CQRSSerializer):
+
+    class Meta:
+        model = Label
+        fields = 'name',
+
+
+class BookSerializer(CQRSSerializer):
+    shelf_name = CharField(source='shelf.name', read_only=True)
+
+    class Meta:
+        model = Book
+        fields = 'title', 'shelf', 'shelf_name'
+
+
+class ShelfSerializer(CQRSSerializer):
+    books = BookSerializer(many=True, read_only=True)
+    labels = LabelSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Shelf
+        fields = 'name', 'books', 'labels'
@@ -0,0 +1,160 @@
+from django.test import TestCase
+
+from ..bulk import batched_projection
+from ..memory import PolymorphicMemoryBackend
+from ..models import CQRSManager, CQRSPolymorphicManager
+
+from .collections import (ACollection, BookCollection, LabelCollection,
+                          ShelfCollection)
+from .models import ModelA, ModelAM, Label, Shelf, Book
+
+
+class BulkProjectionTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='bulk_tests')
+        cls.label_collection = LabelCollection()
+        cls.shelf_collection = ShelfCollection()
+        cls.a_collection = ACollection()
+        cls.book_collection = BookCollection()
+        # (Fan-outs would get mixed up with the fan-out tests'.)
+        cls.book_collection.fanout_paths = ()
+        for collection in (cls.label_collection, cls.shelf_collection,
+                           cls.a_collection, cls.book_collection):
+            cls.backend.register(collection)
+
+    def setUp(self):
+        for collection in self.backend.collections.values():
+            self.backend.sync_collection(collection)
+        self.backend.flush_oplog()
+
+    def assertProjected(self, collection):
+        self.assertEqual(
+            dict((doc_id, doc) for doc_id, doc
+                 in self.backend.data[collection.name].items()),
+            dict((obj.pk, self.expected(collection, obj))
+                 for obj in collection.queryset()))
+
+    def expected(self, collection, obj):
+        doc = collection.dump(obj)
+        doc['_id'] = doc.pop('id')
+        return doc
+
+    def test_managers(self):
+        self.assertIsInstance(Label.objects, CQRSManager)
+        self.assertIsInstance(ModelAM.objects, CQRSPolymorphicManager)
+        self.assertIsInstance(ModelA._default_manager, CQRSPolymorphicManager)
+
+    def test_bulk_create(self):
+        Label.objects.bulk_create([Label(id=9000 + i, name=str(i))
+                                   for i in range(3)])
+        self.assertProjected(self.label_collection)
+        self.assertEqual(
+            sorted(action.doc_id for action in self.backend.flush_oplog()),
+            [9000, 9001, 9002])
+
+        objs = ModelA.objects.bulk_create([
+            ModelA(id=9000 + i, field_a1='a', field_a2='A')
+            for i in range(2)])
+        # The polymorphic type was filled in as save() would have.
+        self.assertEqual([type(obj) for obj in ModelA.objects.filter(
+            pk__in=[obj.pk for obj in objs])], [ModelA, ModelA])
+        self.assertProjected(self.a_collection)
+
+    def test_update(self):
+        shelves = [Shelf.objects.create(name=name) for name in 'ab']
+        label = Label.objects.create(name='classics')
+        shelves[0].labels.add(label)
+        objs = [ModelA.objects.create(field_a1='x', field_a2='X'),
+                ModelAM.objects.create(field_a1='x', field_a2='X',
+                                       field_am1='y', field_am2='Y')]
+        self.backend.flush_oplog()
+
+        # The shelf's document embeds its labels.
+        self.assertEqual(Label.objects.filter(pk=label.pk)
+                         .update(name='old stuff'), 1)
+        self.assertProjected(self.label_collection)
+        self.assertProjected(self.shelf_collection)
+
+        ModelA.objects.filter(pk__in=[obj.pk for obj in objs]).update(
+            field_a1='z')
+        self.assertProjected(self.a_collection)
+
+    def test_update_moves_related(self):
+        shelves = [Shelf.objects.create(name=name) for name in 'ab']
+        books = [Book.objects.create(shelf=shelves[0], title=title)
+                 for title in ('Emma', 'Persuasion')]
+        Book.objects.filter(pk=books[0].pk).update(shelf=shelves[1])
+        # Both the shelf it left and the one it went to.
+        self.assertProjected(self.shelf_collection)
+
+    def test_delete(self):
+        labels = [Label.objects.create(name=str(i)) for i in range(3)]
+        self.backend.flush_oplog()
+        Label.objects.filter(pk__in=[label.pk for label in labels[:2]]) \
+            .delete()
+        self.assertProjected(self.label_collection)
+        self.assertEqual(len(self.backend.flush_oplog()), 2)
+
+    def log_deleted_many(self):
+        deletes = []
+        deleted_many = self.backend.deleted_many
+
+        def log(collection, doc_ids):
+            deletes.append((collection.name, sorted(doc_ids)))
+            return deleted_many(collection, doc_ids)
+        self.backend.deleted_many = log
+        self.addCleanup(delattr, self.backend, 'deleted_many')
+        return deletes
+
+    def test_delete_cascades(self):
+        shelf = Shelf.objects.create(name='fiction')
+        books = [Book.objects.create(shelf=shelf, title=str(i))
+                 for i in range(3)]
+        shelf_pk = shelf.pk
+        deletes = self.log_deleted_many()
+        shelf.delete()
+        self.assertEqual(sorted(deletes), [
+            (self.book_collection.name, sorted(book.pk for book in books)),
+            (self.shelf_collection.name, [shelf_pk])])
+        self.assertProjected(self.book_collection)
+        self.assertProjected(self.shelf_collection)
+
+    def test_delete_bubbles(self):
+        obj = ModelAM.objects.create(field_a1='x', field_a2='X',
+                                     field_am1='y', field_am2='Y')
+        pk = obj.pk
+        deletes = self.log_deleted_many()
+        self.backend.flush_oplog()
+        # Delete signals are sent for both ModelAM and ModelA.
+        obj.delete()
+        self.assertEqual(deletes, [(self.a_collection.name, [pk])])
+        self.assertEqual(len(self.backend.flush_oplog()), 1)
+        self.assertProjected(self.a_collection)
+
+    def test_batched_projection(self):
+        writes = []
+        added_many = self.backend.added_many
+
+        def log_added_many(collection, docs):
+            writes.append((collection.name, len(docs)))
+            return added_many(collection, docs)
+        self.backend.added_many = log_added_many
+        try:
+            with batched_projection():
+                for name in 'abc':
+                    Label.objects.create(name=name)
+                # Nothing yet.
+                self.assertEqual(list(self.backend.oplog), [])
+        finally:
+            del self.backend.added_many
+        self.assertEqual(writes, [(self.label_collection.name, 3)])
+        self.assertProjected(self.label_collection)
+
+    def test_batched_projection_exception(self):
+        with self.assertRaises(ValueError):
+            with batched_projection():
+                Label.objects.create(name='a')
+                raise ValueError
+        self.assertEqual(list(self.backend.oplog), [])
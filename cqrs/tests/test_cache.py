@@ -0,0 +1,109 @@
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from ..cache import CachingBackendMixin, MemoryInvalidationChannel
+from ..memory import PolymorphicMemoryBackend
+
+from .collections import LabelCollection
+from .models import Label
+
+
+class CachingMemoryBackend(CachingBackendMixin, PolymorphicMemoryBackend):
+    pass
+
+
+class DocumentCacheTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.channel = MemoryInvalidationChannel()
+        cls.backend = CachingMemoryBackend(
+            name='cache_tests', cache_size=2,
+            invalidation_channel=cls.channel)
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.backend.sync_collection(self.collection)
+        self.backend.cache.stats.clear()
+        self.reads = []
+        get_doc = PolymorphicMemoryBackend.get_doc
+
+        def log_get_doc(backend, collection, doc_id):
+            self.reads.append(doc_id)
+            return get_doc(backend, collection, doc_id)
+        PolymorphicMemoryBackend.get_doc = log_get_doc
+        self.addCleanup(delattr, PolymorphicMemoryBackend, 'get_doc')
+
+    def get_doc(self, label):
+        return self.backend.get_doc(self.collection, label.pk)
+
+    def test_read_through(self):
+        label = Label.objects.create(name='classics')
+        doc = self.get_doc(label)
+        self.assertEqual(doc['name'], 'classics')
+        # Changing what you get doesn't change what's cached.
+        doc['name'] = 'changed'
+        self.assertEqual(self.get_doc(label)['name'], 'classics')
+        self.assertEqual(self.reads, [label.pk])
+        self.assertEqual(self.backend.cache_report(), {
+            self.collection.name: {'hits': 1, 'misses': 1,
+                                   'hit_rate': 0.5}})
+
+    def test_invalidation(self):
+        label = Label.objects.create(name='classics')
+        self.get_doc(label)
+        label.name = 'old stuff'
+        label.save()
+        self.assertEqual(self.get_doc(label)['name'], 'old stuff')
+        label_pk = label.pk
+        label.delete()
+        self.assertIsNone(self.backend.get_doc(self.collection, label_pk))
+        self.assertEqual(self.reads, [label_pk] * 3)
+
+    def test_write_during_read(self):
+        label = Label.objects.create(name='classics')
+
+        def load():
+            doc = PolymorphicMemoryBackend.get_doc(
+                self.backend, self.collection, label.pk)
+            # Written before the read is done.
+            self.backend.changed(self.collection, label.pk,
+                                 {'_id': label.pk, 'name': 'old stuff'})
+            return doc
+        self.assertEqual(self.backend.cache.get(
+            self.collection.name, label.pk, load)['name'], 'classics')
+        # What was read wasn't kept.
+        self.assertEqual(self.get_doc(label)['name'], 'old stuff')
+
+    def test_bounded(self):
+        labels = [Label.objects.create(name=str(i)) for i in range(3)]
+        for label in labels + labels[:1]:
+            self.get_doc(label)
+        self.assertEqual(len(self.backend.cache), 2)
+        self.assertEqual(self.reads, [label.pk for label in labels]
+                         + [labels[0].pk])
+
+    def test_ttl(self):
+        label = Label.objects.create(name='classics')
+        self.backend.cache.ttl = 0
+        self.addCleanup(setattr, self.backend.cache, 'ttl', 60)
+        self.get_doc(label)
+        self.get_doc(label)
+        self.assertEqual(self.reads, [label.pk, label.pk])
+
+    def test_channel(self):
+        label = Label.objects.create(name='classics')
+        self.get_doc(label)
+        # Another process wrote it.
+        self.channel.publish(self.collection.name, [label.pk])
+        self.get_doc(label)
+        self.channel.publish(self.collection.name)
+        self.get_doc(label)
+        self.assertEqual(self.reads, [label.pk] * 3)
+
+    def test_no_rebuild(self):
+        # Caching doesn't make a backend able to rebuild.
+        with self.assertRaises(CommandError):
+            call_command('cqrs_rebuild', 'cache_tests', self.collection.name)
@@ -1,19 +1,29 @@
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 
+from denormalize.context import delay_sync, sync_together
+
 from ..models import CQRSModel, CQRSPolymorphicModel
 from ..collections import (DRFPolymorphicDocumentCollection,
                            DRFDocumentCollection,
                            SubCollection, SubCollectionMeta)
+from ..embedded import EmbeddedArray
+from ..fanout import fanouts
+from ..indexes import Index
+from ..keymap import KeyMap, key_maps
+from ..serializers import CQRSSerializerMeta
 
 from .models import (ModelA, ModelAA, ModelAAA, ModelAAM, ModelAM, ModelAMA,
                      ModelAMM, ModelM, ModelMA, ModelMAA, ModelMAM, ModelMM,
                      ModelMMA, ModelMMM, BoringModel, OneMixingBowl,
-                     AnotherMixingBowl, AutomaticMixer)
+                     AnotherMixingBowl, AutomaticMixer, Label, Shelf, Book)
 from .collections import (ACollection, MCollection, AMSubCollection,
                           AMMSubCollection, MAMSubCollection, BoringCollection,
                           OneMixingBowlCollection, AnotherMixingBowlCollection,
-                          AutomaticMixerCollection)
-from .backend import OpLogBackend, Action, ADD, DELETE, CHANGE
+                          AutomaticMixerCollection, ShelfCollection,
+                          BookCollection)
+from .backend import (OpLogBackend, Action, ADD, DELETE, CHANGE, EMBEDDED_ADD,
+                      EMBEDDED_CHANGE, EMBEDDED_REMOVE)
 
 
 def make_collection_test_method(model):
@@ -81,6 +91,137 @@ class JustCollectionTests(TestCase):
         subcollection.base_collection = ACollection()
         self.assertEqual(subcollection.name, 'cqrs_modela')
 
+    def test_polymorphic_collection_indexes_type_by_default(self):
+        self.assertEqual(ACollection().get_indexes(), [Index('type')])
+        self.assertEqual(BoringCollection().get_indexes(), [])
+
+    def test_declared_indexes(self):
+        class IndexedCollection(MCollection):
+            indexes = (Index('field_m1', '-field_m2'),
+                       Index('type', name='by_type'),
+                       Index('field_m2', expire_after=60))
+            type_index = False
+
+        self.assertEqual(IndexedCollection().get_indexes(),
+                         list(IndexedCollection.indexes))
+        self.assertEqual(IndexedCollection.indexes[0].spec(),
+                         ([('field_m1', 1), ('field_m2', -1)],
+                          {'name': 'field_m1_1_field_m2_-1'}))
+        self.assertEqual(IndexedCollection.indexes[2].spec(),
+                         ([('field_m2', 1)],
+                          {'name': 'field_m2_1', 'expireAfterSeconds': 60}))
+        self.assertTrue(IndexedCollection.indexes[0].matches(
+            [(u'field_m1', 1.0), (u'field_m2', -1.0)]))
+
+    def test_declared_index_suppresses_derived_one(self):
+        class NamedTypeIndexCollection(MCollection):
+            indexes = (Index('type', name='by_type'),
+                       Index('types', sparse=True))
+            type_ancestry = True
+
+        self.assertEqual(NamedTypeIndexCollection().get_indexes(),
+                         list(NamedTypeIndexCollection.indexes))
+
+    def test_type_ancestry(self):
+        class AncestryCollection(ACollection):
+            type_ancestry = True
+
+        collection = AncestryCollection()
+        instance = ModelAAA.create_test_instance()
+        doc = collection.dump(instance)
+        self.assertEqual(doc.pop('types'), ['cqrs.tests.models.ModelAAA',
+                                            'cqrs.tests.models.ModelAA',
+                                            'cqrs.tests.models.ModelA'])
+        self.assertEqual(doc, instance.as_test_serialized())
+        self.assertEqual(collection.get_indexes(),
+                         [Index('type'), Index('types')])
+        self.assertEqual(collection.subtree_query(ModelAA),
+                         {'types': 'cqrs.tests.models.ModelAA'})
+
+    def test_dump_document(self):
+        class TypedACollection(ACollection):
+            type_ancestry = True
+
+        for collection in (ACollection(), TypedACollection()):
+            for model in (ModelA, ModelAM, ModelAMM):
+                instance = model.create_test_instance()
+                expected = collection.dump(instance)
+                expected['_id'] = expected.pop('id')
+                self.assertEqual(collection.dump_document(instance), expected)
+
+        instance = BoringModel.create_test_instance()
+        doc = BoringCollection().dump_document_id(instance.id)
+        self.assertEqual(doc['_id'], instance.id)
+        self.assertIs(type(doc), dict)
+
+    def test_subtree_query_without_type_ancestry(self):
+        query = ACollection().subtree_query(ModelAA)
+        self.assertEqual(set(query['type']['$in']),
+                         set(['cqrs.tests.models.ModelAA',
+                              'cqrs.tests.models.ModelAAA',
+                              'cqrs.tests.models.ModelAAM']))
+        with self.assertRaises(ValueError):
+            ACollection().subtree_query(ModelM)
+
+    def test_generated_key_map(self):
+        key_maps.set_store(None)
+        # (Non-polymorphic collections register themselves, so no subclass.)
+        collection = BoringCollection()
+        collection.key_map = True
+        key_map = collection.get_key_map()
+        self.assertEqual(key_map.compress_map,
+                         {'daft_poem': 'a', 'violets': 'b'})
+
+        instance = BoringModel.create_test_instance()
+        doc = collection.dump(instance)
+        compressed = key_map.compress(doc)
+        self.assertEqual(set(compressed), {'id', 'type', 'a', 'b'})
+        self.assertEqual(collection.expand_doc(compressed), doc)
+        self.assertEqual(key_map.documents, 1)
+        self.assertEqual(key_map.bytes_saved,
+                         len('daft_poem') - 1 + len('violets') - 1)
+
+    def test_generated_key_map_is_append_only(self):
+        key_maps.set_store(None)
+        collection = BoringCollection()
+        collection.key_map = True
+        doc = collection.dump(BoringModel.create_test_instance())
+        stored = collection.get_key_map().compress(doc)
+
+        # A deploy later, there's a new field, which sorts first.
+        collection = BoringCollection()
+        collection.key_map = True
+        collection._key_map_field_names = lambda: [
+            'an_aardvark', 'daft_poem', 'violets']
+        self.assertEqual(
+            collection.get_key_map().compress_map,
+            {'daft_poem': 'a', 'violets': 'b', 'an_aardvark': 'c'})
+        self.assertEqual(collection.expand_doc(stored), doc)
+
+        # And then one has gone; its documents can still be read.
+        collection = BoringCollection()
+        collection.key_map = True
+        collection._key_map_field_names = lambda: ['an_aardvark', 'violets']
+        self.assertEqual(collection.expand_doc(stored), doc)
+        self.assertEqual(key_maps.key_map(collection.name, ['zebra'])
+                         .compress_map['zebra'], 'd')
+
+    def test_polymorphic_generated_key_map(self):
+        class CompressedCollection(MCollection):
+            key_map = True
+
+        compress_map = CompressedCollection().get_key_map().compress_map
+        self.assertIn('field_mmm1', compress_map)
+        self.assertIn('manual_mam3', compress_map)
+        self.assertNotIn('type', compress_map)
+        self.assertNotIn('id', compress_map)
+
+    def test_bad_key_maps(self):
+        with self.assertRaises(ValueError):
+            KeyMap({'violets': 'v', 'daft_poem': 'v'})
+        with self.assertRaises(ValueError):
+            KeyMap({'violets': 'type'})
+
     def test_bad_drf_document_collection_instantiation(self):
         # The idea here is to show that yes, you do need to create a collection
         # class; it's not like ``CQRSPolymorphicSerializer()``
@@ -255,3 +396,156 @@ class CollectionAndBackendTests(TestCase):
 
     # Can't do anything with AutomaticMixer, because it can't have a serializer
     # created (see test_serializers)
+
+
+class EmbeddedArrayTests(TestCase):
+    """Tests for element by element updates of embedded arrays."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = OpLogBackend(name='embedded_array_tests')
+        cls.collection = ShelfCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.shelf = Shelf.objects.create(name='fiction')
+        self.other_shelf = Shelf.objects.create(name='non-fiction')
+        self.backend.flush_oplog()
+
+    def tearDown(self):
+        self.assertEqual(self.backend.flush_oplog(), [])
+
+    def element(self, obj):
+        return self.collection.get_embedded_arrays()[
+            'books' if isinstance(obj, Book) else 'labels'].dump_element(obj)
+
+    def assertOps(self, *ops):
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(action, self.collection, doc_id, doc)
+                          for action, doc_id, doc in ops])
+
+    def test_reverse_foreign_key(self):
+        book = Book.objects.create(shelf=self.shelf, title='Emma')
+        self.assertOps((EMBEDDED_ADD, self.shelf.id,
+                        ('books', self.element(book))))
+
+        book.title = 'Persuasion'
+        book.save()
+        self.assertOps((EMBEDDED_CHANGE, self.shelf.id,
+                        ('books', self.element(book))))
+
+        # Moving it takes it out of one document and puts it in another.
+        book.shelf = self.other_shelf
+        book.save()
+        self.assertOps((EMBEDDED_ADD, self.other_shelf.id,
+                        ('books', self.element(book))),
+                       (EMBEDDED_REMOVE, self.shelf.id, ('books', book.id)))
+
+        book_id = book.id
+        book.delete()
+        self.assertOps((EMBEDDED_REMOVE, self.other_shelf.id,
+                        ('books', book_id)))
+
+    def test_many_to_many_with_aggregates(self):
+        label = Label.objects.create(name='classics')
+        self.backend.flush_oplog()
+
+        # Membership changes affect aggregates, so they're full dumps...
+        self.shelf.labels.add(label)
+        self.assertOps((CHANGE, self.shelf.id,
+                        self.collection.dump_id(self.shelf.id)))
+        label.shelves.add(self.other_shelf)
+        self.assertOps((CHANGE, self.other_shelf.id,
+                        self.collection.dump_id(self.other_shelf.id)))
+
+        # ... but changes to an element are not.
+        label.name = 'old stuff'
+        label.save()
+        element = ('labels', self.element(label))
+        self.assertEqual(
+            sorted(self.backend.flush_oplog(), key=lambda op: op.doc_id),
+            [Action(EMBEDDED_CHANGE, self.collection, self.shelf.id, element),
+             Action(EMBEDDED_CHANGE, self.collection, self.other_shelf.id,
+                    element)])
+
+        self.shelf.labels.remove(label)
+        self.assertOps((CHANGE, self.shelf.id,
+                        self.collection.dump_id(self.shelf.id)))
+        self.assertEqual(self.collection.dump_id(self.shelf.id)['labels'], [])
+
+    def test_full_dump_when_syncing_together(self):
+        with sync_together():
+            book = Book.objects.create(shelf=self.shelf, title='Emma')
+            Book.objects.create(shelf=self.shelf, title='Persuasion')
+            book.title = 'Mansfield Park'
+            book.save()
+        self.assertOps((CHANGE, self.shelf.id,
+                        self.collection.dump_id(self.shelf.id)))
+
+    def test_embedded_array_must_be_nested_serializer(self):
+        bad = EmbeddedArray('name')
+        with self.assertRaises(ImproperlyConfigured):
+            bad.bind(CQRSSerializerMeta._register.instances[Shelf])
+
+
+class FanOutTests(TestCase):
+    """Tests for chunked fan-outs of changes to related objects."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = OpLogBackend(name='fanout_tests')
+        cls.collection = BookCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.shelf = Shelf.objects.create(name='fiction')
+        self.books = [Book.objects.create(shelf=self.shelf, title=title)
+                      for title in ('Emma', 'Persuasion', 'Mansfield Park',
+                                    'Sense and Sensibility',
+                                    'Northanger Abbey')]
+        Book.objects.create(title='Unshelved')
+        self.backend.flush_oplog()
+
+    def tearDown(self):
+        self.assertEqual(self.backend.flush_oplog(), [])
+        self.assertEqual(fanouts.store.unfinished(), [])
+
+    def changes(self, books):
+        return [Action(CHANGE, self.collection, book.id,
+                       self.collection.dump(Book.objects.get(pk=book.pk)))
+                for book in books]
+
+    def test_fanout(self):
+        self.shelf.name = 'novels'
+        self.shelf.save()
+        self.assertEqual(self.backend.flush_oplog(), self.changes(self.books))
+
+    def test_fanout_is_delayed_and_done_once(self):
+        with delay_sync():
+            self.shelf.name = 'novels'
+            self.shelf.save()
+            self.shelf.name = 'old novels'
+            self.shelf.save()
+            self.assertEqual(self.backend.flush_oplog(), [])
+        self.assertEqual(self.backend.flush_oplog(), self.changes(self.books))
+
+    def test_fanout_resumes(self):
+        submitted = []
+        fanouts.executor = submitted.append
+        try:
+            self.shelf.name = 'novels'
+            self.shelf.save()
+        finally:
+            fanouts.executor = None
+        self.assertEqual(self.backend.flush_oplog(), [])
+        job_id, = submitted
+
+        # Pretend it got through the first chunk before being interrupted.
+        job = fanouts.store.get(job_id)
+        job['last_pk'] = self.books[1].pk
+        fanouts.store.save(job)
+
+        self.assertEqual(fanouts.resume(), {job_id: 3})
+        self.assertEqual(self.backend.flush_oplog(),
+                         self.changes(self.books[2:]))
+
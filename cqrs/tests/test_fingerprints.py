@@ -0,0 +1,73 @@
+from django.test import TestCase
+from rest_framework.fields import CharField
+
+from ..fingerprints import rebuild_stale, stale_models
+from ..memory import PolymorphicMemoryBackend
+from ..serializers import CQRSSerializerMeta, serializer_layout
+
+from .collections import ACollection
+from .models import ModelA, ModelAA, ModelAM
+
+
+class FingerprintTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='fingerprint_tests')
+        cls.collection = ACollection()
+        cls.collection.fingerprints = True
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.backend.sync_collection(self.collection)
+
+    def test_fingerprint(self):
+        serializer_class = CQRSSerializerMeta._register[ModelAM]
+        fingerprint = serializer_class.fingerprint()
+        self.assertEqual(serializer_class.fingerprint(), fingerprint)
+        self.assertNotEqual(
+            CQRSSerializerMeta._register[ModelA].fingerprint(), fingerprint)
+
+        serializer = serializer_class()
+        serializer.fields['extra'] = CharField()
+        self.assertNotEqual(serializer_layout(serializer),
+                            serializer_layout(serializer_class()))
+
+    def test_documents(self):
+        obj = ModelAM.objects.create(field_a1='x', field_a2='X',
+                                     field_am1='y', field_am2='Y')
+        fingerprint = CQRSSerializerMeta._register[ModelAM].fingerprint()
+        self.assertEqual(self.collection.dump_document(obj)['_fp'],
+                         fingerprint)
+        self.assertEqual(self.collection.dump(obj)['_fp'], fingerprint)
+        self.assertEqual(
+            self.backend.get_doc(self.collection, obj.pk)['_fp'], fingerprint)
+
+    def test_rebuild_stale(self):
+        objs = [ModelA.objects.create(field_a1='x', field_a2='X'),
+                ModelAA.objects.create(field_a1='x', field_a2='X',
+                                       field_aa1='z', field_aa2='Z'),
+                ModelAM.objects.create(field_a1='x', field_a2='X',
+                                       field_am1='y', field_am2='Y')]
+        self.assertEqual(stale_models(self.backend, self.collection), [])
+
+        # As if ModelAM's serializer had changed since.
+        doc = self.backend.get_doc(self.collection, objs[2].pk)
+        doc['_fp'] = 'old'
+        del doc['field_am1']
+        self.backend.flush_oplog()
+
+        self.assertEqual(stale_models(self.backend, self.collection),
+                         [ModelAM])
+        self.assertEqual(
+            rebuild_stale(self.backend, self.collection, dry_run=True),
+            {ModelAM: 1})
+        self.assertEqual(self.backend.flush_oplog(), [])
+
+        self.assertEqual(rebuild_stale(self.backend, self.collection),
+                         {ModelAM: 1})
+        self.assertEqual([action.doc_id for action
+                          in self.backend.flush_oplog()], [objs[2].pk])
+        doc = self.backend.get_doc(self.collection, objs[2].pk)
+        self.assertEqual(doc, self.collection.dump_document(objs[2]))
+        self.assertEqual(stale_models(self.backend, self.collection), [])
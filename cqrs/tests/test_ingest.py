@@ -0,0 +1,111 @@
+from django.test import TestCase
+
+from ..ingest import IngestError, bulk_ingest
+
+from .backend import OpLogBackend, Action, ADD, CHANGE
+from .collections import ACollection, BookCollection, LabelCollection
+from .models import ModelA, ModelAM, ModelAMM, BoringModel, Label, Shelf, Book
+
+
+class BulkIngestTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = OpLogBackend(name='ingest_tests')
+        cls.label_collection = LabelCollection()
+        cls.book_collection = BookCollection()
+        # (Fan-outs would get mixed up with the fan-out tests'.)
+        cls.book_collection.fanout_paths = ()
+        cls.a_collection = ACollection()
+        for collection in (cls.label_collection, cls.book_collection,
+                           cls.a_collection):
+            cls.backend.register(collection)
+
+    def setUp(self):
+        self.backend.flush_oplog()
+
+    def test_polymorphic(self):
+        payloads = [
+            {'type': ModelAM._class_type_path(), 'field_a1': 'a',
+             'field_a2': 'A', 'field_am1': 'am'},
+            {'type': ModelA._class_type_path(), 'field_a1': 'b',
+             'field_a2': 'B'},
+            {'type': ModelAM._class_type_path(), 'field_a1': 'c',
+             'field_a2': 'C', 'field_am1': 'am'},
+        ]
+        objs = bulk_ingest(payloads, model=ModelA)
+        self.assertEqual([type(obj) for obj in objs],
+                         [ModelAM, ModelA, ModelAM])
+        self.assertEqual([obj.field_a1 for obj in
+                          ModelA.objects.filter(pk__in=[o.pk for o in objs])
+                          .order_by('field_a1')],
+                         ['a', 'b', 'c'])
+        # One projection of each, after it's all saved.
+        self.assertEqual(
+            sorted(self.backend.flush_oplog(), key=lambda a: a.doc_id),
+            [Action(ADD, self.a_collection, obj.pk,
+                    self.a_collection.dump(ModelA.objects.get(pk=obj.pk)))
+             for obj in sorted(objs, key=lambda o: o.pk)])
+
+    def test_invalid(self):
+        payloads = [
+            {'type': ModelAM._class_type_path(), 'field_a1': 'a',
+             'field_a2': 'A', 'field_am1': 'am'},
+            {'field_a1': 'no type'},
+            {'type': BoringModel._meta.object_name, 'field_a1': 'x'},
+            {'type': ModelAMM._class_type_path()},
+        ]
+        with self.assertRaises(IngestError) as r:
+            bulk_ingest(payloads, model=ModelA)
+        errors = r.exception.errors
+        self.assertEqual(errors[0], {})
+        self.assertEqual(errors[1], {'type': ['No polymorphic type provided.']})
+        self.assertEqual(errors[2].keys(), ['type'])
+        self.assertIn('field_amm1', errors[3])
+        self.assertFalse(ModelA.objects.filter(field_a1='a').exists())
+        self.assertEqual(self.backend.flush_oplog(), [])
+
+    def test_bulk_create_with_ids(self):
+        labels = bulk_ingest([{'id': 9001, 'name': 'new'},
+                              {'id': 9002, 'name': 'newer'}], model=Label)
+        self.assertEqual(
+            list(Label.objects.filter(pk__in=[9001, 9002])
+                 .values_list('name', flat=True).order_by('pk')),
+            ['new', 'newer'])
+        self.assertEqual(
+            sorted(self.backend.flush_oplog(), key=lambda a: a.doc_id),
+            [Action(ADD, self.label_collection, label.pk,
+                    self.label_collection.dump(label)) for label in labels])
+
+    def test_update_and_foreign_keys(self):
+        shelves = [Shelf.objects.create(name=name) for name in 'ab']
+        book = Book.objects.create(title='Emma', shelf=shelves[0])
+        self.backend.flush_oplog()
+        with self.assertRaises(IngestError) as r:
+            bulk_ingest([{'title': 'Lost', 'shelf': 999999}], model=Book)
+        self.assertIn('shelf', r.exception.errors[0])
+
+        new, updated = bulk_ingest([
+            {'title': 'Persuasion', 'shelf': str(shelves[1].pk)},
+            {'id': book.pk, 'title': 'Emma', 'shelf': shelves[1].pk},
+        ], model=Book)
+        self.assertEqual(updated.pk, book.pk)
+        self.assertEqual(Book.objects.get(pk=book.pk).shelf, shelves[1])
+        self.assertEqual(Book.objects.get(pk=new.pk).shelf, shelves[1])
+        self.assertEqual(
+            sorted((action.action, action.doc_id)
+                   for action in self.backend.flush_oplog()),
+            sorted([(ADD, new.pk), (CHANGE, book.pk)]))
+
+    def test_one_query_per_related_model(self):
+        shelves = [Shelf.objects.create(name=name) for name in 'ab']
+        payloads = [{'title': 'Emma', 'shelf': shelves[0].pk},
+                    {'title': 'Persuasion', 'shelf': shelves[1].pk},
+                    {'shelf': shelves[0].pk}]
+        # Loading both shelves is all the validation there is to do, and the
+        # missing title means nothing else happens.
+        with self.assertNumQueries(1):
+            with self.assertRaises(IngestError) as r:
+                bulk_ingest(payloads, model=Book)
+        self.assertEqual([error.keys() for error in r.exception.errors],
+                         [[], [], ['title']])
@@ -0,0 +1,319 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.db import connections
+from django.test import TestCase
+
+from ..journal import Journal, JournalBackendMixin, ADD, CHANGE
+from ..memory import PolymorphicMemoryBackend
+from ..verify import resync
+
+from .backend import OpLogBackend, Action, DELETE
+from .collections import LabelCollection
+from .models import Label
+
+
+class FlakyOpLogBackend(JournalBackendMixin, OpLogBackend):
+    """An oplog backend which can be told to fail its writes."""
+
+    spill_exceptions = (IOError,)
+    failing = False
+    # The tests replay it themselves.
+    drain_interval = None
+
+    def log(self, *args, **kwargs):
+        if self.failing:
+            raise IOError('Backend unavailable')
+        super(FlakyOpLogBackend, self).log(*args, **kwargs)
+
+
+class FailingMemoryBackend(PolymorphicMemoryBackend):
+    """A memory backend which can be told to fail its writes."""
+
+    failing = False
+
+    def added(self, *args, **kwargs):
+        if self.failing:
+            raise IOError('Backend unavailable')
+        super(FailingMemoryBackend, self).added(*args, **kwargs)
+
+
+class FlakyMemoryBackend(JournalBackendMixin, FailingMemoryBackend):
+    """A journalled memory backend whose writes (replays too) can fail."""
+
+    spill_exceptions = (IOError,)
+    drain_interval = None
+
+
+class DrainingMemoryBackend(FlakyMemoryBackend):
+    """A flaky memory backend replaying its journal in the background."""
+
+    drain_interval = 0.01
+
+    def _drain(self):
+        # On the writer thread, which needs the test's connection (and so
+        # its transaction), as a live server test's thread does.
+        connections['default'] = self.connection
+        super(DrainingMemoryBackend, self)._drain()
+
+
+class SlowOpLogBackend(JournalBackendMixin, OpLogBackend):
+    """An oplog backend whose writes can be held up."""
+
+    write_timeout = 0.05
+    drain_interval = None
+
+    def __init__(self, *args, **kwargs):
+        super(SlowOpLogBackend, self).__init__(*args, **kwargs)
+        self.proceed = threading.Event()
+        self.proceed.set()
+
+    def log(self, *args, **kwargs):
+        self.proceed.wait()
+        super(SlowOpLogBackend, self).log(*args, **kwargs)
+
+
+class JournalTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.backend = FlakyOpLogBackend(
+            name='journal_tests',
+            journal_path=os.path.join(cls.directory, 'test.journal'))
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    @classmethod
+    def tearDownClass(cls):
+        # The backend lives on, but its file stays open, so that's OK.
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.backend.failing = False
+        self.backend.flush_oplog()
+
+    def tearDown(self):
+        self.assertEqual(self.backend.flush_oplog(), [])
+        self.assertEqual(self.backend.journal.unacknowledged(), [])
+
+    def test_acknowledged(self):
+        label = Label.objects.create(name='classics')
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(ADD, self.collection, label.id,
+                                 self.collection.dump(label))])
+
+    def test_spill_and_replay(self):
+        self.backend.failing = True
+        label = Label.objects.create(name='classics')
+        label.name = 'old stuff'
+        label.save()
+        gone = Label.objects.create(name='ephemera')
+        gone_id = gone.id
+        gone.delete()
+        self.assertEqual(
+            [(record['action'], record['doc_id']) for record
+             in self.backend.journal.unacknowledged()],
+            [(ADD, label.id), (CHANGE, label.id), (ADD, gone_id),
+             (DELETE, gone_id)])
+
+        self.backend.failing = False
+        self.assertEqual(self.backend.replay_journal(), 2)
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(ADD, self.collection, label.id,
+                                 self.collection.dump(label)),
+                          Action(DELETE, self.collection, gone_id, None)])
+        # And it's been compacted down to nothing.
+        self.assertEqual(os.path.getsize(self.backend.journal.path), 0)
+
+    def test_replayed_delete_of_live_row(self):
+        # As if the delete had been rolled back after it was journalled.
+        label = Label.objects.create(name='classics')
+        self.backend.flush_oplog()
+        self.backend.journal.append(DELETE, self.collection.name, label.id)
+
+        self.assertEqual(self.backend.replay_journal(), 1)
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(ADD, self.collection, label.id,
+                                 self.collection.dump(label))])
+
+    def test_batched(self):
+        labels = [Label.objects.create(name=name) for name in 'ab']
+        ids = [label.id for label in labels]
+        self.backend.flush_oplog()
+        self.backend.failing = True
+        Label.objects.filter(pk__in=ids).delete()
+        self.assertEqual(
+            sorted((record['action'], record['doc_id']) for record
+                   in self.backend.journal.unacknowledged()),
+            [(DELETE, ids[0]), (DELETE, ids[1])])
+
+        self.backend.failing = False
+        self.assertEqual(self.backend.replay_journal(), 2)
+        self.assertEqual(
+            sorted(self.backend.flush_oplog(), key=lambda a: a.doc_id),
+            [Action(DELETE, self.collection, doc_id, None) for doc_id in ids])
+
+    def test_reopen(self):
+        path = os.path.join(self.directory, 'reopen.journal')
+        journal = Journal(path)
+        first = journal.append(CHANGE, 'collection', 1)
+        second = journal.append(DELETE, 'collection', 2)
+        journal.acknowledge(first)
+        journal.close()
+        # As if the process died half way through writing an entry.
+        with open(path, 'a') as f:
+            f.write('{"seq": 3, "act')
+
+        journal = Journal(path)
+        self.assertEqual(journal.unacknowledged(),
+                         [{'seq': second, 'action': DELETE,
+                           'collection': 'collection', 'doc_id': 2}])
+        third = journal.append(ADD, 'collection', 3)
+        self.assertEqual(third, 3)
+        journal.close()
+        self.assertEqual([record['seq'] for record
+                          in Journal(path).unacknowledged()], [second, third])
+
+
+class WriteTimeoutTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.backend = SlowOpLogBackend(
+            name='journal_timeout_tests',
+            journal_path=os.path.join(cls.directory, 'test.journal'))
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.backend.proceed.set()
+        self.backend.wait_for_writes()
+        self.backend.flush_oplog()
+
+    def tearDown(self):
+        self.backend.proceed.set()
+        self.backend.wait_for_writes()
+        self.assertEqual(self.backend.flush_oplog(), [])
+        self.assertEqual(self.backend.journal.unacknowledged(), [])
+
+    def test_in_time(self):
+        label = Label.objects.create(name='classics')
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(ADD, self.collection, label.id,
+                                 self.collection.dump(label))])
+
+    def test_overrun(self):
+        self.backend.proceed.clear()
+        t0 = time.time()
+        label = Label.objects.create(name='classics')
+        added = self.collection.dump(label)
+        label.name = 'old stuff'
+        label.save()
+        # Neither save waited for the backend.
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual(self.backend.oplog, [])
+        self.assertEqual(
+            [(record['action'], record['doc_id']) for record
+             in self.backend.journal.unacknowledged()],
+            [(ADD, label.id), (CHANGE, label.id)])
+
+        # The writes are made in the background, in order, once it can.
+        self.backend.proceed.set()
+        self.backend.wait_for_writes()
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(ADD, self.collection, label.id, added),
+                          Action(CHANGE, self.collection, label.id,
+                                 self.collection.dump(label))])
+
+        # Replaying them does no harm.
+        self.assertEqual(self.backend.replay_journal(), 1)
+        self.assertEqual(self.backend.flush_oplog(),
+                         [Action(ADD, self.collection, label.id,
+                                 self.collection.dump(label))])
+
+
+class ResyncJournalTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.backend = FlakyMemoryBackend(
+            name='journal_resync_tests',
+            journal_path=os.path.join(cls.directory, 'test.journal'))
+        cls.backend.listen = False
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_spilled_resync_is_replayed(self):
+        labels = [Label.objects.create(name=name) for name in 'ab']
+        self.backend.failing = True
+        self.assertEqual(resync(self.backend, self.collection)['added'], 2)
+        self.assertEqual(self.backend.count(self.collection), 0)
+        self.assertEqual(
+            [(record['action'], record['doc_id']) for record
+             in self.backend.journal.unacknowledged()],
+            [(ADD, label.id) for label in labels])
+
+        self.backend.failing = False
+        self.assertEqual(self.backend.replay_journal(), 2)
+        self.assertEqual(self.backend.count(self.collection), 2)
+        self.assertEqual(self.backend.journal.unacknowledged(), [])
+
+
+class DrainTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.backend = DrainingMemoryBackend(
+            name='journal_drain_tests',
+            journal_path=os.path.join(cls.directory, 'test.journal'))
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        connection = connections['default']
+        connection.allow_thread_sharing = True
+        self.addCleanup(setattr, connection, 'allow_thread_sharing', False)
+        self.backend.connection = connection
+
+    def wait_for_drain(self):
+        deadline = time.time() + 5
+        while (self.backend.journal.unacknowledged()
+               and time.time() < deadline):
+            time.sleep(0.01)
+
+    def test_drained(self):
+        self.backend.failing = True
+        label = Label.objects.create(name='classics')
+        # Tried again in the background, and failing again, for now.
+        time.sleep(0.05)
+        self.assertEqual(self.backend.count(self.collection), 0)
+        self.assertEqual(
+            [(record['action'], record['doc_id']) for record
+             in self.backend.journal.unacknowledged()],
+            [(ADD, label.id)])
+
+        self.backend.failing = False
+        self.wait_for_drain()
+        self.assertEqual(self.backend.journal.unacknowledged(), [])
+        self.assertEqual(
+            self.backend.get_doc(self.collection, label.id)['name'],
+            'classics')
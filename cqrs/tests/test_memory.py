@@ -0,0 +1,110 @@
+from django.test import TestCase
+
+from ..indexes import Index
+from ..memory import PolymorphicMemoryBackend, matches
+from ..replay import Action, ADD, CHANGE, DELETE
+
+from .collections import LabelCollection, ShelfCollection
+from .models import Label, Shelf, Book
+
+
+class MemoryBackendTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='memory_tests',
+                                               oplog_size=3)
+        cls.collection = LabelCollection()
+        cls.collection.indexes = (Index('name'),)
+        cls.backend.register(cls.collection)
+        cls.shelf_collection = ShelfCollection()
+        cls.backend.register(cls.shelf_collection)
+
+    def setUp(self):
+        self.backend.sync_collection(self.collection)
+        self.backend.sync_collection(self.shelf_collection)
+        self.backend.flush_oplog()
+
+    def expected(self, collection, obj):
+        doc = collection.dump(obj)
+        doc['_id'] = doc.pop('id')
+        return doc
+
+    def test_signals(self):
+        label = Label.objects.create(name='classics')
+        doc = self.expected(self.collection, label)
+        self.assertEqual(self.backend.get_doc(self.collection, label.id), doc)
+        label.delete()
+        self.assertIsNone(self.backend.get_doc(self.collection, doc['_id']))
+        self.assertEqual(self.backend.flush_oplog(), [
+            Action(ADD, self.collection, doc['_id'], doc),
+            Action(DELETE, self.collection, doc['_id'], None)])
+
+    def test_oplog_ring(self):
+        for i in range(5):
+            self.backend.added(self.collection, i, {'_id': i})
+        self.assertEqual(
+            [action.doc_id for action in self.backend.flush_oplog()],
+            [2, 3, 4])
+
+    def test_changed_merges(self):
+        self.backend.added(self.collection, 1, {'_id': 1, 'name': 'a',
+                                                'extra': 1})
+        self.backend.changed(self.collection, 1, {'_id': 1, 'name': 'b'})
+        self.assertEqual(self.backend.get_doc(self.collection, 1),
+                         {'_id': 1, 'name': 'b', 'extra': 1})
+        self.assertEqual(self.backend.flush_oplog()[-1],
+                         Action(CHANGE, self.collection, 1,
+                                {'_id': 1, 'name': 'b'}))
+
+    def test_find(self):
+        a, b, c = [Label.objects.create(name=name) for name in 'abc']
+        c.name = 'a'
+        c.save()
+        index = self.backend.indexes[self.collection.name][0]
+        self.assertEqual(index.entries, {('a',): set([a.id, c.id]),
+                                         ('b',): set([b.id])})
+
+        def found(query):
+            return sorted(doc['_id'] for doc
+                          in self.backend.find(self.collection, query))
+
+        self.assertEqual(found({'name': 'a'}), [a.id, c.id])
+        self.assertEqual(found({'name': {'$in': ['b', 'z']}}), [b.id])
+        self.assertEqual(found({'_id': {'$in': [a.id, b.id]}, 'name': 'a'}),
+                         [a.id])
+        self.assertEqual(found({'type': 'Label'}), [a.id, b.id, c.id])
+        self.assertEqual(found({}), [a.id, b.id, c.id])
+
+    def test_matches(self):
+        doc = {'tags': ['x', 'y'], 'owner': {'name': 'z'}}
+        self.assertTrue(matches(doc, {'tags': 'x'}))
+        self.assertTrue(matches(doc, {'tags': ['x', 'y']}))
+        self.assertTrue(matches(doc, {'owner.name': {'$in': ['z']}}))
+        self.assertTrue(matches(doc, {'missing': None}))
+        self.assertFalse(matches(doc, {'tags': 'z'}))
+        self.assertFalse(matches(doc, {'owner.name': 'x'}))
+
+    def test_embedded_arrays(self):
+        shelf = Shelf.objects.create(name='fiction')
+        first = Book.objects.create(shelf=shelf, title='one')
+        second = Book.objects.create(shelf=shelf, title='two')
+        first.title = 'uno'
+        first.save()
+        second.delete()
+        label = Label.objects.create(name='classics')
+        shelf.labels.add(label)
+        shelf = Shelf.objects.get(pk=shelf.pk)
+        self.assertEqual(
+            self.backend.get_doc(self.shelf_collection, shelf.id),
+            self.expected(self.shelf_collection, shelf))
+
+    def test_sync_collection(self):
+        labels = [Label.objects.create(name=name) for name in 'abc']
+        self.backend.added(self.collection, 999, {'_id': 999, 'name': 'a'})
+        self.assertEqual(self.backend.sync_collection(self.collection), 3)
+        self.assertEqual(self.backend.count(self.collection), 3)
+        self.assertEqual(
+            [doc['_id'] for doc in
+             self.backend.find(self.collection, {'name': 'a'})],
+            [labels[0].id])
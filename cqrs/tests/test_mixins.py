@@ -0,0 +1,158 @@
+import warnings
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from rest_framework import generics, serializers
+from rest_framework.test import APIRequestFactory
+
+from ..memory import PolymorphicMemoryBackend
+from ..mixins import ProjectedReadMixin
+from ..serializers import CQRSSerializerMeta
+
+from .collections import LabelCollection, MCollection
+from .models import Label, ModelM, ModelMM
+
+
+class LabelViewMixin(ProjectedReadMixin):
+    queryset = Label.objects.order_by('pk')
+    serializer_class = CQRSSerializerMeta._register[Label]
+    read_backend = 'mixin_tests'
+
+
+class LabelList(LabelViewMixin, generics.ListAPIView):
+    pass
+
+
+class LabelDetail(LabelViewMixin, generics.RetrieveAPIView):
+    pass
+
+
+class PlainLabelSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Label
+        fields = 'id', 'name'
+
+
+class SparseLabelList(LabelList):
+
+    def get_serializer(self, instance=None, many=False, **kwargs):
+        return self.get_serializer_class()(
+            instance, many=many, context=self.get_serializer_context(),
+            requested_fields=('id',))
+
+
+class ProjectedReadMixinTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='mixin_tests')
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.labels = [Label.objects.create(name=name)
+                       for name in ('classics', 'poetry', 'drama')]
+        self.backend.sync_collection(self.collection)
+        # Documents the view can only have got from the backend, and one it
+        # hasn't got at all.
+        self.backend.changed(self.collection, self.labels[0].pk,
+                             {'_id': self.labels[0].pk, 'name': 'stored'})
+        self.backend.deleted(self.collection, self.labels[1].pk)
+
+    def expected(self, label, name=None):
+        data = dict(LabelViewMixin.serializer_class(label).data)
+        if name is not None:
+            data['name'] = name
+        return data
+
+    def get(self, pk=None, **initkwargs):
+        request = APIRequestFactory().get('/labels/')
+        if pk is None:
+            return LabelList.as_view(**initkwargs)(request)
+        return LabelDetail.as_view(**initkwargs)(request, pk=pk)
+
+    def test_retrieve(self):
+        response = self.get(self.labels[0].pk)
+        self.assertEqual(response.data,
+                         self.expected(self.labels[0], 'stored'))
+        # Not in the read model, so serialized.
+        response = self.get(self.labels[1].pk)
+        self.assertEqual(response.data, self.expected(self.labels[1]))
+        self.assertEqual(self.get(9999).status_code, 404)
+
+    def test_list(self):
+        response = self.get()
+        self.assertEqual(response.data, [
+            self.expected(self.labels[0], 'stored'),
+            self.expected(self.labels[1]),
+            self.expected(self.labels[2])])
+
+    def test_list_paginated(self):
+        response = self.get(paginate_by=2)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['results'], [
+            self.expected(self.labels[0], 'stored'),
+            self.expected(self.labels[1])])
+
+    def test_list_not_empty(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', PendingDeprecationWarning)
+            self.assertEqual(self.get(allow_empty=False).status_code, 200)
+            Label.objects.all().delete()
+            self.assertEqual(self.get(allow_empty=False).status_code, 404)
+
+    def test_other_serializers_serialize_live(self):
+        response = self.get(serializer_class=PlainLabelSerializer)
+        self.assertEqual(response.data, [
+            {'id': label.pk, 'name': label.name} for label in self.labels])
+        response = self.get(self.labels[0].pk,
+                            serializer_class=PlainLabelSerializer)
+        self.assertEqual(response.data,
+                         {'id': self.labels[0].pk, 'name': 'classics'})
+
+        request = APIRequestFactory().get('/labels/')
+        response = SparseLabelList.as_view()(request)
+        self.assertEqual(response.data,
+                         [{'id': label.pk} for label in self.labels])
+
+
+class ReadModelTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='read_model_tests')
+        cls.backend.listen = False
+        cls.m_collection = MCollection()
+        cls.mm_collection = MCollection()
+        cls.mm_collection.model = ModelMM
+        cls.mm_collection.name = 'read_model_tests_mm'
+        for collection in cls.m_collection, cls.mm_collection:
+            cls.backend.register(collection)
+
+    def read_model(self, model, **attrs):
+        view = ProjectedReadMixin()
+        view.read_backend = 'read_model_tests'
+        view.get_queryset = model.objects.all
+        for name, value in attrs.items():
+            setattr(view, name, value)
+        return view.get_read_model()
+
+    def test_most_specific(self):
+        self.assertEqual(self.read_model(ModelM),
+                         (self.backend, self.m_collection))
+        self.assertEqual(self.read_model(ModelMM),
+                         (self.backend, self.mm_collection))
+        with self.assertRaises(ImproperlyConfigured):
+            self.read_model(Label)
+
+    def test_ambiguous(self):
+        other = MCollection()
+        other.name = 'read_model_tests_other'
+        self.backend.register(other)
+        self.addCleanup(self.backend.collections.pop, other.name)
+        with self.assertRaises(ImproperlyConfigured):
+            self.read_model(ModelM)
+        self.assertEqual(
+            self.read_model(ModelM, read_collection=other.name),
+            (self.backend, other))
@@ -0,0 +1,351 @@
+from copy import deepcopy
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+
+from ..cache import CachingBackendMixin, MemoryInvalidationChannel
+from .. import mongo
+from ..indexes import Index
+from ..keymap import MemoryKeyMapStore, key_maps
+from ..mongo import PolymorphicMongoIDBackend
+from ..typecodes import MemoryTypeCodeStore, type_codes
+
+from .collections import LabelCollection, MCollection
+from .models import Label
+from .serializers import MSerializer
+
+
+def _ids(spec):
+    """The ids an ``{'_id': ...}`` spec selects, or ``None`` for all."""
+    if '_id' not in spec:
+        return None
+    if isinstance(spec['_id'], dict):
+        return list(spec['_id']['$in'])
+    return [spec['_id']]
+
+
+class FakeBulk(object):
+    """Just enough of a pymongo unordered bulk operation."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.ops = []
+
+    def find(self, spec):
+        bulk = self
+
+        class Op(object):
+            def upsert(self):
+                return self
+
+            def replace_one(self, doc):
+                bulk.ops.append((spec, doc))
+
+            def update_one(self, update):
+                bulk.ops.append((spec, update))
+
+        return Op()
+
+    def execute(self):
+        for spec, doc in self.ops:
+            self.collection.update(spec, doc, upsert=True)
+
+
+class FakeCollection(object):
+    """Just enough of a pymongo collection, keeping documents by ``_id``."""
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.docs = {}
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def _select(self, spec):
+        ids = _ids(spec)
+        if ids is None:
+            return sorted(self.docs)
+        return [doc_id for doc_id in ids if doc_id in self.docs]
+
+    def find(self, spec=None):
+        return [deepcopy(self.docs[doc_id])
+                for doc_id in self._select(spec or {})]
+
+    def find_one(self, spec):
+        docs = self.find(spec)
+        return docs[0] if docs else None
+
+    def _created(self):
+        # Writing to a collection (re-)creates it.
+        self.db.collections.setdefault(self.name, self)
+
+    def insert(self, docs):
+        self._created()
+        for doc in docs:
+            assert doc['_id'] not in self.docs, 'Duplicate key'
+            self.docs[doc['_id']] = deepcopy(doc)
+        self.db.inserted(self)
+
+    def update(self, spec, doc, upsert=False):
+        self._created()
+        doc_id = spec['_id']
+        if '$set' in doc:
+            stored = self.docs.setdefault(doc_id, {'_id': doc_id})
+            stored.update(deepcopy(doc['$set']))
+        else:
+            self.docs[doc_id] = dict(deepcopy(doc), _id=doc_id)
+        return {'n': 1}
+
+    def remove(self, spec):
+        for doc_id in self._select(spec):
+            del self.docs[doc_id]
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self)
+
+    def drop(self):
+        self.docs.clear()
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+        self.db.collections.pop(self.name, None)
+
+    def rename(self, name, dropTarget=False):
+        assert dropTarget or name not in self.db.collections
+        del self.db.collections[self.name]
+        self.name = name
+        self.db.collections[name] = self
+
+    def index_information(self):
+        return deepcopy(self.indexes)
+
+    def create_index(self, keys, background=False, name=None, **options):
+        self.indexes[name] = dict(options, key=keys)
+
+
+class FakeDB(object):
+    """
+    Just enough of a pymongo database. ``on_insert``, if given, is called
+    with each collection inserted into.
+    """
+
+    def __init__(self, on_insert=None):
+        self.collections = {}
+        self.on_insert = on_insert
+
+    def __getattr__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def inserted(self, collection):
+        if self.on_insert is not None:
+            self.on_insert(collection)
+
+
+class RegisterTests(TestCase):
+
+    def backend(self, name):
+        backend = PolymorphicMongoIDBackend(name=name)
+        backend.db = FakeDB()
+        backend.listen = False
+        return backend
+
+    def test_type_codes_need_store(self):
+        MSerializer.use_type_codes = True
+        self.addCleanup(delattr, MSerializer, 'use_type_codes')
+        self.addCleanup(type_codes.set_store, None)
+
+        type_codes.set_store(None)
+        backend = self.backend('register_tests_unstored')
+        with self.assertRaises(ImproperlyConfigured):
+            backend.register(MCollection())
+        self.assertEqual(backend.collections, {})
+
+        type_codes.set_store(MemoryTypeCodeStore())
+        backend = self.backend('register_tests_stored')
+        collection = MCollection()
+        backend.register(collection)
+        self.assertEqual(backend.collections.keys(), [collection.name])
+
+
+    def test_key_maps_need_store(self):
+        self.addCleanup(key_maps.set_store, None)
+        collection = LabelCollection()
+        collection.key_map = True
+
+        key_maps.set_store(None)
+        backend = self.backend('register_tests_unmapped')
+        with self.assertRaises(ImproperlyConfigured):
+            backend.register(collection)
+
+        key_maps.set_store(MemoryKeyMapStore())
+        backend = self.backend('register_tests_mapped')
+        backend.register(collection)
+        self.assertEqual(backend.collections.keys(), [collection.name])
+
+
+class EnsureIndexesTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMongoIDBackend(name='ensure_indexes_tests')
+        cls.backend.listen = False
+        cls.collection = LabelCollection()
+        cls.collection.key_map = {'name': 'n'}
+        cls.collection.indexes = (
+            Index('name', '-id', partial={'$or': [{'name': 'classics'},
+                                                  {'name.x': {'$gt': 1}}]}),)
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.backend.db = self.db = FakeDB()
+
+    def test_compressed(self):
+        self.assertEqual(self.backend.ensure_indexes(self.collection),
+                         ['name_1_id_-1'])
+        index = self.db.collections[self.collection.name].indexes[
+            'name_1_id_-1']
+        self.assertEqual(index['key'], [('n', 1), ('id', -1)])
+        self.assertEqual(index['partialFilterExpression'],
+                         {'$or': [{'n': 'classics'}, {'n.x': {'$gt': 1}}]})
+        # What exists is recognized as what's declared.
+        warnings = []
+        mongo.log.warning = lambda *args: warnings.append(args)
+        self.addCleanup(delattr, mongo.log, 'warning')
+        self.assertEqual(self.backend.ensure_indexes(self.collection), [])
+        self.assertEqual(warnings, [])
+
+
+class RebuildTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMongoIDBackend(name='rebuild_tests')
+        cls.backend.db = FakeDB()
+        cls.collection = LabelCollection()
+        cls.collection.key_map = {'name': 'n'}
+        cls.collection.indexes = (Index('type'),)
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.backend.db = self.db = FakeDB()
+        self.labels = [Label.objects.create(name=name)
+                       for name in ('classics', 'poetry', 'drama')]
+
+    def live(self):
+        return self.db.collections[self.collection.name]
+
+    def assertRebuilt(self):
+        self.assertEqual(self.db.collections.keys(), [self.collection.name])
+        expected = {}
+        for label in Label.objects.all():
+            doc = self.collection.dump(label)
+            doc['_id'] = doc.pop('id')
+            doc['n'] = doc.pop('name')
+            expected[label.pk] = doc
+        self.assertEqual(self.live().docs, expected)
+        self.assertEqual(self.backend._captures, {})
+
+    def test_rebuild(self):
+        # Stale and orphaned documents.
+        self.live().docs[self.labels[0].pk]['n'] = 'stale'
+        self.live().docs[999] = {'_id': 999, 'n': 'orphan'}
+        shadow = self.collection.name + self.backend.shadow_suffix
+        self.db.collections[shadow] = FakeCollection(self.db, shadow)
+        self.db.collections[shadow].docs[998] = {'_id': 998}
+
+        self.assertEqual(
+            self.backend.rebuild_collection(self.collection, batch_size=2), 3)
+        self.assertRebuilt()
+        # The declared indexes were built on the shadow, and came with it.
+        self.assertIn('type_1', self.live().indexes)
+        # Stored with short keys, and read back with long ones.
+        self.assertEqual(
+            self.backend.get_doc(self.collection, self.labels[0].pk)['name'],
+            'classics')
+
+    def test_catch_up(self):
+        labels = self.labels
+
+        def write_meanwhile(collection):
+            if collection.name == self.collection.name:
+                return
+            # Once, during the first batch of inserts into the shadow.
+            self.db.on_insert = None
+            labels[0].name = 'old stuff'
+            labels[0].save()
+            labels[1].delete()
+            labels.extend([Label.objects.create(name='ephemera'),
+                           Label.objects.create(name='juvenilia')])
+
+        catch_ups = []
+        catch_up = self.backend._catch_up
+
+        def recording_catch_up(shadow, doc_ids):
+            catch_ups.append((sorted(doc_ids),
+                              self.backend._rebuild_lock._is_owned()))
+            return catch_up(shadow, doc_ids)
+
+        self.db.on_insert = write_meanwhile
+        deleted_id = labels[1].pk
+        self.backend._catch_up = recording_catch_up
+        try:
+            self.backend.rebuild_collection(self.collection, batch_size=2)
+        finally:
+            del self.backend._catch_up
+
+        self.assertRebuilt()
+        self.assertNotIn(deleted_id, self.live().docs)
+        self.assertEqual(self.live().docs[labels[0].pk]['n'], 'old stuff')
+        # Too many to catch up on with writes held up, then the rest (none)
+        # with them held up, just before the swap.
+        self.assertEqual(catch_ups, [
+            (sorted([labels[0].pk, deleted_id, labels[3].pk, labels[4].pk]),
+             False),
+            ([], True)])
+
+    def test_failure(self):
+        def fail(collection):
+            raise RuntimeError('Out of disk')
+
+        before = deepcopy(self.live().docs)
+        self.db.on_insert = fail
+        with self.assertRaises(RuntimeError):
+            self.backend.rebuild_collection(self.collection)
+        # The live collection is untouched, and writes aren't captured any
+        # more.
+        self.assertEqual(self.live().docs, before)
+        self.assertEqual(self.backend._captures, {})
+
+
+class CachingMongoBackend(CachingBackendMixin, PolymorphicMongoIDBackend):
+    pass
+
+
+class CachedRebuildTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.channel = MemoryInvalidationChannel()
+        cls.backend = CachingMongoBackend(
+            name='cached_rebuild_tests', invalidation_channel=cls.channel)
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.backend.db = self.db = FakeDB()
+        self.label = Label.objects.create(name='classics')
+        self.published = []
+        self.channel.subscribe(
+            lambda name, doc_ids: self.published.append((name, doc_ids)))
+        self.addCleanup(self.channel._subscribers.pop)
+
+    def test_rebuild(self):
+        self.db.collections[self.collection.name].docs[self.label.pk][
+            'name'] = 'stale'
+        self.assertEqual(self.backend.get_doc(
+            self.collection, self.label.pk)['name'], 'stale')
+
+        self.backend.rebuild_collection(self.collection)
+        # The rebuilt document is read, not the cached one.
+        self.assertEqual(self.backend.get_doc(
+            self.collection, self.label.pk)['name'], 'classics')
+        self.assertEqual(self.published[-1], (self.collection.name, None))
@@ -0,0 +1,149 @@
+from datetime import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase
+
+from .. import settings
+from ..memory import PolymorphicMemoryBackend
+from ..polling import (ChangeLogSource, ChangePoller, ColumnSource,
+                       MemoryWatermarkStore, Watermarks, watermarks)
+
+from .collections import NoteCollection
+from .models import Label, Note, NoteChange
+
+
+made_stores = []
+
+
+def counted_store():
+    made_stores.append(MemoryWatermarkStore())
+    return made_stores[-1]
+
+
+class MongoLikeWatermarkStore(MemoryWatermarkStore):
+    """Keeps datetimes to the millisecond, as Mongo does."""
+
+    def save(self, name, watermark):
+        super(MongoLikeWatermarkStore, self).save(name, [
+            value.replace(microsecond=value.microsecond // 1000 * 1000,
+                          tzinfo=None)
+            if isinstance(value, datetime) else value
+            for value in watermark])
+
+
+class PollingTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='polling_tests')
+        # Nothing but polling.
+        cls.backend.listen = False
+        cls.collection = NoteCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        self.backend.sync_collection(self.collection)
+        watermarks.store._watermarks.clear()
+
+    def assertProjected(self):
+        expected = {}
+        for note in Note.objects.all():
+            doc = self.collection.dump(note)
+            doc['_id'] = doc.pop('id')
+            expected[note.pk] = doc
+        self.assertEqual(self.backend.data[self.collection.name], expected)
+
+    def test_column(self):
+        notes = [Note.objects.create(text=str(i)) for i in range(5)]
+        # No signals.
+        self.assertEqual(self.backend.count(self.collection), 0)
+        poller = ChangePoller(ColumnSource(Note, 'modified'),
+                              batch_size=2, backend_names=['polling_tests'])
+        self.assertEqual(poller.poll(), 2)
+        self.assertEqual(self.backend.count(self.collection), 2)
+        self.assertEqual(poller.poll_all(), 3)
+        self.assertProjected()
+
+        # Behind the ORM's back.
+        cursor = connection.cursor()
+        cursor.execute('UPDATE {} SET text = %s, modified = %s WHERE id = %s'
+                       .format(Note._meta.db_table),
+                       ['raw', '2999-01-01 00:00:00', notes[1].pk])
+        notes[3].text = 'saved'
+        notes[3].save()
+        self.assertEqual(poller.poll_all(), 2)
+        self.assertProjected()
+        self.assertEqual(poller.poll_all(), 0)
+
+        report = poller.report()
+        self.assertEqual(report['changes'], 7)
+        self.assertEqual(report['documents'], 7)
+
+    def test_change_log(self):
+        notes = [Note.objects.create(text=str(i)) for i in range(3)]
+        for note in notes:
+            NoteChange.objects.create(note_id=note.pk)
+        poller = ChangePoller(ChangeLogSource(Note, NoteChange, 'note_id'),
+                              backend_names=['polling_tests'])
+        self.assertEqual(poller.poll_all(), 3)
+        self.assertProjected()
+
+        NoteChange.objects.create(note_id=notes[0].pk)
+        notes[0].delete()
+        self.assertEqual(poller.poll_all(), 1)
+        self.assertProjected()
+
+        # A new poller carries on from the saved watermark.
+        poller = ChangePoller(ChangeLogSource(Note, NoteChange, 'note_id'))
+        self.assertEqual(poller.poll_all(), 0)
+
+    def test_watermark_round_trip(self):
+        [Note.objects.create(text=str(i)) for i in range(5)]
+        # All with the same time, to the microsecond.
+        Note.objects.update(modified=datetime(2014, 1, 1, 12, 0, 0, 123456))
+        store = watermarks.store
+        watermarks.set_store(MongoLikeWatermarkStore())
+        try:
+            poller = ChangePoller(ColumnSource(Note, 'modified'),
+                                  batch_size=2,
+                                  backend_names=['polling_tests'])
+            self.assertEqual([poller.poll() for _ in range(4)], [2, 2, 1, 0])
+            self.assertProjected()
+        finally:
+            watermarks.set_store(store)
+
+    def test_bulk_not_projected(self):
+        Note.objects.bulk_create([Note(text='a'), Note(text='b')])
+        Note.objects.update(text='c')
+        # Only polling brings it up to date.
+        self.assertEqual(self.backend.count(self.collection), 0)
+        poller = ChangePoller(ColumnSource(Note, 'modified'),
+                              backend_names=['polling_tests'])
+        self.assertEqual(poller.poll_all(), 2)
+        self.assertProjected()
+
+    def test_root_models_only(self):
+        poller = ChangePoller(ChangeLogSource(Label, NoteChange, 'note_id'),
+                              backend_names=['polling_tests'])
+        with self.assertRaises(ImproperlyConfigured):
+            poller.collections()
+        poller = ChangePoller(ChangeLogSource(Note, NoteChange, 'note_id'),
+                              backend_names=['polling_tests'])
+        self.assertEqual(poller.collections(),
+                         [(self.backend, self.collection)])
+
+    def test_configured_store(self):
+        setting = settings.CQRS_WATERMARK_STORE
+        settings.CQRS_WATERMARK_STORE = 'cqrs.tests.test_polling.counted_store'
+        try:
+            del made_stores[:]
+            store = Watermarks()
+            # Nothing is made until it's needed.
+            self.assertEqual(made_stores, [])
+            store.save('notes', [1, 2])
+            self.assertEqual(store.get('notes'), [1, 2])
+            self.assertEqual(len(made_stores), 1)
+            self.assertIs(store.store, made_stores[0])
+        finally:
+            settings.CQRS_WATERMARK_STORE = setting
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from ..replay import (Action, ADD, CHANGE, DELETE, Changes, EventWriter,
+                      read_events, collapse, replay, RecordingBackendMixin)
+
+from .backend import OpLogBackend
+from .collections import LabelCollection
+from .models import Label
+
+
+class RecordingOpLogBackend(RecordingBackendMixin, OpLogBackend):
+    pass
+
+
+class ReplayTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.recorder = RecordingOpLogBackend(
+            name='replay_tests_recorder',
+            events_path=os.path.join(cls.directory, 'recorded.events'))
+        cls.recorder.register(LabelCollection())
+        cls.backend = OpLogBackend(name='replay_tests')
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.backend.flush_oplog()
+
+    def test_collapse(self):
+        self.assertEqual(collapse([
+            Action(ADD, 'things', 1, {'id': 1, 'a': 1, 'b': 1}),
+            Action(ADD, 'things', 2, {'id': 2, 'a': 2}),
+            Action(CHANGE, 'things', 1, {'id': 1, 'b': 2}),
+            Action(DELETE, 'things', 2, None),
+            Action(ADD, 'others', 2, {'id': 2}),
+            Action(DELETE, 'others', 3, None),
+            Action(ADD, 'others', 3, {'id': 3}),
+        ]), {
+            ('things', 1): {'id': 1, 'a': 1, 'b': 2},
+            ('things', 2): None,
+            ('others', 2): {'id': 2},
+            ('others', 3): {'id': 3},
+        })
+
+    def test_collapse_changes_only(self):
+        final = collapse([
+            Action(CHANGE, 'things', 1, {'id': 1, 'a': 2}),
+            Action(CHANGE, 'things', 1, {'id': 1, 'b': 2}),
+            Action(CHANGE, 'things', 2, {'id': 2, 'a': 2}),
+            Action(ADD, 'things', 2, {'id': 2, 'b': 1}),
+            Action(DELETE, 'things', 3, None),
+            Action(CHANGE, 'things', 3, {'id': 3, 'a': 3}),
+        ])
+        self.assertEqual(final, {
+            ('things', 1): {'id': 1, 'a': 2, 'b': 2},
+            ('things', 2): {'id': 2, 'b': 1},
+            ('things', 3): {'id': 3, 'a': 3},
+        })
+        self.assertIsInstance(final['things', 1], Changes)
+        self.assertNotIsInstance(final['things', 2], Changes)
+        self.assertNotIsInstance(final['things', 3], Changes)
+
+        # Written as changes, leaving the rest of the document be.
+        name = self.collection.name
+        stats = replay([Action(CHANGE, name, 1, {'id': 1, 'a': 2}),
+                        Action(ADD, name, 2, {'id': 2})], self.backend)
+        self.assertEqual(stats.written, 2)
+        self.assertEqual(
+            sorted(self.backend.flush_oplog(), key=lambda op: op.doc_id),
+            [Action(CHANGE, self.collection, 1, {'id': 1, 'a': 2}),
+             Action(ADD, self.collection, 2, {'id': 2})])
+
+    def test_event_file(self):
+        path = os.path.join(self.directory, 'roundtrip.events')
+        events = [Action(ADD, 'things', 1, {'id': 1, 'name': u'caf\xe9'}),
+                  Action(DELETE, 'things', 1, None)]
+        writer = EventWriter(path)
+        for event in events:
+            writer.write(event)
+        writer.close()
+        self.assertEqual(list(read_events(path)), events)
+
+    def test_record_and_replay(self):
+        labels = [Label.objects.create(name=name)
+                  for name in ('classics', 'poetry', 'drama')]
+        labels[0].name = 'old stuff'
+        labels[0].save()
+        deleted_id = labels[2].id
+        labels[2].delete()
+        self.backend.flush_oplog()  # (This one's been listening, too.)
+
+        stats = replay(self.recorder.event_writer.path, self.backend,
+                       batch_size=1)
+        self.assertEqual((stats.events, stats.written, stats.deleted),
+                         (5, 2, 1))
+        self.assertEqual(
+            sorted(self.backend.flush_oplog(), key=lambda op: op.doc_id),
+            [Action(ADD, self.collection, label.id,
+                    self.collection.dump(label)) for label in labels[:2]] +
+            [Action(DELETE, self.collection, deleted_id, None)])
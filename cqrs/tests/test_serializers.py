@@ -1,15 +1,22 @@
 import re
+from decimal import Decimal
 
 from django.test import TestCase
 from django.forms.models import model_to_dict
+from django.utils.datastructures import SortedDict
 
+from ..memo import (SerializationMemo, batch_memo, current_memo,
+                    memo_report)
 from ..models import CQRSPolymorphicModel
-from ..serializers import CQRSPolymorphicSerializer, CQRSSerializerMeta
+from ..serializers import (CQRSPolymorphicSerializer, CQRSSerializer,
+                           CQRSSerializerMeta, document_value)
+from ..typecodes import type_codes
 
+from .collections import ShelfCollection
 from .models import (ModelA, ModelAA, ModelAAA, ModelAAM, ModelAM, ModelAMA,
                      ModelAMM, ModelM, ModelMA, ModelMAA, ModelMAM, ModelMM,
                      ModelMMA, ModelMMM, AutomaticMixer, BoringModel,
-                     OneMixingBowl, AnotherMixingBowl)
+                     OneMixingBowl, AnotherMixingBowl, Label, Shelf, Book)
 from .serializers import (AAMSerializer, AMSerializer, AMMSerializer,
                           MSerializer, MAMSerializer, MMSerializer,
                           MMMSerializer, BoringSerializer,
@@ -280,3 +287,206 @@ class PolymorphicSerializersTestCase(TestCase):
                                    'field_mm1', 'manual_mm3',
                                    'field_mmm1', 'manual_mmm3',
                                    })
+
+    def test_type_codes(self):
+        instance = ModelMM.create_test_instance()
+        expected = instance.as_test_serialized()
+        type_path = expected['type']
+
+        MSerializer.use_type_codes = True
+        try:
+            serialized = self.serializer.to_native(instance)
+        finally:
+            del MSerializer.use_type_codes
+
+        code = serialized.pop('type')
+        self.assertIsInstance(code, int)
+        self.assertEqual(type_codes.path_for(code), type_path)
+        self.assertEqual(type_codes.code_for(type_path), code)
+        del expected['type']
+        self.assertEqual(serialized, expected)
+
+        # Codes, strings of digits and type paths are all accepted.
+        for type_ in code, str(code), type_path:
+            serializer = CQRSPolymorphicSerializer()
+            deserialized = serializer.from_native(dict(expected, type=type_))
+            self.assertIsInstance(deserialized, ModelMM)
+
+        serializer = CQRSPolymorphicSerializer()
+        self.assertIs(serializer.from_native(dict(expected, type=9999)), None)
+        self.assertEqual(serializer.errors, {'type': ['Invalid type 9999.']})
+
+
+class DocumentTestCase(TestCase):
+    '''Tests for serializing straight into backend documents.'''
+
+    def assertIsDocumentOf(self, doc, data):
+        expected = document_value(data)
+        expected['_id'] = expected.pop('id')
+        self.assertEqual(doc, expected)
+
+        def check_plain(value):
+            self.assertFalse(isinstance(value, SortedDict), repr(value))
+            if isinstance(value, dict):
+                for item in value.values():
+                    check_plain(item)
+            elif isinstance(value, list):
+                for item in value:
+                    check_plain(item)
+        check_plain(doc)
+
+    def test_document_value(self):
+        self.assertEqual(document_value(
+            SortedDict([('price', Decimal('1.10')),
+                        ('parts', [SortedDict([('a', 1)])])])),
+            {'price': '1.10', 'parts': [{'a': 1}]})
+
+    def test_polymorphic_document(self):
+        for model in (ModelA, ModelAMM, ModelMAM):
+            instance = model.create_test_instance()
+            serializer = CQRSSerializerMeta._register.instances[type(instance)]
+            self.assertIsDocumentOf(serializer.to_document(instance),
+                                    serializer.to_native(instance))
+            # The base serializer dispatches, like to_native.
+            base = CQRSSerializerMeta._register.instances[
+                ModelA if model.prefix.startswith('a') else ModelM]
+            self.assertEqual(base.to_document(instance),
+                             serializer.to_document(instance))
+
+    def test_nested_document(self):
+        shelf = Shelf.objects.create(name='fiction')
+        Book.objects.create(shelf=shelf, title='Emma')
+        shelf.labels.add(Label.objects.create(name='classics'))
+        serializer = CQRSSerializerMeta._register.instances[Shelf]
+        doc = serializer.to_document(shelf)
+        self.assertIsDocumentOf(doc, serializer.to_native(shelf))
+        self.assertEqual(doc['books'][0]['title'], 'Emma')
+
+
+class MemoTestCase(TestCase):
+
+    def setUp(self):
+        self.label = Label.objects.create(name='classics')
+        self.shelves = [Shelf.objects.create(name=name)
+                        for name in ('fiction', 'poetry')]
+        for shelf in self.shelves:
+            shelf.labels.add(self.label)
+        self.serializer = CQRSSerializerMeta._register.instances[Shelf]
+
+    def test_memo_bounds(self):
+        memo = SerializationMemo(max_size=2)
+        calls = []
+
+        def compute(key):
+            return lambda: calls.append(key) or key.upper()
+
+        for key in ('a', 'b', 'a', 'c', 'b', 'a'):
+            self.assertEqual(memo.get_or_compute(key, compute(key)),
+                             key.upper())
+        # b went when c came in, as a had been used more recently.
+        self.assertEqual(calls, ['a', 'b', 'c', 'b', 'a'])
+        self.assertEqual((memo.hits, memo.misses), (1, 5))
+        self.assertEqual(len(memo), 2)
+
+    def test_batch(self):
+        self.assertIsNone(current_memo())
+        unbatched = [self.serializer.to_native(shelf)
+                     for shelf in self.shelves]
+        with batch_memo() as memo:
+            with batch_memo() as inner:
+                self.assertIs(inner, memo)
+            batched = [self.serializer.to_native(shelf)
+                       for shelf in self.shelves]
+            documents = [self.serializer.to_document(shelf)
+                         for shelf in self.shelves]
+        self.assertIsNone(current_memo())
+        self.assertEqual(batched, unbatched)
+        # The label was serialized once each way, and shared.
+        self.assertEqual((memo.hits, memo.misses), (2, 2))
+        self.assertIs(batched[0]['labels'][0], batched[1]['labels'][0])
+        self.assertIs(documents[0]['labels'][0], documents[1]['labels'][0])
+        self.assertEqual(ShelfCollection().dump_many(self.shelves), unbatched)
+
+    def test_unbatched(self):
+        first, second = [self.serializer.to_native(shelf)
+                         for shelf in self.shelves]
+        self.assertEqual(first['labels'], second['labels'])
+        self.assertIsNot(first['labels'][0], second['labels'][0])
+
+    def test_cached_fields(self):
+        bowl = OneMixingBowl.create_test_instance()
+        serializer = CQRSSerializerMeta._register.instances[OneMixingBowl]
+        with batch_memo() as memo:
+            first = serializer.to_native(bowl)
+            # Another copy of the same object is the same object.
+            again = OneMixingBowl.objects.get(pk=bowl.pk)
+            self.assertEqual(serializer.to_document(again)['total'],
+                             first['total'])
+            # Without a cache_version, a change goes unnoticed in the batch.
+            again.water += 1
+            self.assertEqual(serializer.to_native(again)['total'],
+                             first['total'])
+        self.assertEqual(memo.report(), {'OneMixingBowlSerializer.total': {
+            'hits': 2, 'misses': 1, 'hit_rate': 2 / 3.0}})
+        self.assertEqual(serializer.to_native(again)['total'],
+                         first['total'] + 1)
+        self.assertGreaterEqual(
+            memo_report()['OneMixingBowlSerializer.total']['hits'], 2)
+
+        serializer.cache_version = 'water'
+        try:
+            with batch_memo():
+                self.assertEqual(serializer.to_native(bowl)['total'],
+                                 first['total'])
+                self.assertEqual(serializer.to_native(again)['total'],
+                                 first['total'] + 1)
+        finally:
+            del serializer.cache_version
+
+
+class SparseFieldsTestCase(TestCase):
+
+    def setUp(self):
+        self.instance = ModelAMM.create_test_instance()
+        self.full = CQRSSerializerMeta._register.instances[
+            ModelAMM].to_native(self.instance)
+
+    def test_polymorphic_dispatch(self):
+        base = CQRSSerializerMeta._register.instances[ModelA]
+        fields = ['id', 'field_am1', 'manual_amm3', 'no_such_field']
+        data = base.to_native(self.instance, fields)
+        self.assertEqual(data.keys(), ['id', 'field_am1', 'manual_amm3'])
+        self.assertEqual(dict(data), dict((key, self.full[key])
+                                          for key in data))
+        amm = CQRSSerializerMeta._register.instances[ModelAMM]
+        self.assertEqual(
+            CQRSSerializer._field_subsets[AMMSerializer, tuple(amm.fields),
+                                          frozenset(fields)],
+            ['id', 'field_am1', 'manual_amm3'])
+
+    def test_dynamic_fields(self):
+        # Fields dropped by an instance, as DRF's dynamic fields pattern
+        # does, aren't taken from another instance's subset.
+        fields = ['id', 'field_am1']
+        self.assertEqual(
+            AMMSerializer().to_native(self.instance, fields).keys(), fields)
+        serializer = AMMSerializer()
+        del serializer.fields['field_am1']
+        self.assertEqual(serializer.to_native(self.instance, fields).keys(),
+                         ['id'])
+
+    def test_unrequested_fields_not_evaluated(self):
+        def explode():
+            raise AssertionError('calc_am3 was called')
+        self.instance.calc_am3 = explode
+        data = CQRSPolymorphicSerializer().to_native(self.instance,
+                                                     ['type', 'field_amm1'])
+        self.assertEqual(dict(data), {'type': self.full['type'],
+                                      'field_amm1': self.full['field_amm1']})
+
+    def test_requested_fields(self):
+        serializer = CQRSSerializerMeta._register[ModelA](
+            self.instance, requested_fields=('id', 'field_a1'))
+        self.assertEqual(dict(serializer.data),
+                         {'id': self.instance.id,
+                          'field_a1': self.full['field_a1']})
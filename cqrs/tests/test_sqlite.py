@@ -0,0 +1,70 @@
+from django.test import TestCase
+
+from ..sqlite import PolymorphicSQLiteBackend
+
+from .collections import LabelCollection
+from .models import Label
+
+
+class SQLiteBackendTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicSQLiteBackend(name='sqlite_tests',
+                                               batch_size=2)
+        cls.collection = LabelCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        with self.backend.connection:
+            self.backend.connection.execute(
+                'DELETE FROM "{}"'.format(self.collection.name))
+
+    def expected(self, label):
+        doc = self.collection.dump(label)
+        doc['_id'] = doc.pop('id')
+        return doc
+
+    def test_signals(self):
+        label = Label.objects.create(name='classics')
+        self.assertEqual(self.backend.get_doc(self.collection, label.id),
+                         self.expected(label))
+        label.name = 'old stuff'
+        label.save()
+        self.assertEqual(self.backend.get_doc(self.collection, label.id),
+                         self.expected(label))
+        label_id = label.id
+        label.delete()
+        self.assertIsNone(self.backend.get_doc(self.collection, label_id))
+
+    def test_changed_merges(self):
+        self.backend.added(self.collection, 1, {'_id': 1, 'name': 'a',
+                                                'extra': [1, 2]})
+        self.backend.changed(self.collection, 1, {'_id': 1, 'name': 'b'})
+        self.assertEqual(self.backend.get_doc(self.collection, 1),
+                         {'_id': 1, 'name': 'b', 'extra': [1, 2]})
+
+    def test_many(self):
+        self.backend.added_many(self.collection, [
+            (i, {'_id': i, 'name': str(i)}) for i in range(5)])
+        self.assertEqual(self.backend.count(self.collection), 5)
+        self.backend.changed_many(self.collection, [
+            (i, {'_id': i, 'name': 'changed'}) for i in range(3, 7)])
+        self.assertEqual(self.backend.count(self.collection), 7)
+        self.assertEqual(self.backend.get_doc(self.collection, 4),
+                         {'_id': 4, 'name': 'changed'})
+        self.backend.deleted_many(self.collection, range(1, 6))
+        self.assertEqual(self.backend.count(self.collection), 2)
+        self.assertEqual(self.backend.get_doc(self.collection, 0),
+                         {'_id': 0, 'name': '0'})
+
+    def test_sync_collection(self):
+        labels = [Label.objects.create(name=name)
+                  for name in ('a', 'b', 'c', 'd', 'e')]
+        self.backend.added(self.collection, 999, {'_id': 999})
+        self.assertEqual(self.backend.sync_collection(self.collection), 5)
+        self.assertEqual(self.backend.count(self.collection), 5)
+        self.assertIsNone(self.backend.get_doc(self.collection, 999))
+        for label in labels:
+            self.assertEqual(self.backend.get_doc(self.collection, label.id),
+                             self.expected(label))
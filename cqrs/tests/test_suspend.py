@@ -0,0 +1,74 @@
+from django.test import TestCase
+
+from ..memory import PolymorphicMemoryBackend
+from ..suspend import suspend_projection
+
+from .collections import BookCollection, LabelCollection, ShelfCollection
+from .models import Label, Shelf, Book
+
+
+class SuspendProjectionTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicMemoryBackend(name='suspend_tests')
+        cls.label_collection = LabelCollection()
+        cls.shelf_collection = ShelfCollection()
+        cls.book_collection = BookCollection()
+        cls.book_collection.fanout_paths = ()
+        for collection in (cls.label_collection, cls.shelf_collection,
+                           cls.book_collection):
+            cls.backend.register(collection)
+
+    def setUp(self):
+        for collection in self.backend.collections.values():
+            self.backend.sync_collection(collection)
+        self.backend.flush_oplog()
+
+    def assertProjected(self, collection):
+        expected = {}
+        for obj in collection.queryset():
+            doc = collection.dump(obj)
+            doc['_id'] = doc.pop('id')
+            expected[obj.pk] = doc
+        self.assertEqual(self.backend.data[collection.name], expected)
+
+    def test_suspend(self):
+        gone = Label.objects.create(name='gone')
+        self.backend.flush_oplog()
+        with suspend_projection() as suspension:
+            # No queries beyond the inserts themselves.
+            with self.assertNumQueries(3):
+                labels = [Label.objects.create(name=name) for name in 'abc']
+            shelf = Shelf.objects.create(name='fiction')
+            shelf.labels.add(labels[0])
+            labels[0].name = 'changed'
+            labels[0].save()
+            Book.objects.create(shelf=shelf, title='Emma')
+            gone.delete()
+            self.assertEqual(list(self.backend.oplog), [])
+        for collection in self.backend.collections.values():
+            self.assertProjected(collection)
+        # Each document written (or deleted) once: four labels, a shelf and
+        # a book. (Other tests' backends have them too.)
+        self.assertEqual(len(self.backend.flush_oplog()), 6)
+        self.assertGreaterEqual(suspension.written, 6)
+
+    def test_chosen_collections(self):
+        with suspend_projection([LabelCollection]):
+            label = Label.objects.create(name='a')
+            shelf = Shelf.objects.create(name='fiction')
+            self.assertIsNone(
+                self.backend.get_doc(self.label_collection, label.pk))
+            self.assertIsNotNone(
+                self.backend.get_doc(self.shelf_collection, shelf.pk))
+        self.assertProjected(self.label_collection)
+
+    def test_exception(self):
+        with self.assertRaises(ValueError):
+            with suspend_projection():
+                label = Label.objects.create(name='a')
+                raise ValueError
+        # It's in the database, so it's projected all the same.
+        self.assertIsNotNone(
+            self.backend.get_doc(self.label_collection, label.pk))
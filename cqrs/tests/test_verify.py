@@ -0,0 +1,108 @@
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+
+from ..sqlite import PolymorphicSQLiteBackend
+from ..verify import RangeVerifier, resync
+
+from .backend import OpLogBackend
+from .collections import NoteCollection
+from .models import Note
+
+
+class RangeVerifierTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = PolymorphicSQLiteBackend(name='verify_tests',
+                                               batch_size=7)
+        # Drift is made by hand.
+        cls.backend.listen = False
+        cls.collection = NoteCollection()
+        cls.backend.register(cls.collection)
+
+    def setUp(self):
+        Note.objects.bulk_create([Note(id=i, text=str(i))
+                                  for i in range(1, 101)])
+        self.backend.sync_collection(self.collection)
+
+    def verifier(self):
+        return RangeVerifier(self.backend, self.collection, branching=4,
+                             leaf_size=8)
+
+    def assertProjected(self):
+        self.assertEqual(
+            [(doc_id, doc['text']) for doc_id, doc
+             in self.backend.docs_in_range(self.collection)],
+            list(Note.objects.order_by('pk').values_list('pk', 'text')))
+
+    def test_clean(self):
+        verifier = self.verifier()
+        self.assertEqual(verifier.verify(), [])
+        # Each side read once, and no range looked at any closer.
+        self.assertEqual(verifier.stats['documents'], 200)
+        self.assertEqual(verifier.stats['ranges'], 6)
+
+    def drift(self):
+        self.backend.changed(self.collection, 10, {'_id': 10, 'text': 'x'})
+        self.backend.deleted(self.collection, 55)
+        self.backend.added(self.collection, 5000, {'_id': 5000, 'text': 'y'})
+        # Behind the ORM's back.
+        cursor = connection.cursor()
+        cursor.execute('UPDATE {} SET text = %s WHERE id = %s'
+                       .format(Note._meta.db_table), ['raw', 70])
+
+    def test_drift(self):
+        self.drift()
+        verifier = self.verifier()
+        self.assertEqual(verifier.verify(repair=False), [10, 55, 70, 5000])
+        # Only the ranges with drift in were read again.
+        self.assertLess(verifier.stats['documents'], 400)
+        self.assertEqual(self.backend.count(self.collection), 100)
+
+        self.assertEqual(self.verifier().verify(), [10, 55, 70, 5000])
+        self.assertProjected()
+        self.assertEqual(self.verifier().verify(), [])
+
+    def test_empty(self):
+        Note.objects.all().delete()
+        self.assertEqual(self.verifier().verify(), range(1, 101))
+        self.assertEqual(self.backend.count(self.collection), 0)
+
+    def test_resync(self):
+        self.drift()
+        writes = []
+        added_many = self.backend.added_many
+
+        def log_added_many(collection, docs):
+            writes.append([doc_id for doc_id, doc in docs])
+            return added_many(collection, docs)
+        self.backend.added_many = log_added_many
+        self.addCleanup(delattr, self.backend, 'added_many')
+
+        self.assertEqual(resync(self.backend, self.collection, batch_size=2),
+                         {'documents': 100, 'added': 1, 'changed': 2,
+                          'deleted': 1})
+        self.assertEqual(writes, [[10, 55], [70]])
+        self.assertProjected()
+        self.assertEqual(self.verifier().verify(repair=False), [])
+        # Nothing to do any more.
+        self.assertEqual(resync(self.backend, self.collection),
+                         {'documents': 100, 'added': 0, 'changed': 0,
+                          'deleted': 0})
+
+    def test_command(self):
+        connection.cursor().execute(
+            'UPDATE {} SET text = %s WHERE id = %s'.format(
+                Note._meta.db_table), ['changed', 3])
+        out = StringIO()
+        call_command('cqrs_verify', 'verify_tests', dry_run=True, stdout=out)
+        self.assertIn('{}: 1 drifted'.format(self.collection.name),
+                      out.getvalue())
+
+        OpLogBackend(name='verify_tests_oplog')
+        with self.assertRaises(CommandError):
+            call_command('cqrs_verify', 'verify_tests_oplog')
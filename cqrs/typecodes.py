@@ -0,0 +1,130 @@
+'''
+Compact integer codes for polymorphic type paths.
+
+A polymorphic document's ``type`` is normally the model's full path (e.g.
+``'shop.models.EBook'``), repeated in every single document and every entry of
+the type index. With type codes turned on (``use_type_codes`` on a
+:class:`~cqrs.serializers.CQRSPolymorphicSerializer`, or
+``CQRS_TYPE_CODES = True`` for all of them), a small integer is stored instead.
+
+The codes come from a persisted type table, so that they're stable across
+processes and deploys: with ``CQRS_TYPE_CODE_STORE =
+'cqrs.mongo.type_code_store'``, it's kept in a side collection. Each process
+caches the table, and only goes back to the store for a type it hasn't seen
+before. A Mongo backend won't take a collection using type codes unless a store
+is configured (or set with :meth:`TypeCodeTable.set_store`).
+
+Deserialization accepts either form, so clients which send type paths keep
+working.
+'''
+
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_by_path
+
+from . import settings
+
+
+class MemoryTypeCodeStore(object):
+    """
+    A type table store which lives only in memory. This is what you get if
+    ``CQRS_TYPE_CODE_STORE`` isn't set; it's fine for tests and a single
+    process, but each process numbers the types its own way.
+
+    A store needs just two methods: :meth:`load`, giving the whole table as a
+    dictionary of type path to code, and :meth:`allocate`, giving the code for
+    a type path, allocating a new one if need be.
+    """
+
+    def __init__(self):
+        self._codes = {}
+
+    def load(self):
+        return dict(self._codes)
+
+    def allocate(self, type_path):
+        if type_path not in self._codes:
+            self._codes[type_path] = len(self._codes) + 1
+        return self._codes[type_path]
+
+
+class TypeCodeTable(object):
+    """
+    The in-process cache of the type table, in both directions.
+    """
+
+    def __init__(self, store=None):
+        self._lock = threading.RLock()
+        self.set_store(store)
+
+    def set_store(self, store):
+        """
+        Switch to a different store (``None`` for the configured one),
+        forgetting everything cached.
+        """
+        with self._lock:
+            self._store = store
+            self._codes = {}
+            self._paths = {}
+
+    @property
+    def store(self):
+        # Made when it's first needed, so that nothing is touched by a
+        # process which never uses type codes.
+        with self._lock:
+            if self._store is None:
+                if settings.CQRS_TYPE_CODE_STORE:
+                    self._store = import_by_path(
+                        settings.CQRS_TYPE_CODE_STORE)()
+                else:
+                    self._store = MemoryTypeCodeStore()
+            return self._store
+
+    def check_persistent(self, name):
+        """
+        Check that the codes written to the collection ``name`` will mean
+        the same thing to every process, i.e. that the store isn't the
+        in-memory default.
+
+        :raises ImproperlyConfigured: if no store is configured
+        """
+        with self._lock:
+            if self._store is None and not settings.CQRS_TYPE_CODE_STORE:
+                raise ImproperlyConfigured(
+                    "{} uses type codes, which need CQRS_TYPE_CODE_STORE "
+                    "(e.g. 'cqrs.mongo.type_code_store') to be stored"
+                    .format(name))
+
+    def _remember(self, type_path, code):
+        self._codes[type_path] = code
+        self._paths[code] = type_path
+
+    def code_for(self, type_path):
+        """Get the code for a type path, allocating one if necessary."""
+        try:
+            return self._codes[type_path]
+        except KeyError:
+            with self._lock:
+                code = self.store.allocate(type_path)
+                self._remember(type_path, code)
+            return code
+
+    def path_for(self, code):
+        """
+        Get the type path for a code.
+
+        :raises KeyError: if the code isn't in the table (even after
+                          reloading it, in case another process allocated it)
+        """
+        try:
+            return self._paths[code]
+        except KeyError:
+            with self._lock:
+                for type_path, stored_code in self.store.load().items():
+                    self._remember(type_path, stored_code)
+            return self._paths[code]
+
+
+#: The type table used by the serializers.
+type_codes = TypeCodeTable()
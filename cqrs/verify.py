@@ -0,0 +1,272 @@
+'''
+Checking a read model against the database, cheaply.
+
+A full sync proves a collection's documents are right by rewriting every one
+of them. :class:`RangeVerifier` finds out which (if any) are wrong, without
+writing anything that isn't, by comparing digests of ranges of ids::
+
+    verifier = RangeVerifier(backend, ProductCollection())
+    drifted = verifier.verify()
+    log.info('%d products re-projected: %r', len(drifted), verifier.stats)
+
+The primary key space (from the smallest key in the database to the largest)
+is split into ``CQRS_VERIFY_BRANCHING`` ranges, and for each of them an MD5
+digest is made of the documents as they'd be dumped now and another of the
+documents as the backend has them (see
+:meth:`~cqrs.backend.PolymorphicBackendBase.docs_in_range`). Only the ranges
+whose digests differ are looked at any closer: they're split up in turn,
+until a range spans no more than ``CQRS_BULK_CHUNK_SIZE`` keys, when its
+documents are compared one by one. The ids of the documents which differ,
+are missing, or shouldn't be there at all (including any outside the
+database's range of keys) are reconciled (see :func:`cqrs.bulk.reconcile`),
+unless ``repair=False``.
+
+So everything is read once, on both sides, and a range of keys with drift in
+it is read again once per level (of which there are few), but the only
+writes are of the documents which need them. It's meant for a nightly
+check; for keeping up with changes made behind the ORM's back, see
+:mod:`cqrs.polling`.
+
+When much of a collection is likely to be wrong, :func:`resync` is the
+better bet: it merge-joins the objects and the stored documents in a single
+ordered pass over each, writing what's missing or different and deleting the
+orphans (documents whose objects were deleted behind the ORM's back, or
+whose deletion failed to project), without holding more than a batch in
+memory. It's what backends which can read their documents back use for
+``sync_collection`` if they don't have one of their own.
+
+Documents are compared as JSON (with sorted keys), so that a document read
+back from SQLite compares equal to its freshly dumped self. Values a backend
+doesn't keep exactly will always look drifted: Mongo keeps datetimes to the
+millisecond, so documents with microseconds in them are rewritten every
+time. Collections' documents must be keyed by the primary key, which must be
+an integer.
+'''
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import time
+from bisect import bisect_right
+
+from django.db.models import Max, Min
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import settings
+from .bulk import reconcile
+from .memo import batch_memo
+
+
+log = logging.getLogger(__name__)
+
+
+def canonical(doc):
+    """
+    Get a document as a string which is the same however it was stored:
+    JSON, with sorted keys, and ``id`` as ``_id``.
+    """
+    doc = dict(doc)
+    if 'id' in doc:
+        doc['_id'] = doc.pop('id')
+    return json.dumps(doc, cls=JSONEncoder, sort_keys=True,
+                      separators=(',', ':'))
+
+
+def dumped_docs(backend, collection, lo=None, hi=None):
+    """
+    Generate ``(pk, document)`` for the objects with ``lo <= pk < hi`` (either
+    bound may be ``None``), in order, dumped as ``backend`` wants them,
+    ``CQRS_BULK_CHUNK_SIZE`` at a time.
+    """
+    queryset = collection.queryset()
+    if lo is not None:
+        queryset = queryset.filter(pk__gte=lo)
+    if hi is not None:
+        queryset = queryset.filter(pk__lt=hi)
+    queryset = queryset.order_by('pk')
+    size = settings.CQRS_BULK_CHUNK_SIZE
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        with batch_memo():
+            docs = [(obj.pk, backend.document_for(collection, obj))
+                    for obj in chunk[:size]]
+        for pair in docs:
+            yield pair
+        if len(docs) < size:
+            return
+        last = docs[-1][0]
+
+
+_END = object()
+
+
+def _merge(source, stored):
+    """
+    Merge-join two streams of ``(id, document)`` in order of id, generating
+    ``(id, source document, stored document)``, with ``None`` for a side
+    which doesn't have it.
+    """
+    source, stored = iter(source), iter(stored)
+    left, right = next(source, _END), next(stored, _END)
+    while left is not _END or right is not _END:
+        if right is _END or (left is not _END and left[0] < right[0]):
+            yield left[0], left[1], None
+            left = next(source, _END)
+        elif left is _END or right[0] < left[0]:
+            yield right[0], None, right[1]
+            right = next(stored, _END)
+        else:
+            yield left[0], left[1], right[1]
+            left, right = next(source, _END), next(stored, _END)
+
+
+def _write_upserts(backend, collection, docs):
+    # By way of _call_added_many, like the other bulk writes, so that a
+    # journal (see cqrs.journal) sees them; the documents are dumped already.
+    backend._call_added_many(collection, [doc_id for doc_id, _ in docs], docs)
+
+
+def resync(backend, collection, batch_size=None):
+    """
+    Bring everything a backend has for a collection into line with the
+    database, by streaming the objects and the stored documents side by side
+    in order of id: documents which are missing or differ are written (with
+    ``_call_added_many``, which replaces them), and those whose objects have
+    gone are deleted (with ``_call_deleted_many``), ``batch_size`` (by
+    default ``CQRS_BULK_CHUNK_SIZE``) at a time. Memory use doesn't grow with
+    the size of the collection, and documents which are right aren't written
+    at all.
+
+    Returns a dictionary counting the documents there should be, and those
+    added, changed and deleted.
+    """
+    batch_size = batch_size or settings.CQRS_BULK_CHUNK_SIZE
+    stats = {'documents': 0, 'added': 0, 'changed': 0, 'deleted': 0}
+    upserts, orphans = [], []
+    t0 = time.time()
+    for doc_id, doc, stored in _merge(
+            dumped_docs(backend, collection),
+            backend.docs_in_range(collection)):
+        if doc is None:
+            orphans.append(doc_id)
+            stats['deleted'] += 1
+        else:
+            stats['documents'] += 1
+            if stored is None:
+                upserts.append((doc_id, doc))
+                stats['added'] += 1
+            elif canonical(doc) != canonical(stored):
+                upserts.append((doc_id, doc))
+                stats['changed'] += 1
+        if len(upserts) >= batch_size:
+            _write_upserts(backend, collection, upserts)
+            upserts = []
+        if len(orphans) >= batch_size:
+            backend._call_deleted_many(collection, orphans)
+            orphans = []
+    if upserts:
+        _write_upserts(backend, collection, upserts)
+    if orphans:
+        backend._call_deleted_many(collection, orphans)
+    log.info('resync %s: %d documents (%d added, %d changed, %d deleted) in '
+             '%.3fs', collection.name, stats['documents'], stats['added'],
+             stats['changed'], stats['deleted'], time.time() - t0)
+    return stats
+
+
+class RangeVerifier(object):
+    """
+    Checks (and repairs) a collection's documents in a backend by comparing
+    digests of ranges of ids (see :mod:`cqrs.verify`).
+
+    ``stats`` counts the ranges compared, the documents read (on both sides)
+    and the documents which had drifted.
+    """
+
+    def __init__(self, backend, collection, branching=None, leaf_size=None):
+        self.backend = backend
+        self.collection = collection
+        self.branching = max(2, branching or settings.CQRS_VERIFY_BRANCHING)
+        self.leaf_size = leaf_size or settings.CQRS_BULK_CHUNK_SIZE
+        self.stats = {'ranges': 0, 'documents': 0, 'drifted': 0}
+
+    def source_docs(self, lo=None, hi=None):
+        """
+        Generate ``(pk, canonical document)`` for the objects with
+        ``lo <= pk < hi``, in order.
+        """
+        for pk, doc in dumped_docs(self.backend, self.collection, lo, hi):
+            self.stats['documents'] += 1
+            yield pk, canonical(doc)
+
+    def stored_docs(self, lo=None, hi=None):
+        """
+        Generate ``(doc_id, canonical document)`` for the stored documents
+        with ``lo <= doc_id < hi``, in order.
+        """
+        for doc_id, doc in self.backend.docs_in_range(self.collection, lo, hi):
+            self.stats['documents'] += 1
+            yield doc_id, canonical(doc)
+
+    def _digests(self, pairs, bounds):
+        """
+        Digest ``(id, document)`` pairs, in order, in the ranges starting at
+        each of ``bounds``.
+        """
+        digests = [hashlib.md5() for _ in bounds]
+        for doc_id, doc in pairs:
+            digests[bisect_right(bounds, doc_id) - 1].update(
+                '{}\0{}\n'.format(doc_id, doc))
+        return [digest.digest() for digest in digests]
+
+    def _compare(self, lo, hi):
+        """Compare the documents in a range one by one, returning drift."""
+        self.stats['ranges'] += 1
+        source = dict(self.source_docs(lo, hi))
+        stored = dict(self.stored_docs(lo, hi))
+        return set(doc_id for doc_id in set(source) | set(stored)
+                   if source.get(doc_id) != stored.get(doc_id))
+
+    def _narrow(self, lo, hi):
+        """Find the drift in a range, looking closer where digests differ."""
+        if hi - lo <= self.leaf_size:
+            return self._compare(lo, hi)
+        step = -(-(hi - lo) // self.branching)
+        bounds = range(lo, hi, step)
+        self.stats['ranges'] += len(bounds)
+        source = self._digests(self.source_docs(lo, hi), bounds)
+        stored = self._digests(self.stored_docs(lo, hi), bounds)
+        drifted = set()
+        for start, source_digest, stored_digest in zip(bounds, source, stored):
+            if source_digest != stored_digest:
+                drifted |= self._narrow(start, min(start + step, hi))
+        return drifted
+
+    def drifted(self):
+        """Get the ids of the documents which aren't as they should be."""
+        keys = self.collection.queryset(prefetch=False).aggregate(
+            lo=Min('pk'), hi=Max('pk'))
+        if keys['lo'] is None:
+            # Nothing should be there at all.
+            return self._compare(None, None)
+        lo, hi = keys['lo'], keys['hi'] + 1
+        # Anything outside the database's keys is stale.
+        drifted = self._compare(None, lo) | self._compare(hi, None)
+        return drifted | self._narrow(lo, hi)
+
+    def verify(self, repair=True):
+        """
+        Find the documents which have drifted and, if ``repair``, reconcile
+        them. Returns their ids, sorted.
+        """
+        drifted = self.drifted()
+        self.stats['drifted'] = len(drifted)
+        log.info('verify %s: %d documents drifted (%d ranges, %d documents '
+                 'read)', self.collection.name, len(drifted),
+                 self.stats['ranges'], self.stats['documents'])
+        if repair and drifted:
+            reconcile(self.backend, self.collection, drifted)
+        return sorted(drifted)